@@ -0,0 +1,58 @@
+# One bit per chunk, for the chunk masks bvTorrent-client.py and
+#   bvTorrent-tracker.py keep. The tracker protocol spells a mask out as a
+#   string of '0' and '1' characters, which is 8 times bigger and has to be
+#   rebuilt to change a single chunk. A Bitfield is converted to and from
+#   that string only where it goes over the wire. Chunk 0 is the high bit of
+#   the first byte, so the bits are in the same order as the string.
+class Bitfield:
+    def __init__(self, size, bits=None):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8) if bits is None else bytearray(bits)
+
+    # builds a Bitfield from a '0'/'1' mask string, a trailing newline is ignored
+    @classmethod
+    def fromMask(cls, mask):
+        mask = mask.strip()
+        byteCount = (len(mask) + 7) // 8
+        value = int(mask.ljust(byteCount * 8, "0"), 2) if mask else 0
+        return cls(len(mask), value.to_bytes(byteCount, 'big'))
+
+    # the '0'/'1' mask string, without a newline
+    def toMask(self):
+        if not self.size:
+            return ""
+        return format(int.from_bytes(self.bits, 'big'), f"0{len(self.bits) * 8}b")[:self.size]
+
+    def __getitem__(self, index):
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def set(self, index):
+        self.bits[index >> 3] |= 0x80 >> (index & 7)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.size == other.size and self.bits == other.bits
+
+    def copy(self):
+        return Bitfield(self.size, self.bits)
+
+    # number of chunks set
+    def count(self):
+        return int.from_bytes(self.bits, 'big').bit_count()
+
+    def isFull(self):
+        return self.count() == self.size
+
+    # indexes of the chunks set in this field but not in `other', or in
+    #   exactly one of the two with symmetric=True
+    def difference(self, other, symmetric=False):
+        mine = int.from_bytes(self.bits, 'big')
+        theirs = int.from_bytes(other.bits, 'big')
+        diff = (mine ^ theirs) if symmetric else (mine & ~theirs)
+        shift = len(self.bits) * 8 - 1
+        indexes = []
+        while diff:
+            low = diff & -diff
+            indexes.append(shift - (low.bit_length() - 1))
+            diff ^= low
+        indexes.reverse()
+        return indexes
@@ -0,0 +1,165 @@
+from socket import *
+
+# number of bytes asked for in a single recv call
+RECV_SIZE = 65536
+
+# Buffered reader for one socket. Instead of calling recv(1) for every byte,
+#   it pulls large chunks into a bytearray and hands out complete lines and
+#   fixed-length messages from it. Bytes received past the end of a line or
+#   message stay in the buffer for the next call, so every read on a socket
+#   must go through the same reader once one is created for it.
+class BufferedReader:
+    def __init__(self, conn, recvSize=RECV_SIZE):
+        self.conn = conn
+        self.recvSize = recvSize
+        self.buffer = bytearray(recvSize)
+        self.start = 0 # index of the first unread byte in buffer
+        self.end = 0 # index one past the last received byte in buffer
+        self.scanned = 0 # bytes after start already known to contain no newline
+        self.eof = False # True once the other side closed the connection
+        self.recvCalls = 0 # number of recv syscalls made, used by the benchmarks
+
+    # number of received bytes that haven't been handed out yet
+    def buffered(self):
+        return self.end - self.start
+
+    # make room for at least `size' more bytes at the end of the buffer, moving
+    #   unread bytes to the front or growing the buffer when it is full
+    def makeRoom(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        unread = self.end - self.start
+        if unread + size > len(self.buffer):
+            newBuffer = bytearray(max(unread + size, 2 * len(self.buffer)))
+            newBuffer[:unread] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = newBuffer
+        else:
+            self.buffer[:unread] = memoryview(self.buffer)[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    # receive one chunk from the socket into the buffer.
+    #   returns the number of bytes received, 0 if the connection is closed.
+    #   with flags=MSG_DONTWAIT this raises BlockingIOError if nothing is waiting
+    def fill(self, flags=0):
+        self.makeRoom(self.recvSize)
+        with memoryview(self.buffer) as view:
+            received = self.conn.recv_into(view[self.end:], 0, flags)
+        self.recvCalls += 1
+        if received == 0:
+            self.eof = True
+        self.end += received
+        return received
+
+    # marks the next `length' bytes of the buffer as read
+    def consume(self, length):
+        self.start += length
+        self.scanned = 0
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    # decodes the next `length' bytes of the buffer straight out of it and
+    #   marks them as read
+    def take(self, length, decodeLength=None):
+        if decodeLength is None:
+            decodeLength = length
+        with memoryview(self.buffer) as view:
+            text = str(view[self.start:self.start + decodeLength], 'utf-8')
+        self.consume(length)
+        return text
+
+    # returns the next complete line in the buffer without touching the
+    #   socket, or None if there isn't a full line buffered yet
+    def popLine(self, keepNewline=False):
+        newline = self.buffer.find(b'\n', self.start + self.scanned, self.end)
+        if newline == -1:
+            self.scanned = self.end - self.start
+            return None
+        length = newline + 1 - self.start
+        return self.take(length, length if keepNewline else length - 1)
+
+    # gets a line from the socket, blocking until a newline is read.
+    #   if the connection closes first, whatever was received is returned
+    def getLine(self, keepNewline=False):
+        while True:
+            line = self.popLine(keepNewline)
+            if line is not None:
+                return line
+            if self.eof or self.fill() == 0:
+                return self.take(self.buffered())
+
+    # gets a line from the socket without blocking. returns None if a full
+    #   line hasn't arrived yet, the partial line stays buffered for next time
+    def getLineAsync(self, keepNewline=False):
+        while True:
+            line = self.popLine(keepNewline)
+            if line is not None or self.eof:
+                return line
+            try:
+                if self.fill(MSG_DONTWAIT) == 0:
+                    return None
+            except BlockingIOError:
+                return None
+
+    # receives whatever is waiting on the socket without blocking. returns
+    #   True once at least `length' bytes are buffered
+    def bufferedAsync(self, length):
+        while self.buffered() < length and not self.eof:
+            try:
+                if self.fill(MSG_DONTWAIT) == 0:
+                    break
+            except BlockingIOError:
+                break
+        return self.buffered() >= length
+
+    # receives until at least `length' bytes are buffered, blocking. returns
+    #   False if the connection closed first
+    def ensure(self, length):
+        while self.buffered() < length:
+            if self.eof or self.fill() == 0:
+                return False
+        return True
+
+    # returns a memoryview of the buffered bytes, for parsing many small
+    #   fields without a call per field. Use it in a with block, the buffer
+    #   can't grow while the view is alive, and consume what was parsed after
+    def view(self):
+        return memoryview(self.buffer)[self.start:self.end]
+
+    # returns the next `length' buffered bytes without marking them as read
+    def peek(self, length):
+        return bytes(self.buffer[self.start:self.start + length])
+
+    # fills the writable buffer `view' (a bytearray, memoryview or mmap slice)
+    #   with the next len(view) bytes of the stream. buffered bytes are copied
+    #   first and the rest is received straight into `view'. returns the number
+    #   of bytes written, which is less than len(view) if the connection closed
+    #   or the socket's timeout ran out first
+    def readInto(self, view):
+        view = memoryview(view).cast('B')
+        length = len(view)
+        fromBuffer = min(length, self.buffered())
+        view[:fromBuffer] = memoryview(self.buffer)[self.start:self.start + fromBuffer]
+        self.consume(fromBuffer)
+
+        received = fromBuffer
+        while received < length and not self.eof:
+            try:
+                count = self.conn.recv_into(view[received:])
+            except TimeoutError:
+                break
+            self.recvCalls += 1
+            if count == 0:
+                self.eof = True
+            received += count
+        return received
+
+    # fully fetches a message of `msgLength' bytes from the socket. returns a
+    #   bytearray, which is shorter than msgLength if the connection closed
+    #   or timed out
+    def getFullMsg(self, msgLength):
+        msg = bytearray(msgLength)
+        received = self.readInto(msg)
+        if received < msgLength:
+            del msg[received:]
+        return msg
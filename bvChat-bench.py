@@ -0,0 +1,456 @@
+from socket import *
+from sys import argv, executable
+import threading
+import selectors
+import subprocess
+import tempfile
+import random
+import time
+import importlib
+import queue
+import curses
+import os
+import pty
+import struct
+import fcntl
+import termios
+from bvBufferedReader import BufferedReader
+import bvChatProtocol as protocol
+from bvChatRender import MessageView
+from bvChatLib import ChatClient
+
+# benchmarks for the bvChat programs
+# usage: bvChat-bench.py reader [MESSAGES]
+#        bvChat-bench.py broadcast [BROADCASTS]
+#        bvChat-bench.py framing [MESSAGES]
+#        bvChat-bench.py render [MESSAGES] [BURST]
+#        bvChat-bench.py load [USERS] [MESSAGES] [HASH_ITERATIONS]
+
+# the server's file name isn't a valid module name, so import it by path name
+chatServer = importlib.import_module("bvChat-server")
+
+# wraps a socket and counts every recv call made on it
+class CountingSocket:
+    def __init__(self, conn):
+        self.conn = conn
+        self.recvCalls = 0
+
+    def recv(self, size, flags=0):
+        self.recvCalls += 1
+        return self.conn.recv(size, flags)
+
+    def recv_into(self, view, size=0, flags=0):
+        self.recvCalls += 1
+        return self.conn.recv_into(view, size, flags)
+
+# the byte-at-a-time line reader the chat programs used before BufferedReader
+def oldGetLine(conn):
+    msg = b''
+    while True:
+        ch = conn.recv(1)
+        if ch == b'\n' or len(ch) == 0:
+            break
+        msg += ch
+    return msg.decode()
+
+# the full message reader the chat programs used before BufferedReader
+def oldGetFullMsg(conn, msgLength):
+    msg = b''
+    while len(msg) < msgLength:
+        retVal = conn.recv(msgLength - len(msg))
+        msg += retVal
+        if len(retVal) == 0:
+            break
+    return msg.decode()
+
+# builds `count' pushed chat messages the way the server sends them
+def makeMessages(count):
+    data = []
+    for i in range(count):
+        msg = f"message number {i} from the benchmark, padded out to a typical chat line"
+        data.append((str(len(msg)) + ":bench\n" + msg).encode())
+    return b''.join(data)
+
+# sends `data' from a separate thread so the reading side can be timed alone
+def sendInBackground(conn, data):
+    def send():
+        conn.sendall(data)
+        conn.close()
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    return thread
+
+# reads `count' messages with either the old or the buffered reader and
+#   returns (seconds, recv calls)
+def readMessages(count, buffered):
+    sender, receiver = socketpair()
+    conn = CountingSocket(receiver)
+    thread = sendInBackground(sender, makeMessages(count))
+
+    start = time.perf_counter()
+    if buffered:
+        reader = BufferedReader(conn)
+        for i in range(count):
+            header = reader.getLine()
+            colon = header.find(":")
+            reader.getFullMsg(int(header[:colon])).decode()
+    else:
+        for i in range(count):
+            header = oldGetLine(conn)
+            colon = header.find(":")
+            oldGetFullMsg(conn, int(header[:colon]))
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    receiver.close()
+    return elapsed, conn.recvCalls
+
+# compares syscalls and time per message for the old and buffered readers
+def benchReader(count):
+    print(f"reading {count} pushed chat messages over a socketpair")
+    print(f"{'reader':<10}{'recv calls':>12}{'calls/msg':>12}{'us/msg':>10}")
+    for name, buffered in (("recv(1)", False), ("buffered", True)):
+        elapsed, calls = readMessages(count, buffered)
+        print(f"{name:<10}{calls:>12}{calls / count:>12.3f}{elapsed / count * 1e6:>10.2f}")
+
+# the broadcast the server used before it kept a set of online users: every
+#   registered user is visited under one global lock and gets its own tuple
+def oldBroadcastMessage(message, curr_user, buffers, isOnline, lock):
+    lock.acquire()
+    for uname in buffers:
+        if uname == curr_user or isOnline[uname] == False:
+            continue
+        buffers[uname].put_nowait((curr_user, message))
+    lock.release()
+
+# registers 4 users for every online one, so offline users make up most of
+#   the user base like they do on a real server. returns a queue for every
+#   registered user, the way the old server kept them
+def makeUsers(online):
+    chatServer.userMessageBuffers.clear()
+    chatServer.userIsOnline.clear()
+    allBuffers = {}
+    for i in range(online * 4):
+        chatServer.initUser(f"user{i}")
+        allBuffers[f"user{i}"] = queue.Queue()
+    for i in range(online):
+        chatServer.setOnline(f"user{i}", True)
+    return allBuffers
+
+# empties every message queue between runs
+def clearBuffers(allBuffers):
+    for buffers in (allBuffers, chatServer.userMessageBuffers):
+        for buffer in buffers.values():
+            while not buffer.empty():
+                buffer.get_nowait()
+
+# measures broadcasts per second against the number of online users
+def benchBroadcast(broadcasts):
+    message = "a broadcast message of about the length people usually type"
+    lock = threading.Lock()
+    print(f"{broadcasts} broadcasts, 4 registered users per online user")
+    print(f"{'online':>8}{'old/s':>12}{'new/s':>12}{'speedup':>10}")
+    for online in (10, 100, 1000, 10000):
+        allBuffers = makeUsers(online)
+        count = max(1, broadcasts // online)
+
+        start = time.perf_counter()
+        for i in range(count):
+            oldBroadcastMessage(message, "user0", allBuffers, chatServer.userIsOnline, lock)
+        oldRate = count / (time.perf_counter() - start)
+        clearBuffers(allBuffers)
+
+        start = time.perf_counter()
+        for i in range(count):
+            chatServer.broadcastMessage(message, "user0")
+        newRate = count / (time.perf_counter() - start)
+        clearBuffers(allBuffers)
+
+        print(f"{online:>8}{oldRate:>12.0f}{newRate:>12.0f}{newRate / oldRate:>9.1f}x")
+
+# builds `count' broadcast commands the way a client sends them, as a list of
+#   the separate send calls for each message
+def makeCommands(count, version):
+    sends = []
+    for i in range(count):
+        text = f"message number {i} from the benchmark, padded out to a typical chat line"
+        if version == 2:
+            sends.append([protocol.encodeFrame(protocol.BROADCAST, text.encode())])
+        else:
+            sends.append([("MSG_BROADCAST:" + str(len(text)) + "\n").encode(), text.encode()])
+    return sends
+
+# sends and parses `count' broadcast commands in one protocol version and
+#   returns (send calls, parse seconds)
+def frameMessages(count, version):
+    sends = makeCommands(count, version)
+    sendCalls = sum(len(message) for message in sends)
+    sender, receiver = socketpair()
+    thread = sendInBackground(sender, b''.join(b''.join(message) for message in sends))
+
+    reader = BufferedReader(receiver)
+    while reader.fill() > 0:
+        pass # get everything into the buffer so only parsing is timed
+    thread.join()
+
+    start = time.perf_counter()
+    if version == 2:
+        for i in range(count):
+            protocol.readFrame(reader)[2].decode()
+    else:
+        for i in range(count):
+            header = reader.getLine()
+            reader.getFullMsg(int(header[14:])).decode()
+    elapsed = time.perf_counter() - start
+    receiver.close()
+    return sendCalls, elapsed
+
+# compares send calls and parse time per message for v1 and v2 framing
+def benchFraming(count):
+    print(f"sending and parsing {count} broadcast commands")
+    print(f"{'protocol':<10}{'send calls':>12}{'calls/msg':>12}{'parse us/msg':>14}")
+    for version in (1, 2):
+        sendCalls, elapsed = frameMessages(count, version)
+        print(f"{'v' + str(version):<10}{sendCalls:>12}{sendCalls / count:>12.1f}{elapsed / count * 1e6:>14.2f}")
+
+# the renderer bvChat-client.py used before MessageView: blanks every row and
+#   draws the whole visible history again for every batch of new messages
+def oldRenderMessages(stdscr, allMessages, newMessages, width, height, emptyStr):
+    for i in range(len(newMessages)):
+        allMessages.append(newMessages.pop(-1))
+    msgIndex = len(allMessages) - 1
+    for i in range(height-1, 0, -1):
+        stdscr.addstr(i, 0, emptyStr)
+    renderIndex = height-1
+    while renderIndex > 1 and msgIndex >= 0:
+        msg, rows = allMessages[msgIndex]
+        renderIndex -= rows
+        stdscr.addstr(renderIndex, 0, msg)
+        msgIndex -= 1
+        renderIndex -= 1
+
+# draws `count' chat lines `burst' at a time with the old renderer or
+#   MessageView on the terminal this process has, the client's 76x18 layout
+#   on an 80x24 screen, and writes the seconds it took to the pipe `result'
+def renderInTerminal(renderer, count, burst, result):
+    width, height = 76, 18
+    stdscr = curses.initscr()
+    messages = [f"[user{i % 7}]: message number {i} from the benchmark, a typical chat line" for i in range(count)]
+    start = time.perf_counter()
+    if renderer == "old":
+        allMessages = []
+        for first in range(0, count, burst):
+            oldRenderMessages(stdscr, allMessages, [(msg, 0) for msg in messages[first:first + burst]], width, height, " " * width)
+            stdscr.refresh()
+    else:
+        view = MessageView(curses.newwin(height - 1, width + 1, 1, 0), width)
+        for first in range(0, count, burst):
+            view.draw([(msg, curses.A_NORMAL, True) for msg in messages[first:first + burst]])
+            curses.doupdate()
+    elapsed = time.perf_counter() - start
+    curses.endwin()
+    os.write(result, str(elapsed).encode())
+
+# runs renderInTerminal in a child process on a pseudo terminal, returns
+#   (seconds, bytes written to the terminal)
+def renderInPty(renderer, count, burst):
+    resultRead, resultWrite = os.pipe()
+    pid, terminal = pty.fork()
+    if pid == 0:
+        os.environ["TERM"] = "xterm"
+        fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack("HHHH", 24, 80, 0, 0))
+        try:
+            renderInTerminal(renderer, count, burst, resultWrite)
+        finally:
+            os._exit(0)
+    os.close(resultWrite)
+    written = 0
+    while True:
+        try:
+            data = os.read(terminal, 65536)
+        except OSError:
+            break # the child exited and closed the terminal
+        if not data:
+            break
+        written += len(data)
+    os.waitpid(pid, 0)
+    elapsed = float(os.read(resultRead, 64) or "nan")
+    os.close(resultRead)
+    os.close(terminal)
+    return elapsed, written
+
+# compares the old full repaint with MessageView's scrolling for messages
+#   that arrive one at a time and in bursts
+def benchRender(count, burst):
+    print(f"drawing {count} chat lines on an 80x24 terminal")
+    print(f"{'renderer':<10}{'burst':>6}{'us/line':>10}{'bytes/line':>12}")
+    for size in sorted({1, burst}):
+        for renderer in ("old", "new"):
+            elapsed, written = renderInPty(renderer, count, size)
+            print(f"{renderer:<10}{size:>6}{elapsed / count * 1e6:>10.1f}{written / count:>12.1f}")
+
+# starts bvChat-server.py on `port' with its credentials and mailbox in
+#   `stateDir', hashing new passwords with `iterations' rounds
+LOAD_SERVER = """
+import asyncio, importlib, sys
+from pathlib import Path
+chatServer = importlib.import_module("bvChat-server")
+port, stateDir, iterations = int(sys.argv[1]), Path(sys.argv[2]), int(sys.argv[3])
+chatServer.port = port
+chatServer.credentialLog = stateDir / ".credentials.log"
+chatServer.credentialFile = stateDir / ".credentials.json"
+chatServer.mailboxFile = stateDir / ".mailbox.db"
+chatServer.HASH_ITERATIONS = iterations
+asyncio.run(chatServer.main())
+"""
+
+# threads the simulated users are spread over. Each one logs its users in
+#   one after another and then runs their traffic with a single selector
+LOAD_WORKERS = 16
+
+# 1 in BROADCAST_EVERY messages a simulated user sends is a broadcast, the
+#   rest are direct messages to a random user
+BROADCAST_EVERY = 50
+
+# the load test is over once no message arrived for this many seconds
+DRAIN_IDLE = 2
+
+# every load test message ends with this and the perf_counter() it was sent at
+SENT_MARK = "sent at "
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def startChatServer(stateDir, iterations):
+    with socket(AF_INET, SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen([executable, "-c", LOAD_SERVER, str(port), stateDir, str(iterations)],
+        stdout=subprocess.DEVNULL, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))))
+    while True: # wait until it listens
+        try:
+            create_connection(("127.0.0.1", port)).close()
+            return server, port
+        except ConnectionRefusedError:
+            time.sleep(.05)
+
+# logs in the users called `names', waits at `barrier' for every other
+#   worker, has each user send `messages' messages and reads what they get
+#   until the server goes quiet. Fills in `result'
+def loadWorker(port, names, allNames, messages, barrier, result):
+    picker = random.Random(names[0])
+    latencies = result["latencies"] = []
+    result["lastDelivery"] = 0
+    def onMessage(sender, text):
+        mark = text.rfind(SENT_MARK)
+        if mark != -1:
+            now = time.perf_counter()
+            latencies.append(now - float(text[mark + len(SENT_MARK):]))
+            result["lastDelivery"] = now
+
+    clients = []
+    logins = result["logins"] = []
+    for name in names:
+        start = time.perf_counter()
+        client = ChatClient("127.0.0.1", port, onMessage)
+        try:
+            if client.connect().startswith("ACK") and client.login(name, "load") == "AUTH_GOOD":
+                logins.append(time.perf_counter() - start)
+                clients.append(client)
+                continue
+        except OSError:
+            pass
+        client.conn.close()
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.messageSocket, selectors.EVENT_READ, client)
+
+    barrier.wait() # everybody is logged in
+    tells = broadcasts = 0
+    for n in range(messages):
+        for client in clients:
+            text = f"load test message {n}, {SENT_MARK}{time.perf_counter()!r}"
+            if picker.randrange(BROADCAST_EVERY) == 0:
+                client.broadcast(text)
+                broadcasts += 1
+            else:
+                client.tell(picker.choice(allNames), text)
+                tells += 1
+            for key, events in selector.select(0):
+                key.data.poll()
+    result["tells"], result["broadcasts"] = tells, broadcasts
+
+    while True:
+        events = selector.select(DRAIN_IDLE)
+        if not events:
+            break
+        for key, mask in events:
+            if not key.data.poll():
+                selector.unregister(key.fileobj)
+    for client in clients:
+        client.close()
+
+# simulates `userCount' users against a bvChat-server.py of its own and
+#   reports how fast they log in and how fast their messages get delivered
+def benchLoad(userCount, messages, iterations):
+    chatServer.raiseFileLimit()
+    names = [f"load{n:05}" for n in range(userCount)]
+    with tempfile.TemporaryDirectory() as stateDir:
+        server, port = startChatServer(stateDir, iterations)
+        workers = min(LOAD_WORKERS, userCount)
+        barrier = threading.Barrier(workers + 1)
+        results = [{} for n in range(workers)]
+        threads = [threading.Thread(target=loadWorker, args=(port, names[n::workers], names, messages, barrier, results[n]))
+            for n in range(workers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        trafficStart = time.perf_counter()
+        loginSeconds = trafficStart - start
+        for thread in threads:
+            thread.join()
+        server.kill()
+        server.wait()
+
+    logins = sorted(login for result in results for login in result["logins"])
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    tells = sum(result["tells"] for result in results)
+    broadcasts = sum(result["broadcasts"] for result in results)
+    expected = tells + broadcasts * (len(logins) - 1)
+    print(f"{userCount} users, {messages} messages each, {iterations} hash iterations")
+    if not logins:
+        print("nobody could log in")
+        return
+    print(f"logged in {len(logins)} in {loginSeconds:.2f} s, {len(logins) / loginSeconds:.1f} logins/s, "
+        f"p50 {percentile(logins, 50) * 1000:.1f} ms, p99 {percentile(logins, 99) * 1000:.1f} ms")
+    print(f"sent {tells} tells and {broadcasts} broadcasts, delivered {len(latencies)} of {expected}")
+    if not latencies:
+        return
+    trafficSeconds = max(result["lastDelivery"] for result in results) - trafficStart
+    print(f"{len(latencies) / trafficSeconds:.0f} deliveries/s over {trafficSeconds:.2f} s")
+    print(f"latency ms: p50 {percentile(latencies, 50) * 1000:.1f}, p90 {percentile(latencies, 90) * 1000:.1f}, "
+        f"p99 {percentile(latencies, 99) * 1000:.1f}, max {latencies[-1] * 1000:.1f}")
+
+if len(argv) < 2:
+    print("usage: bvChat-bench.py reader [MESSAGES]")
+    print("       bvChat-bench.py broadcast [BROADCASTS]")
+    print("       bvChat-bench.py framing [MESSAGES]")
+    print("       bvChat-bench.py render [MESSAGES] [BURST]")
+    print("       bvChat-bench.py load [USERS] [MESSAGES] [HASH_ITERATIONS]")
+    exit()
+
+mode = argv[1]
+if mode == "reader":
+    benchReader(int(argv[2]) if len(argv) > 2 else 20000)
+elif mode == "broadcast":
+    benchBroadcast(int(argv[2]) if len(argv) > 2 else 200000)
+elif mode == "framing":
+    benchFraming(int(argv[2]) if len(argv) > 2 else 50000)
+elif mode == "render":
+    benchRender(int(argv[2]) if len(argv) > 2 else 20000, int(argv[3]) if len(argv) > 3 else 50)
+elif mode == "load":
+    benchLoad(int(argv[2]) if len(argv) > 2 else 1000, int(argv[3]) if len(argv) > 3 else 10,
+        int(argv[4]) if len(argv) > 4 else chatServer.HASH_ITERATIONS)
+else:
+    print(f"unknown benchmark {mode}")
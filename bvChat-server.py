@@ -1,420 +1,695 @@
-from socket import *
-import threading
-import json
-from pathlib import Path
-import queue
-import time
-
-# store username and passwords as JSON in pathlib object
-credentialFile = Path(__file__).parent / ".credentials.json"
-
-# create the credential file if it doesn't exist.
-if not credentialFile.exists():
-    with open(str(credentialFile), "w") as f:
-        f.write("{}")
-
-port = 42424 # default server port
-
-# contains all user credentials, where key is the username, a
-#   and value is the user's password
-userCredentials = {}
-
-# contains booleans for each username representing whether the user is online or not.
-userIsOnline = {}
-
-# contains all incoming messages to each user
-# each username is associated with a queue object that get processed when filled
-userMessageBuffers = {}
-
-# contains the number of login failures per user
-auth_failures = {}
-
-# contains the number of 30 second intervals a user needs 
-#   for a user to be able to log in again
-reauth_cooldown = {}
-
-# timeout time retries x 30 seconds for a user to retry logging
-#   in again after 3 unsuccessful login attempts in 30 seconds
-CLIENT_AUTH_TIMEOUT = 4
-
-# number of seconds the server waits before decrementing lockout timer
-TIMEOUT_CHECKER_TIMEOUT = 30
-
-# loop condiiton that controls when the main thread exits
-running = True
-
-MOTD = "We've been trying to reach you concerning your vehicle's extended warranty."
-
-# mutexes #
-statusLock = threading.Lock() # lock for accessing login state (logged in)
-msgAccessLock = threading.Lock() # lock for accessing message queues 
-authFailLock = threading.Lock() # lock for accessing auth_failures dict
-
-# init a listener for clients to connect to
-listener = socket(AF_INET, SOCK_STREAM)
-listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-listener.bind(('', port))
-listener.listen(20) # allow 20 simultaneous connections
-
-# this function loads user credentials as JSON from a credential file stored on disk
-# this method is called when the server starts.
-def loadCredentials():
-    global userCredentials, userIsOnline
-    with open(str(credentialFile), "r") as jsonFile:
-        userCredentials = json.load(jsonFile)
-
-    # for each user in the credential file, initialize internal data 
-    #   structures for that user
-    for username in userCredentials:
-        initUser(username)
-
-# write user credentials dict to credential file        
-def writeCredentials():
-    with open(str(credentialFile), "w") as jsonFile:
-        json.dump(userCredentials, jsonFile)
-
-# Fully fetches a message of `msgLength' bytes from the specified socket `conn'
-def getFullMsg(conn, msgLength):
-    msg = b''
-    while len(msg) < msgLength:
-        retVal = conn.recv(msgLength - len(msg))
-        msg += retVal
-        if len(retVal) == 0:
-            break    
-    return msg.decode()
-
-# gets a message from a specified socket 'conn' until a newline is read.
-#    the socket does not block to receive a message. Thus, if a message
-#    is not received, the socket will time out and will return 
-def getLineAsync(conn):
-    msg = b''
-    while True:
-        try:
-            ch = conn.recv(1, MSG_DONTWAIT)
-            if ch == b'\n' or len(ch) == 0:
-                break
-            msg += ch
-        except BlockingIOError:
-            break
-    return msg.decode()
-
-# gets a message from a specified socket 'conn' until a newline is read.
-#   the socket blocks until a message is received. 
-def getLineSync(conn):
-    msg = b''
-    while True:
-        ch = conn.recv(1)
-        if ch == b'\n':
-            break
-        msg += ch
-    return msg.decode()
-
-# gets a list of all users that are currently connected to the server
-def getOnlineUsers():
-    users = []
-    for user in userIsOnline:
-        if userIsOnline[user]:
-            users.append(user)
-    return users
-
-# initialize auth failure data structures for an ip address
-def initAuthDetect(ip):
-    authFailLock.acquire()
-    auth_failures[ip] = 0
-    reauth_cooldown[ip] = 0
-    authFailLock.release()
-
-# initialize all basic data structures for user data
-# this method is called when the server starts.
-def initUser(username):
-    global userMessageBuffer
-    msgAccessLock.acquire()
-    userMessageBuffer = queue.Queue() # init the messages queue 
-    userMessageBuffers[username] = userMessageBuffer # store it
-    msgAccessLock.release()
-
-    statusLock.acquire()
-    userIsOnline[username] = False # by default, all users are offline
-    statusLock.release()
-
-# given a message and a username, send a message to every other
-#   user that is connected to the server
-def broadcastMessage(message, curr_user, server=False):
-    global userMessageBuffers
-    msgAccessLock.acquire()
-
-    # iterate through each user in messagebuffers.
-    for uname in userMessageBuffers:
-        # don't send message to yourself or to users that are offline
-        if uname == curr_user or userIsOnline[uname] == False:
-            continue
-
-        # when a message is stored, it is saved as a tuple containing
-        #    the sender and the message
-        #    if the server flag is set by the function caller, the sender
-        #    is set to the server itself
-        if server:
-            userMessageBuffers[uname].put(("SERVER", message))
-        else:
-            userMessageBuffers[uname].put((curr_user, message))
-    msgAccessLock.release()
-
-# given a message, a recipient, and a sender, send one user a message
-def unicastMessage(message, receiver, sender):
-    global userMessageBuffers
-    msgAccessLock.acquire()
-
-    # use minecraft syntax for direct message and denote the sender
-    unicastMessage = "UNICAST: " + sender + " whispers to you: " + message
-
-    # send the messge to the recipient
-    userMessageBuffers[receiver].put(("Server", unicastMessage))
-    msgAccessLock.release()
-
-# Process a given message from bvClient and respond appropriately with a socket connection
-def handleCommand(msg, conn, curr_user, async_conn):
-    if msg == "CLOSE":
-        # close the socket connection
-        cleanup(curr_user, conn, async_conn)
-    # send the MOTD
-    elif msg.startswith("MOTD"):
-        sendSize = str(len(MOTD)) + "\n"
-        conn.send(sendSize.encode())
-        conn.send(MOTD.encode())
-    # the client is sending a direct message
-    elif msg.startswith("MSG_TELL:"):
-        length = int(msg[9:]) # length of the incoming message
-        msg = getFullMsg(conn, length) # get the full message
-        colon = msg.find(":") # index of the colon that splits the username length from teh length of the message
-        username_len = int(msg[:colon])
-        receiver = msg[colon+1:colon+1+username_len] # the username of the message recipient
-        msg_slice = msg[colon+1+username_len:] # the actual message
-
-        # if the user doesn't exist, tell the user
-        if not receiver in userIsOnline:
-            conn.send(b"ERR_NOUSER\n")
-            return 
-        else:
-            conn.send(b"ACK\n")
-        # send the message
-        unicastMessage(msg_slice, receiver, curr_user)
-
-    # the client is sending a message to all online users
-    elif msg.startswith("MSG_BROADCAST:"):
-        length = int(msg[14:]) # length of the message in the header
-        msg = getFullMsg(conn, length) # get the full message
-        broadcastMessage(msg, curr_user) # broadcast it
-
-    # the client is requesting a list of all online users
-    elif msg.startswith("QUERY_ONLINE_USERS"):
-        users_str = ", ".join(getOnlineUsers()) # make a comma-delimited string of users
-        header = "USERS:"+ str(len(users_str)) + "\n" # get the length of user string
-        conn.send(header.encode()) # SEND IT
-        conn.send(users_str.encode())
-
-    # send an emote message
-    elif msg.startswith("/me: "):
-        colon = msg.find(":", 5, -1) # find the colon seperating the username and length of the message
-        msg_len = int(msg[5:colon])
-        emote_txt = getFullMsg(conn, msg_len) # get the full message
-        username = msg[colon+1:]
-        broadcastMessage(emote_txt, username) # send the message
-
-# given a username, get messages from their message buffer from when they were offline
-def getOfflineMessages(username, conn):
-    notificationMSG = "You have new direct messages: "
-    msgAccessLock.acquire()
-    size = userMessageBuffers[username].qsize() # get the number of messages in the queue
-    if size > 0:
-        # encode the length of the notification message and denote it as from the server
-        header = str(len(notificationMSG)) + ":Server" + "\n"
-        conn.send(header.encode()) # S E N D   I T
-        conn.send(notificationMSG.encode())
-
-        # keep looping until the queue is empty
-        while userMessageBuffers[username].qsize() != 0:
-            data = userMessageBuffers[username].get() # dequeue a tuple
-            sender = data[0] # get the sender
-            msg = data[1] # get the message
-            unicast_header = str(len(msg)) + ":" + sender + "\n" # endocde the message length and sender
-            conn.send(unicast_header.encode()) # s e n d
-            conn.send(msg.encode())
-
-    msgAccessLock.release()
-
-# handle all the stuff that needs to happen before closing here
-def cleanup(*args):
-    username = args[0]
-    # announce that elvis has left the building
-    broadcastMessage(username + " has left the chat room.", username, True)
-    statusLock.acquire()
-    userIsOnline[username] = False # set online status to false
-    statusLock.release()
-
-    # depending on length of args, we close one or two sockets
-    arg_len = len(args)
-    if arg_len == 3:
-        conn1 = args[1]
-        conn2 = args[2]
-        conn1.close()
-        conn2.close()
-    else:
-        conn = args[1]
-        conn.close()
-    exit(0)
-
-# thread for handling authentication failures
-def authTimeoutManager():
-    global auth_failures, reauth_cooldown
-    while running:
-        time.sleep(TIMEOUT_CHECKER_TIMEOUT) # wait 30 seconds
-        authFailLock.acquire()
-        for ip in auth_failures:
-            if auth_failures[ip] > 0: # reset login attempts
-                auth_failures[ip] = 0
-            if reauth_cooldown[ip] > 0: # decrement timer for account lockout
-                reauth_cooldown[ip] -= 1
-        authFailLock.release()
-
-# thread for handling each new connection
-def handleClient(connInfo):
-    global userCredentials, userIsOnline, userMessageBuffers, auth_failures, reauth_cooldown 
-    
-    # new connection objects
-    clientConn, clientAddr = connInfo
-    clientIP = clientAddr[0]
-    print(f"New connection from {clientIP}!")
-   
-    done = False # loop variable, set to true when it is time to exit the thread
-    auth = False # boolean for when the user successfully authenticates
-
-    # boolean for calling cleanup method
-    doCleanup = True
-
-    # get initialization message from client
-    init = getLineSync(clientConn)
-
-    if clientIP in reauth_cooldown:
-
-        # check to see if the client should be locked out 
-        if reauth_cooldown[clientIP] > 0:
-            # tell the client they are locked out and exit
-            clientConn.send(b"ERR_AUTH_LOCKOUT\n")
-            clientConn.close()
-            exit()
-        else:
-            # else, send an acknowledgement
-            clientConn.send(b"ACK\n")
-    else:
-        clientConn.send(b"ACK\n")
-
-    # get the client's username, password, and a port to send async messages to
-    username = getLineSync(clientConn)
-    password = getLineSync(clientConn)
-    msgSendPort = getLineSync(clientConn)
-
-    # if connecting from a new IP, log it
-    if clientIP not in auth_failures:
-        initAuthDetect(clientIP)
-
-    # authenticate user
-    if username in userCredentials:
-        if password == userCredentials[username]: # do the passwords match?
-            if userIsOnline[username] == True: # is the user already connected?
-                clientConn.send(b"ERR_CONCURRENT_CONNECTION\n") # no concurrent clients
-                done = True # exit the loop below
-            else:
-                # tell the client authentication was successful
-                clientConn.send(b"AUTH_GOOD\n")
-                auth = True # auth true
-        # auth failure
-        else:
-            authFailLock.acquire()
-            auth_failures[clientIP] += 1 # log an authentication failure
-            
-            # check to see if the user failed to auth 3 times in 30 seconds
-            if auth_failures[clientIP] >= 3: 
-                reauth_cooldown[clientIP] = CLIENT_AUTH_TIMEOUT # lock them out if so
-                auth_failures[clientIP] = 0 # reset auth failures
-                clientConn.send(b"AUTH_LOCKOUT\n") # let the user know
-            else:
-                clientConn.send(b"AUTH_FAIL\n") # tell the client about failed auth
-            authFailLock.release()
-            done = True
-    else:
-        # first time connection
-        userCredentials[username] = password # save password
-        clientConn.send(b"AUTH_GOOD\n")
-        initUser(username) # initialize data structures
-        auth = True
-        
-    # if authentication was successful
-    if auth:
-        statusLock.acquire()
-        userIsOnline[username] = True # change online status 
-        statusLock.release()
-        
-        # initialize socket to send asynchronous messages to
-        cmSocket = socket(AF_INET, SOCK_STREAM)
-        cmSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        while True:
-            try:
-                # keep trying to connect until the client accepts
-                cmSocket.connect((clientIP, int(msgSendPort)))
-                break
-            except ConnectionRefusedError:
-                continue
-
-        # tell all online users about our presence
-        broadcastMessage(username + " has joined the chat room!", username, True)
-
-        # get offline direct messages
-        getOfflineMessages(username, cmSocket)
-    
-    try:
-        while not done:
-            msg = getLineAsync(clientConn) # check for control messages from client
-            if msg != "":
-                handleCommand(msg, clientConn, username, cmSocket) # process the message
-            
-            # check to see if there are any new messages to broadcast
-            if userMessageBuffers[username].qsize() != 0:                
-                msgAccessLock.acquire()
-                data = userMessageBuffers[username].get() # get tuple
-                sender = data[0] # sender
-                msg = data[1] # message
-                msgAccessLock.release()
-                msgSize = str(len(msg)) + ":" + sender + "\n" # encode the message length and its sender
-                cmSocket.send(msgSize.encode()) # send data via async socket:
-                cmSocket.send(msg.encode())
-
-            # sleep so the loop doesn't happen every CPU cycle
-            time.sleep(.1)
-
-        if doCleanup:
-            if auth:
-                cleanup(username, clientConn, cmSocket)
-            else:
-                cleanup(username, clientConn)
-
-    # if a client suddenly disconnects, gracefully exit
-    except BrokenPipeError:
-        if doCleanup:
-            if auth:
-                cleanup(username, clientConn, cmSocket)
-            else:
-                cleanup(username, clientConn)
-
-# initialize the authentication checker timeout
-threading.Thread(target=authTimeoutManager, args=(), daemon=True).start()
-
-# program start
-while running: 
-    try:
-        # create a new thread for each connecting client
-        threading.Thread(target=handleClient, args=(listener.accept(),), daemon=True).start()
-    # if an exception occurs, exit gracefully
-    except KeyboardInterrupt:
-        print("Shutting down...")
-        writeCredentials() # save user credentials to a file
-        running = False
+from socket import *
+import asyncio
+import json
+from pathlib import Path
+import hashlib
+import hmac
+import os
+import resource
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bvChatProtocol as protocol
+
+# user credentials are stored as salted password hashes in an append-only log
+#   with one JSON record per line. New users and rehashed passwords are
+#   appended as they happen, a later line for a user replaces an earlier one
+credentialLog = Path(__file__).parent / ".credentials.log"
+
+# plaintext credential file used by older versions of the server. It is
+#   hashed into credentialLog and removed the first time the server starts
+credentialFile = Path(__file__).parent / ".credentials.json"
+
+# number of PBKDF2-SHA256 iterations used for new password hashes. Raising it
+#   makes every login cost more CPU; existing users are rehashed with the new
+#   count the next time they log in
+HASH_ITERATIONS = 200000
+
+# number of threads that hash passwords, which bounds how much CPU logins can
+#   take. hashlib releases the GIL while hashing, so they run in parallel
+HASH_WORKERS = os.cpu_count() or 1
+
+# the credential log is compacted once it has this many more lines than there
+#   are users
+CREDENTIAL_LOG_SLACK = 1000
+
+# direct messages sent to offline users are kept in a SQLite database so they
+#   don't take up memory and survive a server restart
+mailboxFile = Path(__file__).parent / ".mailbox.db"
+
+# the most direct messages kept for one offline user, older ones are dropped first
+MAILBOX_LIMIT = 100
+
+# number of seconds an undelivered direct message is kept before it is dropped
+MAILBOX_TTL = 7 * 24 * 60 * 60
+
+# number of seconds between sweeps that drop expired messages for every user
+MAILBOX_CLEAN_INTERVAL = 60 * 60
+
+# the most messages queued for an online user whose client doesn't keep up.
+#   Past that their oldest messages are dropped, direct messages go to the mailbox
+MESSAGE_QUEUE_LIMIT = 1000
+
+port = 42424 # default server port
+
+# number of pending connections the kernel queues for us before we accept them
+LISTEN_BACKLOG = 1024
+
+# whether clients may ask for duplex mode, where messages are pushed over their
+#   control connection instead of a second connection back to the client
+ALLOW_DUPLEX = True
+
+# number of times (and seconds between tries) the server tries to connect back to
+#   a client's message port before giving up on that client
+CALLBACK_RETRIES = 100
+CALLBACK_RETRY_DELAY = .05
+
+# contains all user credentials, where key is the username, a
+#   and value is a dict with the salt, hash and iteration count of the user's password
+userCredentials = {}
+
+# number of lines in the credential log, used to decide when to compact it
+credentialLogLines = 0
+
+# the credential log is only written from the credentialExecutor thread, so
+#   writes never block the event loop and happen in order. Passwords are
+#   hashed on hashExecutor's threads so logins don't stall other clients
+credentialExecutor = ThreadPoolExecutor(max_workers=1)
+hashExecutor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+# contains booleans for each username representing whether the user is online or not.
+userIsOnline = {}
+
+# contains all incoming messages to each user that is currently online, so a
+#   broadcast only has to visit the users that can receive it
+# each username is associated with a queue object that get processed when filled
+# messages are stored already encoded the way they are pushed to the client, as
+#   (frame, mail) pairs where `mail' is the (sender, message) of a direct
+#   message, kept so it can go to the mailbox if the user leaves before it is sent
+userMessageBuffers = {}
+
+# contains the protocol version (1 or 2) each online user's client speaks
+userVersions = {}
+
+# connection to the offline mailbox database. It is only ever used from the
+#   single mailboxExecutor thread, so database work never blocks the event loop
+#   and runs in the order it was submitted.
+mailbox = None
+mailboxExecutor = ThreadPoolExecutor(max_workers=1)
+
+# contains the number of login failures per user
+auth_failures = {}
+
+# contains the number of 30 second intervals a user needs
+#   for a user to be able to log in again
+reauth_cooldown = {}
+
+# timeout time retries x 30 seconds for a user to retry logging
+#   in again after 3 unsuccessful login attempts in 30 seconds
+CLIENT_AUTH_TIMEOUT = 4
+
+# number of seconds the server waits before decrementing lockout timer
+TIMEOUT_CHECKER_TIMEOUT = 30
+
+MOTD = "We've been trying to reach you concerning your vehicle's extended warranty."
+
+# all of the server's state is owned by a single asyncio event loop, so the
+#   data structures above are never touched by two clients at the same time
+#   and don't need mutexes.
+
+# hashes a password, returns a credential record for userCredentials
+def hashPassword(password, salt=None, iterations=None):
+    if salt is None:
+        salt = os.urandom(16)
+    if iterations is None:
+        iterations = HASH_ITERATIONS
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return {"salt": salt.hex(), "hash": digest.hex(), "iterations": iterations}
+
+# checks a password against a credential record
+def verifyPassword(password, credential):
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(credential["salt"]), credential["iterations"])
+    return hmac.compare_digest(digest.hex(), credential["hash"])
+
+# this function loads user credentials from the credential log stored on disk
+# this method is called when the server starts.
+def loadCredentials():
+    global userCredentials, credentialLogLines
+    userCredentials = {}
+    credentialLogLines = 0
+    if credentialLog.exists():
+        with open(str(credentialLog), "r") as logFile:
+            for line in logFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash
+                userCredentials[record.pop("username")] = record
+                credentialLogLines += 1
+
+    # hash the passwords from an old plaintext credential file
+    if credentialFile.exists():
+        with open(str(credentialFile), "r") as jsonFile:
+            for username, password in json.load(jsonFile).items():
+                if username not in userCredentials:
+                    userCredentials[username] = hashPassword(password)
+        writeCredentials()
+        credentialFile.unlink()
+
+    # for each user in the credential file, initialize internal data
+    #   structures for that user
+    for username in userCredentials:
+        initUser(username)
+
+# append one user's credentials to the credential log
+def appendCredential(username, credential):
+    record = dict(credential, username=username)
+    with open(str(credentialLog), "a") as logFile:
+        logFile.write(json.dumps(record) + "\n")
+        logFile.flush()
+        os.fsync(logFile.fileno())
+
+# write user credentials dict to the credential log, replacing the old log
+#   with one line per user
+def writeCredentials(credentials=None):
+    if credentials is None:
+        credentials = userCredentials
+    tmpLog = credentialLog.with_suffix(".tmp")
+    with open(str(tmpLog), "w") as logFile:
+        for username, credential in credentials.items():
+            logFile.write(json.dumps(dict(credential, username=username)) + "\n")
+        logFile.flush()
+        os.fsync(logFile.fileno())
+    os.replace(str(tmpLog), str(credentialLog))
+
+# store a new or changed credential: it is appended to the log right away, and
+#   the log is compacted once it is mostly lines that were replaced later
+def saveCredential(username, credential):
+    global credentialLogLines
+    userCredentials[username] = credential
+    credentialLogLines += 1
+    credentialExecutor.submit(appendCredential, username, credential)
+    if credentialLogLines > len(userCredentials) + CREDENTIAL_LOG_SLACK:
+        credentialLogLines = len(userCredentials)
+        credentialExecutor.submit(writeCredentials, dict(userCredentials))
+
+# run a password hashing function on the hashing threads and wait for its result
+async def runHash(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(hashExecutor, func, *args)
+
+# checks a user's password off the event loop, rehashing it if it was
+#   hashed with an older iteration count
+async def checkPassword(username, password):
+    credential = userCredentials[username]
+    if not await runHash(verifyPassword, password, credential):
+        return False
+    if credential["iterations"] != HASH_ITERATIONS:
+        saveCredential(username, await runHash(hashPassword, password))
+    return True
+
+# open the mailbox database, creating its table the first time
+def openMailbox():
+    global mailbox
+    mailbox = sqlite3.connect(str(mailboxFile), check_same_thread=False)
+    mailbox.execute("PRAGMA journal_mode=WAL")
+    mailbox.execute("PRAGMA synchronous=NORMAL")
+    mailbox.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, recipient TEXT, sent REAL, sender TEXT, message TEXT)")
+    mailbox.execute("CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id)")
+    mailbox.commit()
+
+# store a message for an offline user, dropping their oldest messages once
+#   they have more than MAILBOX_LIMIT waiting. messages are stored unencoded
+#   since it isn't known yet which protocol version the user will log in with
+def storeMail(recipient, sender, message):
+    with mailbox:
+        mailbox.execute("INSERT INTO messages (recipient, sent, sender, message) VALUES (?, ?, ?, ?)",
+            (recipient, time.time(), sender, message))
+        mailbox.execute("DELETE FROM messages WHERE recipient = ? AND id NOT IN "
+            "(SELECT id FROM messages WHERE recipient = ? ORDER BY id DESC LIMIT ?)",
+            (recipient, recipient, MAILBOX_LIMIT))
+
+# remove and return every unexpired message waiting for a user, oldest first,
+#   as (sender, message) tuples
+def takeMail(recipient):
+    with mailbox:
+        mailbox.execute("DELETE FROM messages WHERE recipient = ? AND sent < ?", (recipient, time.time() - MAILBOX_TTL))
+        rows = mailbox.execute("SELECT sender, message FROM messages WHERE recipient = ? ORDER BY id", (recipient,)).fetchall()
+        mailbox.execute("DELETE FROM messages WHERE recipient = ?", (recipient,))
+    return rows
+
+# drop expired messages for every user
+def expireMail():
+    with mailbox:
+        mailbox.execute("DELETE FROM messages WHERE sent < ?", (time.time() - MAILBOX_TTL,))
+
+# run a mailbox function on the mailbox thread and wait for its result
+async def runMailbox(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(mailboxExecutor, func, *args)
+
+# raise the open file limit as far as we are allowed to, since every
+#   connected user holds one or two sockets
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Fully fetches a message of `msgLength' bytes from the stream `reader'
+async def getFullMsg(reader, msgLength):
+    try:
+        msg = await reader.readexactly(msgLength)
+    except asyncio.IncompleteReadError as e:
+        msg = e.partial # the client hung up part way through the message
+    return msg.decode()
+
+# gets a message from the stream 'reader' until a newline is read.
+#   only this client's coroutine waits for the line, every other client
+#   keeps being served. returns None if the client disconnected.
+async def getLine(reader):
+    line = await reader.readline()
+    if not line.endswith(b'\n'):
+        return None
+    return line[:-1].decode()
+
+# gets a v2 frame from the stream 'reader'. returns (type, flags, body),
+#   or None if the client disconnected.
+async def getFrame(reader):
+    try:
+        header = await reader.readexactly(protocol.HEADER_SIZE)
+        frameType, flags, length = protocol.HEADER.unpack(header)
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return frameType, flags, body
+
+# gets a list of all users that are currently connected to the server
+def getOnlineUsers():
+    return list(userMessageBuffers)
+
+# marks a user as online or offline. A message queue only exists while the
+#   user is online, offline users' messages go to the mailbox instead
+def setOnline(username, online, version=1):
+    userIsOnline[username] = online
+    if online:
+        userMessageBuffers[username] = asyncio.Queue(MESSAGE_QUEUE_LIMIT) # init the messages queue
+        userVersions[username] = version
+    else:
+        userMessageBuffers.pop(username, None)
+        userVersions.pop(username, None)
+
+# encodes a message the way it is pushed to a client. v1 sends a header line
+#   with the length of the message and its sender, followed by the message
+#   itself, v2 sends a single MESSAGE frame
+def encodeMessage(sender, message, version=1):
+    if version == 2:
+        return protocol.encodeFrame(protocol.MESSAGE, protocol.packNamed(sender, message))
+    body = message.encode()
+    return (str(len(body)) + ":" + sender + "\n").encode() + body
+
+# queues a (frame, mail) pair in an online user's buffer. A full buffer means
+#   their client stopped reading, so the oldest message makes room
+def queueMessage(username, buffer, frame, mail=None):
+    if buffer.full():
+        dropped = buffer.get_nowait()[1]
+        if dropped is not None:
+            mailboxExecutor.submit(storeMail, username, *dropped)
+    buffer.put_nowait((frame, mail))
+
+# initialize auth failure data structures for an ip address
+def initAuthDetect(ip):
+    auth_failures[ip] = 0
+    reauth_cooldown[ip] = 0
+
+# initialize all basic data structures for user data
+# this method is called when the server starts.
+def initUser(username):
+    userIsOnline[username] = False # by default, all users are offline
+
+# given a message and a username, send a message to every other
+#   user that is connected to the server
+def broadcastMessage(message, curr_user, server=False):
+    # when a message is stored, it is saved with the sender in its header
+    #    if the server flag is set by the function caller, the sender
+    #    is set to the server itself
+    # the message is encoded once per protocol version and every recipient
+    #    shares the same bytes
+    if server:
+        sender = "SERVER"
+    else:
+        sender = curr_user
+    frames = {}
+
+    # iterate through each online user, offline users never see broadcasts
+    # the recipient's delivery task is woken up by the put and sends it right away
+    for uname, buffer in userMessageBuffers.items():
+        # don't send message to yourself
+        if uname == curr_user:
+            continue
+        version = userVersions[uname]
+        frame = frames.get(version)
+        if frame is None:
+            frame = frames[version] = encodeMessage(sender, message, version)
+        queueMessage(uname, buffer, frame)
+
+# given a message, a recipient, and a sender, send one user a message
+def unicastMessage(message, receiver, sender):
+    # use minecraft syntax for direct message and denote the sender
+    unicastMessage = "UNICAST: " + sender + " whispers to you: " + message
+
+    # send the messge to the recipient, or keep it in their mailbox until they log in
+    if receiver in userMessageBuffers:
+        frame = encodeMessage("Server", unicastMessage, userVersions[receiver])
+        queueMessage(receiver, userMessageBuffers[receiver], frame, ("Server", unicastMessage))
+    else:
+        mailboxExecutor.submit(storeMail, receiver, "Server", unicastMessage)
+
+# Process a given message from bvClient and respond appropriately.
+# returns True when the client asked to close the connection
+async def handleCommand(msg, reader, writer, curr_user):
+    if msg == "CLOSE":
+        return True
+    # send the MOTD
+    elif msg.startswith("MOTD"):
+        sendSize = str(len(MOTD)) + "\n"
+        writer.write(sendSize.encode() + MOTD.encode()) # header and body go out together
+    # the client is sending a direct message
+    elif msg.startswith("MSG_TELL:"):
+        length = int(msg[9:]) # length of the incoming message
+        msg = await getFullMsg(reader, length) # get the full message
+        colon = msg.find(":") # index of the colon that splits the username length from teh length of the message
+        username_len = int(msg[:colon])
+        receiver = msg[colon+1:colon+1+username_len] # the username of the message recipient
+        msg_slice = msg[colon+1+username_len:] # the actual message
+
+        # if the user doesn't exist, tell the user
+        if not receiver in userIsOnline:
+            writer.write(b"ERR_NOUSER\n")
+        else:
+            writer.write(b"ACK\n")
+            # send the message
+            unicastMessage(msg_slice, receiver, curr_user)
+
+    # the client is sending a message to all online users
+    elif msg.startswith("MSG_BROADCAST:"):
+        length = int(msg[14:]) # length of the message in the header
+        msg = await getFullMsg(reader, length) # get the full message
+        broadcastMessage(msg, curr_user) # broadcast it
+
+    # the client is requesting a list of all online users
+    elif msg.startswith("QUERY_ONLINE_USERS"):
+        users_str = ", ".join(getOnlineUsers()) # make a comma-delimited string of users
+        header = "USERS:"+ str(len(users_str)) + "\n" # get the length of user string
+        writer.write(header.encode() + users_str.encode()) # SEND IT
+
+    # send an emote message
+    elif msg.startswith("/me: "):
+        colon = msg.find(":", 5, -1) # find the colon seperating the username and length of the message
+        msg_len = int(msg[5:colon])
+        emote_txt = await getFullMsg(reader, msg_len) # get the full message
+        username = msg[colon+1:]
+        broadcastMessage(emote_txt, username) # send the message
+
+    await writer.drain()
+    return False
+
+# Process a v2 frame from bvClient and respond appropriately.
+# returns True when the client asked to close the connection
+async def handleFrame(frameType, body, writer, curr_user):
+    if frameType == protocol.CLOSE:
+        return True
+    # send the MOTD
+    elif frameType == protocol.MOTD:
+        writer.write(protocol.encodeFrame(protocol.MOTD_TEXT, MOTD.encode()))
+    # the client is sending a direct message
+    elif frameType == protocol.TELL:
+        receiver, msg_slice = protocol.unpackNamed(body)
+
+        # if the user doesn't exist, tell the user
+        if not receiver in userIsOnline:
+            writer.write(protocol.encodeFrame(protocol.ERR_NOUSER))
+        else:
+            writer.write(protocol.encodeFrame(protocol.ACK))
+            unicastMessage(msg_slice, receiver, curr_user)
+    # the client is sending a message or an emote to all online users
+    elif frameType in (protocol.BROADCAST, protocol.EMOTE):
+        broadcastMessage(body.decode(), curr_user)
+    # the client is requesting a list of all online users
+    elif frameType == protocol.WHO:
+        users_str = ", ".join(getOnlineUsers())
+        writer.write(protocol.encodeFrame(protocol.USERS, users_str.encode()))
+
+    await writer.drain()
+    return False
+
+# given a username, get messages from their mailbox from when they were offline
+#   all of them are sent to the client with a single write
+async def getOfflineMessages(username, cmWriter, version):
+    notificationMSG = "You have new direct messages: "
+    mail = await runMailbox(takeMail, username) # get every message waiting in the mailbox
+    if len(mail) > 0:
+        # encode the length of the notification message and denote it as from the server
+        frames = [encodeMessage("Server", notificationMSG, version)]
+        for sender, msg in mail:
+            frames.append(encodeMessage(sender, msg, version))
+        cmWriter.writelines(frames) # S E N D   I T
+
+# task that pushes messages to a user over their async socket as soon as
+#   they are put in the user's message buffer
+async def deliverMessages(username, cmWriter):
+    buffer = userMessageBuffers[username]
+    while True:
+        frames = [(await buffer.get())[0]] # sleep until there is a message
+
+        # a burst of messages is sent with a single write
+        while not buffer.empty():
+            frames.append(buffer.get_nowait()[0])
+        cmWriter.writelines(frames) # send data via async socket:
+        await cmWriter.drain()
+
+# open the socket the server pushes asynchronous messages to. The client starts
+#   listening on that port right after it authenticates, so retry a few times
+#   instead of giving up on the first refused connection.
+async def connectToClient(clientIP, msgSendPort):
+    for attempt in range(CALLBACK_RETRIES):
+        try:
+            return await asyncio.open_connection(clientIP, msgSendPort)
+        except ConnectionRefusedError:
+            await asyncio.sleep(CALLBACK_RETRY_DELAY)
+    return None
+
+# handle all the stuff that needs to happen before closing here. The others
+#   only hear that the user left if they were told it `joined'
+async def cleanup(username, joined, deliverTask, *writers):
+    # announce that elvis has left the building
+    if username is not None:
+        buffer = userMessageBuffers.get(username)
+        setOnline(username, False) # set online status to false
+        # direct messages that were never sent wait in the mailbox instead.
+        #   the sender was told they arrived
+        while buffer is not None and not buffer.empty():
+            frame, mail = buffer.get_nowait()
+            if mail is not None:
+                mailboxExecutor.submit(storeMail, username, *mail)
+        if joined:
+            broadcastMessage(username + " has left the chat room.", username, True)
+    if deliverTask is not None:
+        deliverTask.cancel()
+
+    # close every socket the client was using
+    for writer in writers:
+        writer.close()
+    for writer in writers:
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+# task that drops expired direct messages from the mailbox
+async def mailboxCleaner():
+    while True:
+        await asyncio.sleep(MAILBOX_CLEAN_INTERVAL)
+        await runMailbox(expireMail)
+
+# task for handling authentication failures
+async def authTimeoutManager():
+    while True:
+        await asyncio.sleep(TIMEOUT_CHECKER_TIMEOUT) # wait 30 seconds
+        for ip in auth_failures:
+            if auth_failures[ip] > 0: # reset login attempts
+                auth_failures[ip] = 0
+            if reauth_cooldown[ip] > 0: # decrement timer for account lockout
+                reauth_cooldown[ip] -= 1
+
+# coroutine for handling each new connection
+async def handleClient(clientReader, clientWriter):
+    # new connection objects
+    clientIP = clientWriter.get_extra_info("peername")[0]
+    print(f"New connection from {clientIP}!")
+
+    try:
+        await serveClient(clientIP, clientReader, clientWriter)
+    # if a client suddenly disconnects, gracefully exit
+    except (ConnectionError, OSError):
+        pass
+
+# authenticates a client and then processes its commands until it leaves
+async def serveClient(clientIP, clientReader, clientWriter):
+    auth = False # boolean for when the user successfully authenticates
+    version = 1 # protocol version the client and server agreed on
+    duplex = False # True if messages are pushed over the control connection
+    username = None
+    joined = False # True once the others were told the user joined
+    cmWriter = None
+    deliverTask = None
+
+    try:
+        # get initialization message from client
+        init = await getLine(clientReader)
+        if init is None:
+            return
+
+        # check to see if the client should be locked out
+        if reauth_cooldown.get(clientIP, 0) > 0:
+            # tell the client they are locked out and exit
+            clientWriter.write(b"ERR_AUTH_LOCKOUT\n")
+            await clientWriter.drain()
+            return
+        # else, send an acknowledgement. A client that offers v2 framing in
+        #   its init message gets it, older clients keep using v1
+        elif protocol.VERSION in init.split()[1:]:
+            version = 2
+            if ALLOW_DUPLEX and protocol.DUPLEX in init.split()[1:]:
+                duplex = True
+                clientWriter.write(("ACK " + protocol.VERSION + " " + protocol.DUPLEX + "\n").encode())
+            else:
+                clientWriter.write(("ACK " + protocol.VERSION + "\n").encode())
+        else:
+            clientWriter.write(b"ACK\n")
+
+        # get the client's username, password, and a port to send async messages to
+        #   (a duplex client still sends a port, but it isn't used)
+        username = await getLine(clientReader)
+        password = await getLine(clientReader)
+        msgSendPort = await getLine(clientReader)
+        if msgSendPort is None:
+            username = None
+            return
+
+        # if connecting from a new IP, log it
+        if clientIP not in auth_failures:
+            initAuthDetect(clientIP)
+
+        # authenticate user
+        if username in userCredentials:
+            if await checkPassword(username, password): # do the passwords match?
+                if userIsOnline[username] == True: # is the user already connected?
+                    clientWriter.write(b"ERR_CONCURRENT_CONNECTION\n") # no concurrent clients
+                else:
+                    # tell the client authentication was successful
+                    clientWriter.write(b"AUTH_GOOD\n")
+                    auth = True # auth true
+            # auth failure
+            else:
+                auth_failures[clientIP] += 1 # log an authentication failure
+
+                # check to see if the user failed to auth 3 times in 30 seconds
+                if auth_failures[clientIP] >= 3:
+                    reauth_cooldown[clientIP] = CLIENT_AUTH_TIMEOUT # lock them out if so
+                    auth_failures[clientIP] = 0 # reset auth failures
+                    clientWriter.write(b"AUTH_LOCKOUT\n") # let the user know
+                else:
+                    clientWriter.write(b"AUTH_FAIL\n") # tell the client about failed auth
+        else:
+            # first time connection
+            credential = await runHash(hashPassword, password) # hash the password
+            if username in userCredentials:
+                # somebody else registered the name while the password was hashed
+                clientWriter.write(b"AUTH_FAIL\n")
+            else:
+                saveCredential(username, credential) # save password
+                clientWriter.write(b"AUTH_GOOD\n")
+                initUser(username) # initialize data structures
+                auth = True
+
+        if not auth:
+            await clientWriter.drain()
+            username = None # don't announce a user that never logged in
+            return
+
+        # mark the user online before waiting on anything, so a second login
+        #   for the same user can't slip in
+        setOnline(username, True, version) # change online status
+        await clientWriter.drain()
+
+        # initialize socket to send asynchronous messages to. In duplex mode
+        #   messages go out over the control connection
+        if duplex:
+            pushWriter = clientWriter
+        else:
+            cmConn = await connectToClient(clientIP, int(msgSendPort))
+            if cmConn is None:
+                print(f"Could not connect back to {clientIP}:{msgSendPort}")
+                return
+            cmWriter = pushWriter = cmConn[1]
+
+        # tell all online users about our presence
+        broadcastMessage(username + " has joined the chat room!", username, True)
+        joined = True
+
+        # get offline direct messages
+        await getOfflineMessages(username, pushWriter, version)
+        await pushWriter.drain()
+
+        # messages are pushed to the client by their own task, so this one only
+        #   has to wait for control messages. Every frame is written in one
+        #   piece, so in duplex mode pushed frames never split a reply.
+        deliverTask = asyncio.create_task(deliverMessages(username, pushWriter))
+        # a push socket that died takes the session with it: closing the
+        #   control connection ends the loop below, so the user goes offline
+        deliverTask.add_done_callback(lambda task: clientWriter.close())
+
+        while version == 1:
+            msg = await getLine(clientReader) # wait for control messages from client
+            if msg is None:
+                break
+            if await handleCommand(msg, clientReader, clientWriter, username): # process the message
+                break
+
+        while version == 2:
+            frame = await getFrame(clientReader) # wait for control frames from client
+            if frame is None:
+                break
+            if await handleFrame(frame[0], frame[2], clientWriter, username): # process the frame
+                break
+    finally:
+        if cmWriter is not None:
+            await cleanup(username, joined, deliverTask, clientWriter, cmWriter)
+        else:
+            await cleanup(username, joined, deliverTask, clientWriter)
+
+# program start
+async def main():
+    raiseFileLimit()
+    loadCredentials()
+    await runMailbox(openMailbox)
+
+    # init a listener for clients to connect to
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    server = await asyncio.start_server(handleClient, sock=listener, backlog=LISTEN_BACKLOG)
+
+    # initialize the authentication checker timeout
+    asyncio.create_task(authTimeoutManager())
+    asyncio.create_task(mailboxCleaner())
+
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    # if an exception occurs, exit gracefully
+    except KeyboardInterrupt:
+        print("Shutting down...")
+        credentialExecutor.shutdown() # finish writing new users to the log
+        writeCredentials() # compact the credential log
@@ -0,0 +1,198 @@
+from socket import *
+from bvBufferedReader import BufferedReader
+import bvChatProtocol as protocol
+
+# seconds to wait for the server to connect back to a client that didn't
+#   get duplex mode
+ACCEPT_TIMEOUT = 10
+
+# A connection to a bvChat server without any user interface, used by
+#   bvChat-client.py and by scripts that drive the server, like the load
+#   generator in bvChat-bench.py. It speaks v2 framing when the server does
+#   and v1 otherwise, and asks for duplex mode unless `duplex' is False.
+#
+# Pushed messages are handed to the onMessage callback as (sender, text).
+#   They are read by poll(), which never blocks, and by the commands that
+#   wait for a reply, which in duplex mode can find messages ahead of it.
+#   Wait for messageSocket to be readable, with a selector, to know when to
+#   call poll(). A ChatClient isn't thread safe.
+class ChatClient:
+    def __init__(self, ip, port, onMessage=None, duplex=True):
+        self.ip = ip
+        self.port = port
+        self.onMessage = onMessage
+        self.offerDuplex = duplex
+        self.version = 1 # 2 once the server agreed to v2 framing
+        self.duplex = False # True if the server pushes messages over conn
+        self.username = None
+        self.conn = None
+        self.reader = None
+        self.messageSocket = None # where pushed messages arrive, once logged in
+        self.messageReader = None
+
+    # calls `onMessage' with (sender, text) for every pushed message from now on
+    def subscribe(self, onMessage):
+        self.onMessage = onMessage
+
+    # connects to the server and offers v2 framing. returns the server's
+    #   answer, which starts with "ACK" unless it is "ERR_AUTH_LOCKOUT"
+    def connect(self):
+        self.conn = socket(AF_INET, SOCK_STREAM)
+        self.conn.connect((self.ip, self.port))
+        self.reader = BufferedReader(self.conn)
+        if self.offerDuplex:
+            self.conn.sendall(("init " + protocol.VERSION + " " + protocol.DUPLEX + "\n").encode())
+        else:
+            self.conn.sendall(("init " + protocol.VERSION + "\n").encode())
+        answer = self.readLine()
+        if answer == "ACK " + protocol.VERSION:
+            self.version = 2
+        elif answer == "ACK " + protocol.VERSION + " " + protocol.DUPLEX:
+            self.version = 2
+            self.duplex = True
+        return answer
+
+    # logs in, registering `username' if the server doesn't know it yet.
+    #   returns the server's status: "AUTH_GOOD", "AUTH_FAIL", "AUTH_LOCKOUT"
+    #   or "ERR_CONCURRENT_CONNECTION". Without duplex mode this waits for
+    #   the server to connect back, raising TimeoutError if it doesn't
+    def login(self, username, password):
+        listener = None
+        if not self.duplex:
+            listener = socket(AF_INET, SOCK_STREAM)
+            listener.bind(("", 0)) # let OS choose port
+            listener.listen(1)
+            listener.settimeout(ACCEPT_TIMEOUT)
+        try:
+            messagePort = 0 if listener is None else listener.getsockname()[1]
+            self.conn.sendall((username + "\n" + password + "\n" + str(messagePort) + "\n").encode())
+            status = self.readLine()
+            if status != "AUTH_GOOD":
+                return status
+            self.username = username
+            if listener is None:
+                self.messageSocket, self.messageReader = self.conn, self.reader
+            else:
+                self.messageSocket = listener.accept()[0]
+                self.messageSocket.settimeout(None)
+                self.messageReader = BufferedReader(self.messageSocket)
+            return status
+        finally:
+            if listener is not None:
+                listener.close()
+
+    # sends a message to every other online user
+    def broadcast(self, text):
+        if self.version == 2:
+            self.conn.sendall(protocol.encodeFrame(protocol.BROADCAST, text.encode()))
+        else:
+            header = "MSG_BROADCAST:" + str(len(text.encode())) + "\n"
+            self.conn.sendall(header.encode() + text.encode())
+
+    # sends the emote "/me `action'" to every other online user
+    def emote(self, action):
+        text = "/me " + action
+        if self.version == 2:
+            self.conn.sendall(protocol.encodeFrame(protocol.EMOTE, text.encode()))
+        else:
+            header = "/me: " + str(len(text.encode())) + ":" + self.username + "\n" # encode message length and sender
+            self.conn.sendall(header.encode() + text.encode())
+
+    # sends a direct message, kept for later if `username' is offline. returns
+    #   True if it was sent or kept, False if there is no such user and None
+    #   if the connection to the server is gone
+    def tell(self, username, text):
+        if self.version == 2:
+            self.conn.sendall(protocol.encodeFrame(protocol.TELL, protocol.packNamed(username, text)))
+            frame = self.getReply()
+            return None if frame is None else frame[0] != protocol.ERR_NOUSER
+        body = str(len(username)) + ":" + username + text
+        header = "MSG_TELL:" + str(len(body.encode())) + "\n"
+        self.conn.sendall(header.encode() + body.encode())
+        resp = self.readLine()
+        return None if resp == "" else resp != "ERR_NOUSER"
+
+    # returns the list of online users, or None if the connection to the server is gone
+    def who(self):
+        if self.version == 2:
+            self.conn.sendall(protocol.encodeFrame(protocol.WHO))
+            frame = self.getReply()
+            if frame is None:
+                return None
+            users = frame[2].decode()
+        else:
+            self.conn.sendall(b"QUERY_ONLINE_USERS\n")
+            header = self.readLine()
+            if not header.startswith("USERS:"):
+                return None
+            users = self.reader.getFullMsg(int(header[6:])).decode()
+        return users.split(", ")
+
+    # returns the message of the day, or None if the connection to the server is gone
+    def motd(self):
+        if self.version == 2:
+            self.conn.sendall(protocol.encodeFrame(protocol.MOTD))
+            frame = self.getReply()
+            return None if frame is None else frame[2].decode()
+        self.conn.sendall(b"MOTD\n")
+        size = self.readLine()
+        if not size.isdigit():
+            return None
+        return self.reader.getFullMsg(int(size)).decode()
+
+    # tells the server the client is leaving and closes the connections
+    def close(self):
+        try:
+            if self.version == 2:
+                self.conn.sendall(protocol.encodeFrame(protocol.CLOSE))
+            else:
+                self.conn.sendall(b"CLOSE\n")
+        except OSError:
+            pass # the server is gone already
+        self.conn.close()
+        if self.messageSocket is not None and self.messageSocket is not self.conn:
+            self.messageSocket.close()
+
+    # hands every message the server pushed so far to onMessage, without
+    #   waiting for more. returns False once the server closed the connection
+    def poll(self):
+        reader = self.messageReader
+        if self.version == 2:
+            frame = protocol.readFrameAsync(reader)
+            while frame is not None:
+                if frame[0] == protocol.MESSAGE:
+                    self.pushed(*protocol.unpackNamed(frame[2]))
+                frame = protocol.readFrameAsync(reader)
+        else:
+            header = reader.getLineAsync()
+            while header:
+                colon = header.find(":") # find the colon
+                length = int(header[:colon]) # get the length of the message from the header
+                sender = header[colon+1:] # get the sender of the message
+                self.pushed(sender, reader.getFullMsg(length).decode())
+                header = reader.getLineAsync()
+        return not reader.eof
+
+    def pushed(self, sender, text):
+        if self.onMessage is not None:
+            self.onMessage(sender, text)
+
+    # gets the server's v2 reply to the command that was just sent, or None if
+    #   the connection to the server is gone
+    def getReply(self):
+        frame = protocol.readFrame(self.reader)
+        # in duplex mode messages can come in ahead of the reply
+        while frame is not None and frame[0] == protocol.MESSAGE:
+            self.pushed(*protocol.unpackNamed(frame[2]))
+            frame = protocol.readFrame(self.reader)
+        # and the ones read along with it are buffered already
+        if frame is not None and self.duplex:
+            self.poll()
+        return frame
+
+    # reads one line of the handshake or a v1 reply, "" if the connection closed
+    def readLine(self):
+        try:
+            return self.reader.getLine()
+        except TimeoutError:
+            return ""
@@ -0,0 +1,88 @@
+import struct
+
+# bvChat protocol v2 framing, shared by bvChat-server.py and bvChat-client.py
+#
+# v1 sends a text header line like "MSG_TELL:12\n" and then the body, which
+#   takes two sends and a newline scan per message. A v2 frame is a fixed
+#   6 byte header followed by the body, sent together with a single send:
+#
+#   +------+-------+----------------+----------------
+#   | type | flags | length         | body ...
+#   +------+-------+----------------+----------------
+#     1 B    1 B     4 B, big endian  `length' bytes
+#
+# v2 is negotiated during the handshake. The client sends "init v2" instead of
+#   "init" and the server answers "ACK v2" if it speaks v2. A v1 server ignores
+#   the extra word and answers "ACK", and a v1 client sends a plain "init", so
+#   either side falls back to v1. The rest of the handshake (username,
+#   password, message port and the AUTH_* reply) stays line based, and both
+#   connections switch to frames right after AUTH_GOOD.
+#
+# A v2 client can also offer duplex mode with "init v2 duplex". If the server
+#   answers "ACK v2 duplex" it doesn't connect back to the client's message
+#   port. Pushed MESSAGE frames are sent over the control connection instead,
+#   mixed in with the replies to the client's commands, and the client tells
+#   them apart by frame type.
+
+VERSION = "v2"
+DUPLEX = "duplex"
+
+HEADER = struct.Struct("!BBI")
+HEADER_SIZE = HEADER.size
+
+# length prefix in front of a username inside a frame body
+NAME_LENGTH = struct.Struct("!H")
+
+# frames sent by the client
+BROADCAST = 1 # body: the message
+TELL = 2 # body: packed recipient and message
+EMOTE = 3 # body: the emote text, starting with "/me "
+WHO = 4 # empty body
+MOTD = 5 # empty body
+CLOSE = 6 # empty body
+
+# frames sent by the server
+# every type except MESSAGE is a reply to the client's last command
+MESSAGE = 16 # a pushed message, body: packed sender and message
+ACK = 17 # the TELL was delivered or stored
+ERR_NOUSER = 18 # the TELL's recipient doesn't exist
+USERS = 19 # body: comma delimited list of online users
+MOTD_TEXT = 20 # body: the message of the day
+
+# builds a complete frame, header and body in one bytes object
+def encodeFrame(frameType, body=b'', flags=0):
+    return HEADER.pack(frameType, flags, len(body)) + body
+
+# packs a username and a message into a frame body
+def packNamed(name, text):
+    name = name.encode()
+    return NAME_LENGTH.pack(len(name)) + name + text.encode()
+
+# unpacks a frame body built by packNamed, returns (name, text)
+def unpackNamed(body):
+    nameLength = NAME_LENGTH.unpack_from(body)[0]
+    nameEnd = NAME_LENGTH.size + nameLength
+    return bytes(body[NAME_LENGTH.size:nameEnd]).decode(), bytes(body[nameEnd:]).decode()
+
+# reads one frame from a BufferedReader, blocking until all of it arrived.
+#   returns (type, flags, body), or None if the connection closed
+def readFrame(reader):
+    header = reader.getFullMsg(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return None
+    frameType, flags, length = HEADER.unpack(header)
+    body = reader.getFullMsg(length)
+    if len(body) < length:
+        return None
+    return frameType, flags, body
+
+# reads one frame from a BufferedReader without blocking. returns None if the
+#   whole frame hasn't arrived yet, what did arrive stays buffered
+def readFrameAsync(reader):
+    if not reader.bufferedAsync(HEADER_SIZE):
+        return None
+    frameType, flags, length = HEADER.unpack(reader.peek(HEADER_SIZE))
+    if not reader.bufferedAsync(HEADER_SIZE + length):
+        return None
+    reader.consume(HEADER_SIZE)
+    return frameType, flags, reader.getFullMsg(length)
@@ -0,0 +1,79 @@
+import unicodedata
+from collections import deque
+
+# lines of history kept for redrawing the message window
+HISTORY_LINES = 1000
+
+# the number of terminal columns character `ch' takes up
+def charWidth(ch):
+    if unicodedata.combining(ch):
+        return 0
+    return 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+
+# splits `text' into lines that fit in `columns' terminal columns, breaking
+#   at the newlines in it and wherever a line runs out of room. Wide
+#   characters count as 2 columns and combining ones as none
+def wrapText(text, columns):
+    lines = []
+    for paragraph in text.split("\n"):
+        if paragraph.isascii():
+            lines.extend(paragraph[start:start + columns] for start in range(0, len(paragraph), columns))
+            if not paragraph:
+                lines.append("")
+            continue
+        line = ""
+        used = 0
+        for ch in paragraph:
+            chWidth = charWidth(ch)
+            if used + chWidth > columns:
+                lines.append(line)
+                line = ""
+                used = 0
+            line += ch
+            used += chWidth
+        lines.append(line)
+    return lines
+
+# The message area of the chat screen. New messages are wrapped once and
+#   drawn at the bottom of the window, which scrolls the lines already on
+#   screen up instead of drawing them again. The last HISTORY_LINES lines are
+#   kept, wrapped, to redraw the window from when the terminal is resized.
+#
+# The window should be one column wider than `columns', so a full line never
+#   reaches the last column and makes curses wrap or scroll on its own.
+class MessageView:
+    def __init__(self, window, columns, historyLines=HISTORY_LINES):
+        self.window = window
+        self.columns = columns
+        self.history = deque(maxlen=historyLines) # (line, attribute)
+        window.scrollok(True)
+        window.leaveok(True) # leave the cursor on the input line
+
+    # draws `messages', a list of (text, attribute, keep) in the order they
+    #   arrived. Messages with keep False are shown but not kept in the
+    #   history. Only the end of a burst bigger than the window is drawn.
+    #   Marks the window for the next curses.doupdate()
+    def draw(self, messages):
+        lines = []
+        for text, attribute, keep in messages:
+            wrapped = [(line, attribute) for line in wrapText(text, self.columns)]
+            if keep:
+                self.history.extend(wrapped)
+            lines.extend(wrapped)
+        rows = self.window.getmaxyx()[0]
+        lines = lines[-rows:]
+        if not lines:
+            return
+        self.window.scroll(len(lines))
+        for row, (line, attribute) in enumerate(lines, rows - len(lines)):
+            self.window.addstr(row, 0, line, attribute)
+        self.window.noutrefresh()
+
+    # draws the whole window again from the history
+    def redraw(self):
+        rows = self.window.getmaxyx()[0]
+        self.window.erase()
+        lines = list(self.history)[-rows:]
+        for row, (line, attribute) in enumerate(lines, rows - len(lines)):
+            self.window.addstr(row, 0, line, attribute)
+        self.window.noutrefresh()
@@ -0,0 +1,54 @@
+import random
+from bvBitfield import Bitfield
+
+# number of missing chunks left when the picker switches to endgame mode
+ENDGAME_CHUNKS = 8
+
+# most peers a chunk is requested from at once in endgame mode
+ENDGAME_DUPLICATES = 3
+
+# Chooses which chunks bvTorrent-client.py downloads first. It keeps a count
+#   of how many peers have each chunk, updated from the peers' masks every
+#   time the client list is refreshed, and hands out missing chunks rarest
+#   first so chunks only a few peers have are fetched before those peers leave.
+#   Chunks equally rare are handed out in random order so downloaders don't
+#   all ask for the same chunk.
+class PiecePicker:
+    def __init__(self, chunkNum):
+        self.chunkNum = chunkNum
+        self.availability = [0] * chunkNum # number of peers that have each chunk
+        self.peerMasks = {} # peer -> copy of the Bitfield its counts were taken from
+        self.missing = set(range(chunkNum)) # chunks we don't have yet
+
+    # updates the counts from a fresh client list, given as a dict of
+    #   peer -> Bitfield. Only peers that joined, left or changed their mask
+    #   are looked at, and a changed mask only updates the chunks that changed
+    def updatePeers(self, peerMasks):
+        for peer in list(self.peerMasks):
+            if peer not in peerMasks:
+                for i in self.peerMasks.pop(peer).difference(Bitfield(self.chunkNum)):
+                    self.availability[i] -= 1
+        for peer, clientMask in peerMasks.items():
+            oldMask = self.peerMasks.get(peer, Bitfield(self.chunkNum))
+            if oldMask == clientMask:
+                continue
+            for i in oldMask.difference(clientMask, symmetric=True):
+                self.availability[i] += 1 if clientMask[i] else -1
+            self.peerMasks[peer] = clientMask.copy()
+
+    # marks a chunk as downloaded
+    def markHave(self, index):
+        self.missing.discard(index)
+
+    # returns the missing chunks that at least one peer has, rarest first,
+    #   with ties in random order
+    def pickOrder(self):
+        available = [i for i in self.missing if self.availability[i] > 0]
+        random.shuffle(available)
+        available.sort(key=self.availability.__getitem__)
+        return available
+
+    # True once so few chunks are missing that they should be requested from
+    #   several peers at once, so one slow peer can't hold up the end of the download
+    def inEndgame(self):
+        return len(self.missing) <= ENDGAME_CHUNKS
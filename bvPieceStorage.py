@@ -0,0 +1,109 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import mmap
+import os
+
+# Keeps the chunks bvTorrent-client.py downloads in the file itself instead of
+#   in memory. The file is created at its full size up front and memory
+#   mapped, every chunk is written straight to its place at
+#   index * chunkSize, and chunks are served to other peers from the file
+#   with sendfile, so they never pass through Python at all. Only the chunks
+#   that are still being downloaded are held in memory.
+# The chunk mask is saved next to the file as it grows, so a restarted client
+#   can pick up where it left off. The chunks it claims are hashed again
+#   first, since the file could have been changed or cut short in between.
+class PieceStorage:
+    def __init__(self, fileName, chunkSize, chunkSizes):
+        self.fileName = fileName
+        self.maskFile = fileName + ".mask"
+        self.chunkSize = chunkSize
+        self.chunkSizes = chunkSizes
+        self.have = [False] * len(chunkSizes) # chunks written and safe to serve
+        self.existed = os.path.exists(fileName) # a partial file from an earlier run
+        self.file = open(os.open(fileName, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        self.file.truncate(sum(chunkSizes))
+        self.map = mmap.mmap(self.file.fileno(), 0) if chunkSizes else None
+
+    def offset(self, index):
+        return index * self.chunkSize
+
+    # writes a verified chunk into its place in the file
+    def write(self, index, chunk):
+        start = self.offset(index)
+        self.map[start:start + len(chunk)] = chunk
+        self.have[index] = True
+
+    # hashes a downloaded chunk and writes it to the file if it matches the
+    #   sha224 `digest'. Runs on the client's verification threads; hashlib
+    #   lets go of the GIL while it hashes a large buffer, so chunks are
+    #   checked in parallel with each other and with the downloads.
+    #   returns True if the chunk was good
+    def verifyAndWrite(self, index, chunk, digest):
+        if len(chunk) != self.chunkSizes[index] or hashlib.sha224(chunk).digest() != digest:
+            return False
+        self.write(index, chunk)
+        return True
+
+    # sends a chunk to a peer straight from the file, or `length' bytes of
+    #   it starting `start' bytes in
+    def sendChunk(self, conn, index, start=0, length=None):
+        if length is None:
+            length = self.chunkSizes[index] - start
+        conn.sendfile(self.file, self.offset(index) + start, length)
+
+    # returns the saved chunk mask, without the newline. If there is none but
+    #   the file was already there, every chunk is worth checking
+    def loadMask(self):
+        try:
+            with open(self.maskFile) as f:
+                mask = f.read().strip()
+            if len(mask) == len(self.chunkSizes):
+                return mask
+        except OSError:
+            pass
+        return ("1" if self.existed else "0") * len(self.chunkSizes)
+
+    # saves the chunk mask, replacing the old one in a single rename so a
+    #   crash never leaves half a mask behind
+    def saveMask(self, mask):
+        with open(self.maskFile + ".tmp", 'w') as f:
+            f.write(mask.strip() + "\n")
+        os.replace(self.maskFile + ".tmp", self.maskFile)
+
+    # hashes the chunks in `indexes' again, split across `workers' processes
+    #   that each map the file themselves. digests are the binary sha224
+    #   digests of the chunks. returns the indexes that matched
+    def verify(self, indexes, digests, workers=None):
+        if not indexes or self.map is None:
+            return []
+        self.map.flush() # the workers read the file, not this mapping
+        workers = workers or os.cpu_count()
+        batchSize = -(-len(indexes) // (workers * 4)) # a few batches per worker so they finish together
+        batches = [[(i, self.offset(i), self.chunkSizes[i], digests[i]) for i in indexes[start:start + batchSize]]
+            for start in range(0, len(indexes), batchSize)]
+        if workers == 1:
+            results = [verifyChunks(self.fileName, batch) for batch in batches]
+        else:
+            # fork, so the workers don't run bvTorrent-client.py's top level again
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                results = list(pool.map(verifyChunks, [self.fileName] * len(batches), batches))
+        return [i for good in results for i in good]
+
+    # writes everything to disk and closes the file
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.file.close()
+
+# runs in a worker process. Hashes (index, offset, size, digest) chunks of
+#   fileName straight out of a read-only mapping, returns the indexes that match
+def verifyChunks(fileName, batch):
+    good = []
+    with open(fileName, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as fileMap:
+        with memoryview(fileMap) as view:
+            for index, offset, size, digest in batch:
+                if hashlib.sha224(view[offset:offset + size]).digest() == digest:
+                    good.append(index)
+    return good
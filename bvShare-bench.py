@@ -0,0 +1,353 @@
+from sys import argv, executable
+from socket import *
+from pathlib import Path
+from random import Random
+import gzip
+import subprocess
+import shutil
+import tempfile
+import threading
+import time
+import os
+from bvBufferedReader import BufferedReader
+from bvShareIndex import RepositoryIndex
+import bvShareProtocol as protocol
+
+# local benchmarks for bvShare_Server.py and bvShare_Client.py
+# usage: bvShare-bench.py transfer [SIZE_MB ...]
+#   downloads a file of every size over loopback with bvShare_Client.py and
+#   reports the time and throughput. The files are sparse, so multi-GB sizes
+#   don't need that much disk until the client writes its copy
+# usage: bvShare-bench.py ranges [SIZE_MB] [CONNECTIONS ...]
+#   downloads one file split into ranges over 1, 2, 4 and 8 connections
+# usage: bvShare-bench.py compress [SIZE_MB]
+#   downloads a text file, a file of random bytes and a .gz file as they are
+#   and with --compress, and reports the time, the compression ratio and the
+#   CPU it cost the client and the server. The server caches a file the
+#   second time it is asked for, so the third download comes out of its cache
+# usage: bvShare-bench.py sync [SIZE_MB]
+#   downloads a file, then downloads it again once it is here, then once more
+#   after it has been renamed, which the client copies from the renamed file
+# usage: bvShare-bench.py batch [FILES] [SIZE_KB] [CONNECTIONS ...]
+#   mirrors a repository of FILES files with one bvShare_Client.py run per
+#   file, then with one batch run over each number of connections
+# usage: bvShare-bench.py load [CLIENTS] [SIZE_MB] [WORKERS ...]
+#   has CLIENTS clients download the same file at once from servers started
+#   with each --workers count, and reports the aggregate throughput and the
+#   median and p99 time to first byte. One more client asks for the file
+#   first and then doesn't read it for a second, like a slow link would
+# usage: bvShare-bench.py listing [FILES] [CONNECTIONS]
+#   compares scanning and encoding a repository of FILES files for every
+#   connection with the cached index, then times CONNECTIONS clients that
+#   only fetch the listing from the server
+
+here = Path(__file__).parent
+serverPath = here / "bvShare_Server.py"
+clientPath = here / "bvShare_Client.py"
+
+# returns a port nothing is listening on right now
+def freePort():
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# starts bvShare_Server.py serving workDir/repository, returns the process and
+#   its port. What the server prints after starting goes to server.lines
+def startServer(workDir, serverArgs=()):
+    port = freePort()
+    server = subprocess.Popen([executable, "-u", str(serverPath), str(port)] + list(serverArgs),
+        cwd=workDir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        env=dict(os.environ, PYTHONPATH=str(here)))
+    server.stdout.readline() # "Running on ..."
+    server.lines = []
+    threading.Thread(target=lambda: server.lines.extend(server.stdout), daemon=True).start()
+    return server, port
+
+def stopServer(server):
+    server.kill()
+    server.wait()
+
+# runs bvShare_Client.py in workDir and downloads file `fileId', returns
+#   the number of seconds it took and the last line it printed
+def runClient(port, workDir, fileId, clientArgs=()):
+    start = time.perf_counter()
+    client = subprocess.run([executable, str(clientPath), "127.0.0.1", str(port), str(fileId)] + list(clientArgs),
+        cwd=workDir, stdout=subprocess.PIPE, text=True, env=dict(os.environ, PYTHONPATH=str(here)))
+    return time.perf_counter() - start, client.stdout.rstrip("\n").rpartition("\n")[2]
+
+def benchTransfer(sizes):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "server" / "repository"
+        repository.mkdir(parents=True)
+        clientDir = Path(workDir) / "client"
+        clientDir.mkdir()
+        filePath = repository / "transfer.bin"
+        filePath.touch() #listed from the start, the server sends its size when it is asked for
+        server, port = startServer(repository.parent)
+
+        print(f"{'MB':>8}{'seconds':>10}{'MB/s':>10}")
+        for sizeMB in sizes:
+            with open(filePath, 'wb') as f:
+                f.truncate(int(sizeMB * 1024 * 1024))
+            elapsed, output = runClient(port, clientDir, 1)
+            received = clientDir / "repository" / "transfer.bin"
+            if not received.exists() or received.stat().st_size != filePath.stat().st_size:
+                print(f"{sizeMB:>8g}{'failed':>10}")
+            else:
+                print(f"{sizeMB:>8g}{elapsed:>10.2f}{sizeMB / elapsed:>10.1f}")
+            received.unlink(missing_ok=True)
+        stopServer(server)
+
+def benchRanges(sizeMB, connectionCounts):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "server" / "repository"
+        repository.mkdir(parents=True)
+        clientDir = Path(workDir) / "client"
+        clientDir.mkdir()
+        filePath = repository / "ranges.bin"
+        filePath.write_bytes(os.urandom(int(sizeMB * 1024 * 1024)))
+        server, port = startServer(repository.parent)
+
+        print(f"{sizeMB:g} MB file")
+        print(f"{'connections':>12}{'seconds':>10}{'MB/s':>10}")
+        for connections in connectionCounts:
+            elapsed, output = runClient(port, clientDir, 1, [f"--connections={connections}"])
+            received = clientDir / "repository" / "ranges.bin"
+            if not received.exists() or received.read_bytes() != filePath.read_bytes():
+                print(f"{connections:>12}{'failed':>10}")
+            else:
+                print(f"{connections:>12}{elapsed:>10.2f}{sizeMB / elapsed:>10.1f}")
+            received.unlink(missing_ok=True)
+        stopServer(server)
+
+# about 100 bytes a line of something like a server log, which compresses
+#   about as well as the text in a repository does
+def textBytes(size):
+    lines = []
+    length = 0
+    words = ["GET", "POST", "/index.html", "/api/files", "200", "404", "OK", "client", "bytes"]
+    random = Random(0)
+    while length < size:
+        line = f"{random.randrange(10 ** 9):09} " + " ".join(random.choice(words) for n in range(12)) + "\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()[:size]
+
+def benchCompress(sizeMB):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "server" / "repository"
+        repository.mkdir(parents=True)
+        clientDir = Path(workDir) / "client"
+        clientDir.mkdir()
+        size = int(sizeMB * 1024 * 1024)
+        text = textBytes(size)
+        files = {
+            "a-text.log": text,
+            "b-random.bin": os.urandom(size),
+            "c-text.log.gz": gzip.compress(text, 6),
+        }
+        for name, data in files.items():
+            (repository / name).write_bytes(data)
+        server, port = startServer(repository.parent)
+
+        print(f"{sizeMB:g} MB files")
+        for fileId, (name, data) in enumerate(files.items(), 1):
+            for clientArgs in ([], ["--compress"], ["--compress"], ["--compress"]):
+                lines = len(server.lines)
+                elapsed, output = runClient(port, clientDir, fileId, clientArgs)
+                received = clientDir / "repository" / name
+                ok = received.exists() and received.read_bytes() == data
+                received.unlink(missing_ok=True)
+                time.sleep(.1) #for the server to print its line
+                mode = " ".join(clientArgs) or "as is"
+                print(f"  {name} {mode}: {'ok' if ok else 'failed'} in {elapsed:.2f} s")
+                if clientArgs and output.startswith("Received"):
+                    print(f"    client: {output}")
+                for line in server.lines[lines:]:
+                    print(f"    server: {line.rstrip()}")
+        stopServer(server)
+
+def benchSync(sizeMB):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "server" / "repository"
+        repository.mkdir(parents=True)
+        clientDir = Path(workDir) / "client"
+        clientDir.mkdir()
+        data = os.urandom(int(sizeMB * 1024 * 1024))
+        (repository / "sync.bin").write_bytes(data)
+        server, port = startServer(repository.parent)
+        while not (repository.parent / "repository.hashes").exists(): #hashed in the background
+            time.sleep(.1)
+
+        received = clientDir / "repository" / "sync.bin"
+        print(f"{sizeMB:g} MB file")
+        for step in ["first download", "already here", "renamed here"]:
+            if step == "renamed here":
+                received.rename(received.with_name("renamed.bin"))
+            elapsed, output = runClient(port, clientDir, 1)
+            ok = received.exists() and received.read_bytes() == data
+            print(f"{step:>16}{elapsed:>8.2f} s  {'ok' if ok else 'failed'}  {output}")
+        stopServer(server)
+
+def benchBatch(fileCount, sizeKB, connectionCounts):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "server" / "repository"
+        repository.mkdir(parents=True)
+        clientDir = Path(workDir) / "client"
+        clientDir.mkdir()
+        for n in range(fileCount):
+            (repository / f"file{n:05}.bin").write_bytes(os.urandom(int(sizeKB * 1024)))
+        server, port = startServer(repository.parent)
+
+        # mirrors the repository with `runs', a list of client arguments per run
+        def mirror(runs):
+            shutil.rmtree(clientDir)
+            clientDir.mkdir()
+            start = time.perf_counter()
+            for clientArgs in runs:
+                runClient(port, clientDir, clientArgs[0], clientArgs[1:])
+            elapsed = time.perf_counter() - start
+            same = all((clientDir / "repository" / path.name).exists() for path in repository.iterdir())
+            return elapsed, same
+
+        print(f"{fileCount} files of {sizeKB:g} KB")
+        print(f"{'':>20}{'seconds':>10}{'files/s':>10}")
+        elapsed, same = mirror([[n + 1] for n in range(fileCount)])
+        print(f"{'one run per file':>20}{elapsed:>10.2f}{fileCount / elapsed:>10.1f}{'' if same else '  failed'}")
+        for connections in connectionCounts:
+            elapsed, same = mirror([["*", f"--connections={connections}"]])
+            label = f"batch, {connections} conn"
+            print(f"{label:>20}{elapsed:>10.2f}{fileCount / elapsed:>10.1f}{'' if same else '  failed'}")
+        stopServer(server)
+
+# one load test client. Does what bvShare_Client.py does but throws the file
+#   away, and appends (seconds to the first byte of the file, bytes received)
+#   to results. A client with `stall' set waits that long before reading the file
+def loadClient(port, fileId, results, stall=0):
+    start = time.perf_counter()
+    try:
+        with create_connection(('127.0.0.1', port)) as conn:
+            reader = BufferedReader(conn)
+            protocol.readListing(reader)
+            conn.sendall(protocol.encodeRequest(fileId))
+            status, size = protocol.readResponse(reader)
+            time.sleep(stall)
+            buffer = memoryview(bytearray(1024 * 1024))
+            received = reader.readInto(buffer[:min(len(buffer), size)])
+            firstByte = time.perf_counter() - start
+            while received < size:
+                count = reader.readInto(buffer[:min(len(buffer), size - received)])
+                if count == 0:
+                    break
+                received += count
+    except (OSError, TypeError):
+        return
+    results.append((firstByte, received))
+
+# the p-th percentile of a sorted list
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def benchLoad(clientCount, sizeMB, workerCounts):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "repository"
+        repository.mkdir()
+        (repository / "load.bin").write_bytes(os.urandom(int(sizeMB * 1024 * 1024)))
+
+        print(f"{clientCount} clients and 1 stalled client, {sizeMB:g} MB file")
+        print(f"{'workers':>8}{'done':>6}{'seconds':>10}{'MB/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for workerCount in workerCounts:
+            server, port = startServer(workDir, [f"--workers={workerCount}"])
+            stalled = threading.Thread(target=loadClient, args=(port, 1, [], 1))
+            stalled.start()
+            time.sleep(.1) #let it take a worker first
+            results = []
+            clients = [threading.Thread(target=loadClient, args=(port, 1, results)) for n in range(clientCount)]
+            start = time.perf_counter()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+            stalled.join()
+            stopServer(server)
+
+            firstBytes = sorted(firstByte for firstByte, received in results)
+            total = sum(received for firstByte, received in results) / 1024 / 1024
+            done = sum(1 for firstByte, received in results if received == int(sizeMB * 1024 * 1024))
+            if not firstBytes:
+                print(f"{workerCount:>8}{'failed':>6}")
+                continue
+            print(f"{workerCount:>8}{done:>6}{elapsed:>10.2f}{total / elapsed:>10.1f}"
+                f"{percentile(firstBytes, 50) * 1000:>10.1f}{percentile(firstBytes, 99) * 1000:>10.1f}")
+
+# fetches the listing and hangs up
+def fetchListing(port):
+    with create_connection(('127.0.0.1', port)) as conn:
+        return protocol.readListing(BufferedReader(conn))
+
+def benchListing(fileCount, connections):
+    with tempfile.TemporaryDirectory() as workDir:
+        repository = Path(workDir) / "repository"
+        repository.mkdir()
+        for n in range(fileCount):
+            (repository / f"file{n:06}.txt").write_bytes(b"x")
+
+        rounds = 20
+        start = time.perf_counter()
+        for n in range(rounds): #what the server did for every connection before the index
+            protocol.encodeListing([entry.name for entry in Path(repository).iterdir()])
+        scanned = (time.perf_counter() - start) / rounds
+        index = RepositoryIndex(str(repository))
+        start = time.perf_counter()
+        for n in range(rounds):
+            index.snapshot()
+        cached = (time.perf_counter() - start) / rounds
+        print(f"{fileCount} files, {len(index.listing)} byte listing")
+        print(f"scan and encode per connection {scanned * 1000:.2f} ms, cached {cached * 1000:.4f} ms")
+
+        server, port = startServer(workDir)
+        start = time.perf_counter()
+        for n in range(connections):
+            if len(fetchListing(port)) != fileCount:
+                print("listing came back wrong")
+                break
+        elapsed = time.perf_counter() - start
+        stopServer(server)
+        print(f"{connections} listings from the server in {elapsed:.2f} s, {connections / elapsed:.0f}/s")
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print("usage: bvShare-bench.py transfer [SIZE_MB ...]")
+        print("       bvShare-bench.py ranges [SIZE_MB] [CONNECTIONS ...]")
+        print("       bvShare-bench.py compress [SIZE_MB]")
+        print("       bvShare-bench.py sync [SIZE_MB]")
+        print("       bvShare-bench.py batch [FILES] [SIZE_KB] [CONNECTIONS ...]")
+        print("       bvShare-bench.py load [CLIENTS] [SIZE_MB] [WORKERS ...]")
+        print("       bvShare-bench.py listing [FILES] [CONNECTIONS]")
+        exit()
+
+    mode = argv[1]
+    if mode == "transfer":
+        benchTransfer([float(size) for size in argv[2:]] or [64, 1024, 5120])
+    elif mode == "ranges":
+        sizeMB = float(argv[2]) if len(argv) > 2 else 256
+        benchRanges(sizeMB, [int(count) for count in argv[3:]] or [1, 2, 4, 8])
+    elif mode == "compress":
+        benchCompress(float(argv[2]) if len(argv) > 2 else 64)
+    elif mode == "sync":
+        benchSync(float(argv[2]) if len(argv) > 2 else 256)
+    elif mode == "batch":
+        fileCount = int(argv[2]) if len(argv) > 2 else 200
+        sizeKB = float(argv[3]) if len(argv) > 3 else 64
+        benchBatch(fileCount, sizeKB, [int(count) for count in argv[4:]] or [1, 4])
+    elif mode == "load":
+        clientCount = int(argv[2]) if len(argv) > 2 else 200
+        sizeMB = float(argv[3]) if len(argv) > 3 else 4
+        benchLoad(clientCount, sizeMB, [int(count) for count in argv[4:]] or [1, 256])
+    elif mode == "listing":
+        fileCount = int(argv[2]) if len(argv) > 2 else 10000
+        connections = int(argv[3]) if len(argv) > 3 else 500
+        benchListing(fileCount, connections)
+    else:
+        print(f"unknown benchmark {mode}")
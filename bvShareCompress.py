@@ -0,0 +1,183 @@
+from collections import OrderedDict, Counter
+import threading
+import time
+import zlib
+import bvShareProtocol as protocol
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compression for bvShare transfers, used by bvShare_Server.py to send frames
+#   and by bvShare_Client.py to unpack them. zlib always works, zstd and lz4
+#   only when the zstandard and lz4 packages are installed.
+
+# raw bytes compressed into one frame
+BLOCK_SIZE = 1024 * 1024
+
+# blocks sent raw without trying after one that didn't compress, so a file
+#   of random bytes doesn't cost much more CPU than sending it as it is
+SKIP_BLOCKS = 16
+
+# files that compress to more than this much of their size aren't worth caching
+CACHE_MAX_RATIO = 0.9
+
+# zlib trades ratio for speed at level 1, it is still slower than the network otherwise
+ZLIB_LEVEL = 1
+
+# file types that are compressed already and get sent as they are
+COMPRESSED_SUFFIXES = {
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".rar", ".jar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".ogg", ".flac", ".aac",
+    ".mp4", ".mkv", ".avi", ".mov", ".webm", ".pdf", ".docx", ".xlsx", ".pptx",
+}
+
+# codec flag: (name, compress, decompress) for every codec this Python has
+CODECS = {protocol.ZLIB: ("zlib", lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompress)}
+if zstandard is not None:
+    CODECS[protocol.ZSTD] = ("zstd", zstandard.ZstdCompressor(level=3).compress,
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 is not None:
+    CODECS[protocol.LZ4] = ("lz4", lz4.frame.compress, lz4.frame.decompress)
+
+# the server's pick when a client offers several, fastest first
+PREFERENCE = [protocol.ZSTD, protocol.LZ4, protocol.ZLIB]
+
+# flags offering every codec there is
+def available():
+    flags = 0
+    for codec in CODECS:
+        flags |= codec
+    return flags
+
+# the codec flag called `name', or None
+def byName(name):
+    for codec, (codecName, compress, decompress) in CODECS.items():
+        if codecName == name:
+            return codec
+    return None
+
+# picks the codec to answer a request's flags with, 0 to send the file as it is
+def choose(flags, fileName):
+    if any(fileName.lower().endswith(suffix) for suffix in COMPRESSED_SUFFIXES):
+        return 0
+    for codec in PREFERENCE:
+        if flags & codec and codec in CODECS:
+            return codec
+    return 0
+
+# compresses `data' into one frame and adds what it cost to `stats'. A block
+#   that doesn't get smaller is sent raw, so incompressible parts of a file
+#   cost a header and no more. With codec 0 the block is sent raw untried
+def encodeFrame(codec, data, stats):
+    start = time.thread_time()
+    packed = CODECS[codec][1](data) if codec else data
+    cpu = time.thread_time() - start
+    if len(packed) >= len(data):
+        frame = protocol.FRAME.pack(len(data) | protocol.RAW_FRAME) + data
+    else:
+        frame = protocol.FRAME.pack(len(packed)) + packed
+    stats.add(len(data), len(frame), cpu)
+    return frame
+
+# yields the frames of `count' bytes of the open file `f' from where it is
+#   positioned, compressed with `codec'. Stops early if the file is shorter
+def encodeFrames(codec, f, count, stats):
+    skip = 0
+    while count:
+        block = f.read(min(count, BLOCK_SIZE))
+        if not block:
+            return
+        frame = encodeFrame(0 if skip else codec, block, stats)
+        if skip:
+            skip -= 1
+        elif protocol.FRAME.unpack_from(frame)[0] & protocol.RAW_FRAME:
+            skip = SKIP_BLOCKS
+        count -= len(block)
+        yield frame
+
+# reads the next frame from a BufferedReader, adds what it cost to `stats'
+#   and returns its raw bytes, or None if the connection closed first
+def readFrame(reader, codec, stats):
+    header = reader.getFullMsg(protocol.FRAME.size)
+    if len(header) < protocol.FRAME.size:
+        return None
+    length = protocol.FRAME.unpack(header)[0]
+    data = reader.getFullMsg(length & ~protocol.RAW_FRAME)
+    if len(data) < length & ~protocol.RAW_FRAME:
+        return None
+    sent = protocol.FRAME.size + len(data)
+    start = time.thread_time()
+    if not length & protocol.RAW_FRAME:
+        data = CODECS[codec][2](data)
+    stats.add(len(data), sent, time.thread_time() - start)
+    return data
+
+
+# What compressing costs: raw bytes, the bytes of frames they were sent in
+#   and CPU seconds spent on them. Safe to share between threads
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw = 0
+        self.sent = 0
+        self.cpu = 0.0
+
+    def add(self, raw, sent, cpu):
+        with self.lock:
+            self.raw += raw
+            self.sent += sent
+            self.cpu += cpu
+
+    # sent bytes per raw byte
+    def ratio(self):
+        return self.sent / self.raw if self.raw else 1.0
+
+
+# Compressed copies of the files clients keep asking for. A file is kept
+#   once it has been asked for `after' times, keyed by name and codec and
+#   only used while its size and mtime match the file on disk, unless it
+#   hardly compresses and sending it as it is costs nothing. The least
+#   recently sent files are dropped once the copies add up to `budget' bytes.
+class FrameCache:
+    def __init__(self, budget, after=2):
+        self.budget = budget
+        self.after = after
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # (name, codec): (size, mtime, frames)
+        self.requests = Counter() # (name, codec, size, mtime): times asked for
+        self.used = 0
+
+    # returns the cached frames of a file, or None
+    def get(self, name, codec, size, mtime):
+        with self.lock:
+            entry = self.entries.get((name, codec))
+            if entry is None or entry[:2] != (size, mtime):
+                return None
+            self.entries.move_to_end((name, codec))
+            return entry[2]
+
+    # counts a request for the file, returns True if it should be cached now
+    def wanted(self, name, codec, size, mtime):
+        with self.lock:
+            self.requests[name, codec, size, mtime] += 1
+            return self.requests[name, codec, size, mtime] >= self.after
+
+    def put(self, name, codec, size, mtime, frames):
+        if len(frames) > self.budget or len(frames) > size * CACHE_MAX_RATIO:
+            return
+        with self.lock:
+            old = self.entries.pop((name, codec), None)
+            if old is not None:
+                self.used -= len(old[2])
+            self.requests.pop((name, codec, size, mtime), None)
+            self.entries[name, codec] = (size, mtime, frames)
+            self.used += len(frames)
+            while self.used > self.budget:
+                key, (oldSize, oldMtime, oldFrames) = self.entries.popitem(last=False)
+                self.used -= len(oldFrames)
@@ -0,0 +1,204 @@
+from collections import namedtuple
+from bisect import bisect_left
+import threading
+import hashlib
+import time
+import os
+import bvShareProtocol as protocol
+
+# Seconds between checks of the repository for changes
+POLL_INTERVAL = 1
+
+# bytes hashed at a time when content hashes are on
+HASH_BLOCK = 1024 * 1024
+
+# One file in the repository. sha256 is the hex digest of its contents, or
+#   None until it has been hashed or when the index doesn't hash contents
+FileEntry = namedtuple("FileEntry", "name size mtime sha256")
+
+# sha256 hex digest of a file, read a block at a time
+def hashFile(filePath):
+    digest = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Content hashes of the files in one directory, each good for as long as
+#   the file keeps the size and mtime it was hashed at. With a `path' they
+#   are kept there between runs as "size mtime sha256 name" lines, so
+#   nothing that didn't change is read again after a restart
+class HashCache:
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes = {} # name: (size, mtime, sha256)
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    size, mtime, sha256, name = line.rstrip("\n").split(" ", 3)
+                    self.hashes[name] = (int(size), int(mtime), sha256)
+        except (OSError, ValueError):
+            pass # no cache yet, or a broken one that gets rewritten
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            lines = [f"{size} {mtime} {sha256} {name}\n" for name, (size, mtime, sha256) in self.hashes.items()
+                if "\n" not in name]
+        with open(self.path + ".tmp", "w") as f:
+            f.writelines(lines)
+        os.replace(self.path + ".tmp", self.path)
+
+    # the known hash of file `name', or None if it wasn't hashed at this size and mtime
+    def get(self, name, size, mtime):
+        with self.lock:
+            known = self.hashes.get(name)
+        if known is None or known[:2] != (size, mtime):
+            return None
+        return known[2]
+
+    def put(self, name, size, mtime, sha256):
+        with self.lock:
+            self.hashes[name] = (size, mtime, sha256)
+
+    # the hash of file `name' as it is now, reading it only if it changed
+    def hash(self, name):
+        stat = os.stat(os.path.join(self.directory, name))
+        sha256 = self.get(name, stat.st_size, stat.st_mtime_ns)
+        if sha256 is None:
+            sha256 = hashFile(os.path.join(self.directory, name))
+            self.put(name, stat.st_size, stat.st_mtime_ns, sha256)
+        return sha256
+
+    # forgets every file not in `names'
+    def keep(self, names):
+        with self.lock:
+            for name in self.hashes.keys() - set(names):
+                del self.hashes[name]
+
+# In-memory index of bvShare_Server.py's repository. Listing the directory
+#   and encoding the names for every connection costs more than anything
+#   else a client asks for once the repository is big, so the index keeps
+#   the entries and the encoded listing and only rebuilds them when a poll
+#   sees a file added, removed, resized or touched. Files are listed sorted
+#   by name, so a file keeps its ID until the files before it change.
+#
+# With hashContents on, a worker thread hashes every new or changed file in
+#   the background and fills in its entry's sha256, so a big file being
+#   hashed never holds up the listing. Hashes are cached by size and mtime,
+#   in cachePath too if one is given.
+class RepositoryIndex:
+    def __init__(self, directory, pollInterval=POLL_INTERVAL, hashContents=False, cachePath=None):
+        self.directory = directory
+        self.pollInterval = pollInterval
+        self.hashContents = hashContents
+        self.hashes = HashCache(directory, cachePath)
+        self.unhashed = threading.Event() # set while some entry has no sha256 yet
+        self.lock = threading.Lock()
+        self.entries = [] # FileEntry of every file, sorted by name
+        self.listing = protocol.encodeListing([])
+        self.manifestCache = {} # mtime flag: the encoded manifest of entries, once a client asked for it
+        self.version = 0 # bumped every time the listing changes
+        self.refresh()
+
+    # returns (entries, listing) as of the last refresh. They always match,
+    #   so an ID read from the listing indexes the entries it came with
+    def snapshot(self):
+        with self.lock:
+            return self.entries, self.listing
+
+    # the encoded manifest of a snapshot. Hashes that came in since the
+    #   snapshot was taken are in it as long as the listing didn't change
+    def manifest(self, entries, listing, mtime=False):
+        with self.lock:
+            if listing is not self.listing:
+                return protocol.encodeManifest(entries, mtime)
+            if mtime not in self.manifestCache:
+                self.manifestCache[mtime] = protocol.encodeManifest(self.entries, mtime)
+            return self.manifestCache[mtime]
+
+    # stats every file and rebuilds the listing if anything changed.
+    #   returns True if it did
+    def refresh(self):
+        stats = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file():
+                    stat = entry.stat()
+                    stats.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        stats.sort()
+        with self.lock:
+            old = [entry[:3] for entry in self.entries]
+        if old == stats:
+            return False
+
+        entries = []
+        for name, size, mtime in stats:
+            sha256 = self.hashes.get(name, size, mtime) if self.hashContents else None
+            entries.append(FileEntry(name, size, mtime, sha256))
+        listing = protocol.encodeListing([entry.name for entry in entries])
+        with self.lock:
+            self.entries = entries
+            self.listing = listing
+            self.manifestCache = {}
+            self.version += 1
+        if self.hashContents:
+            self.hashes.keep([entry.name for entry in entries])
+            if any(entry.sha256 is None for entry in entries):
+                self.unhashed.set()
+        return True
+
+    # polls the directory, and hashes files if hashContents is on, on background threads
+    def start(self):
+        threading.Thread(target=self.poll, daemon=True).start()
+        if self.hashContents:
+            threading.Thread(target=self.hashFiles, daemon=True).start()
+
+    def poll(self):
+        while True:
+            time.sleep(self.pollInterval)
+            try:
+                self.refresh()
+            except OSError:
+                pass # a file went away mid-scan, the next poll sees it
+
+    # hashes the files without a sha256 one at a time, saving the cache
+    #   whenever there is nothing left to hash
+    def hashFiles(self):
+        skipped = set() # (name, size, mtime) of files that couldn't be read or changed while they were
+        while True:
+            self.unhashed.wait()
+            with self.lock:
+                todo = [entry for entry in self.entries if entry.sha256 is None and entry[:3] not in skipped]
+                if not todo:
+                    self.unhashed.clear()
+            if not todo:
+                self.hashes.save()
+                continue
+            for entry in todo:
+                filePath = os.path.join(self.directory, entry.name)
+                try:
+                    sha256 = hashFile(filePath)
+                    changed = os.stat(filePath).st_mtime_ns != entry.mtime
+                except OSError:
+                    changed = True
+                if changed: # the next poll gives it an entry of its own
+                    skipped.add(entry[:3])
+                    continue
+                self.hashes.put(entry.name, entry.size, entry.mtime, sha256)
+                self.setHash(entry, sha256)
+
+    # fills in the sha256 of `entry' if the index still has that version of the file
+    def setHash(self, entry, sha256):
+        with self.lock:
+            at = bisect_left(self.entries, entry.name, key=lambda known: known.name)
+            if at < len(self.entries) and self.entries[at][:3] == entry[:3]:
+                self.entries[at] = entry._replace(sha256=sha256)
+                self.manifestCache = {}
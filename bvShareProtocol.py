@@ -0,0 +1,195 @@
+import struct
+
+# bvShare protocol, shared by bvShare_Server.py and bvShare_Client.py
+#
+# On connect the server sends the repository listing: a 4 byte little endian
+#   file count, then for every file a 2 byte little endian name length and
+#   the UTF-8 name. Files are asked for by their position in the listing,
+#   starting at 1.
+#
+# v1 clients answer with a 2 byte little endian ID and get back a 4 byte
+#   little endian size and the file, so they can't fetch files of 4 GiB or
+#   more. v2 clients send a request header instead, and the server answers
+#   with a response header carrying an 8 byte size:
+#
+#   request   +-------+---------+-------+------------+
+#             | "BV"  | version | flags | file ID    |
+#             +-------+---------+-------+------------+
+#               2 B     1 B       1 B     4 B, big endian
+#
+#   response  +-------+---------+--------+-----------------------+-----------
+#             | "BV"  | version | status | size                  | file ...
+#             +-------+---------+--------+-----------------------+-----------
+#               2 B     1 B       1 B      8 B, big endian
+#
+# The server tells the two apart by the first 2 bytes. A v1 ID would have to
+#   be 22082 to look like "BV". v1 clients get one file per connection. v2
+#   clients can send any number of requests on one connection, without
+#   waiting for the answers, and get the answers in the same order. IDs are
+#   those of the listing sent when the connection opened.
+#
+# With the RANGE flag set the request header is followed by an 8 byte offset
+#   and an 8 byte length, both big endian, and only those bytes of the file
+#   are sent, cut short at the end of the file. The response's size is still
+#   the size of the whole file, so a client can ask for 0 bytes to learn it.
+#
+# A client that can decompress sets the flag of every codec it has (ZLIB,
+#   ZSTD, LZ4). The response header is then followed by 1 byte with the flag
+#   of the codec the server picked, or 0 if it sends the bytes as they are,
+#   which it does for files that are compressed already. Compressed bytes
+#   come in frames, each one block of the file compressed on its own:
+#
+#   frame     +-----------------------+----------------------
+#             | length                | data ...
+#             +-----------------------+----------------------
+#               4 B, big endian
+#
+# A frame with the RAW_FRAME bit of its length set holds its block
+#   uncompressed, because compressing didn't make it smaller. The frames
+#   end once the requested bytes of the file have all been sent.
+#
+# A request with the MANIFEST flag asks for the size and content hash of
+#   file ID instead of the file, or of every file in the listing for ID 0.
+#   The server answers with status MANIFEST_OK, and the response's size is
+#   the length of the manifest that follows it, a MANIFEST_ENTRY per file in
+#   listing order: an 8 byte big endian size and the 32 byte sha256 of the
+#   file, all zeros if the server hasn't hashed it yet. Servers from before
+#   the manifest ignore the flag, so it is sent with a RANGE of 0 bytes and
+#   they answer with just the file's size, or NO_FILE for ID 0.
+#
+# With the MTIME flag as well each entry is a MANIFEST_MTIME_ENTRY, which
+#   adds the file's 8 byte mtime in nanoseconds, so a client can tell a file
+#   that changed without changing size even when there are no hashes.
+#   Servers that don't know the flag send plain entries, and the client
+#   tells them apart by the manifest's length.
+
+MAGIC = b"BV"
+VERSION = 2
+
+# the listing
+COUNT = struct.Struct("<I")
+NAME_LENGTH = struct.Struct("<H")
+
+# v1 request and response
+LEGACY_ID = struct.Struct("<H")
+LEGACY_SIZE = struct.Struct("<I")
+LEGACY_MAX_SIZE = 2 ** 32 - 1
+
+# v2 request and response
+REQUEST = struct.Struct("!2sBBI")
+RESPONSE = struct.Struct("!2sBBQ")
+
+# request flags
+RANGE = 0x01
+RANGE_FIELDS = struct.Struct("!QQ") # offset, length
+ZLIB = 0x02
+ZSTD = 0x04
+LZ4 = 0x08
+COMPRESSION = ZLIB | ZSTD | LZ4
+MANIFEST = 0x10
+MTIME = 0x20
+
+# compressed transfers
+CODEC = struct.Struct("!B")
+FRAME = struct.Struct("!I")
+RAW_FRAME = 0x80000000
+
+# the manifest
+MANIFEST_ENTRY = struct.Struct("!Q32s") # size, sha256
+MANIFEST_MTIME_ENTRY = struct.Struct("!Q32sQ") # size, sha256, mtime
+NO_HASH = bytes(32)
+
+# response statuses
+OK = 0
+NO_FILE = 1 # the ID isn't in the listing
+MANIFEST_OK = 2 # the manifest follows
+
+# encodes the listing of `names' into one buffer
+def encodeListing(names):
+    parts = [COUNT.pack(len(names))]
+    for name in names:
+        name = name.encode()
+        parts.append(NAME_LENGTH.pack(len(name)))
+        parts.append(name)
+    return b''.join(parts)
+
+# reads the listing from a BufferedReader, returns the file names or None if
+#   the connection closed first
+def readListing(reader):
+    count = reader.getFullMsg(COUNT.size)
+    if len(count) < COUNT.size:
+        return None
+    names = []
+    remaining = COUNT.unpack(count)[0]
+    # a listing can have tens of thousands of names, so every name that is
+    #   already buffered is decoded straight out of the reader's buffer
+    #   before it receives more
+    while remaining:
+        with reader.view() as data:
+            end = len(data)
+            pos = 0
+            while remaining and pos + NAME_LENGTH.size <= end:
+                nameEnd = pos + NAME_LENGTH.size + (data[pos] | data[pos + 1] << 8)
+                if nameEnd > end:
+                    break
+                names.append(str(data[pos + NAME_LENGTH.size:nameEnd], 'utf-8'))
+                pos = nameEnd
+                remaining -= 1
+        reader.consume(pos)
+        if remaining and not reader.ensure(reader.buffered() + 1):
+            return None
+    return names
+
+# encodes a request for a whole file, or for `length' bytes from `offset' if offset is given
+def encodeRequest(fileId, flags=0, offset=None, length=0):
+    if offset is None:
+        return REQUEST.pack(MAGIC, VERSION, flags, fileId)
+    return REQUEST.pack(MAGIC, VERSION, flags | RANGE, fileId) + RANGE_FIELDS.pack(offset, length)
+
+# encodes a request for the manifest of file `fileId', or of every file for 0
+def encodeManifestRequest(fileId=0):
+    return encodeRequest(fileId, MANIFEST | MTIME, offset=0, length=0)
+
+# encodes the size and hash, and the mtime if `mtime' is set, of every
+#   FileEntry in `entries' into one buffer
+def encodeManifest(entries, mtime=False):
+    if mtime:
+        return b''.join(MANIFEST_MTIME_ENTRY.pack(entry.size,
+            NO_HASH if entry.sha256 is None else bytes.fromhex(entry.sha256), entry.mtime) for entry in entries)
+    return b''.join(MANIFEST_ENTRY.pack(entry.size, NO_HASH if entry.sha256 is None else bytes.fromhex(entry.sha256))
+        for entry in entries)
+
+# reads a manifest of `length' bytes for `count' files from a BufferedReader,
+#   returns a (size, sha256 hex digest or None, mtime or None) per file or
+#   None if the connection closed first
+def readManifest(reader, length, count):
+    data = reader.getFullMsg(length)
+    if len(data) < length:
+        return None
+    if length == count * MANIFEST_MTIME_ENTRY.size:
+        return [(size, None if sha256 == NO_HASH else sha256.hex(), mtime)
+            for size, sha256, mtime in MANIFEST_MTIME_ENTRY.iter_unpack(data)]
+    return [(size, None if sha256 == NO_HASH else sha256.hex(), None)
+        for size, sha256 in MANIFEST_ENTRY.iter_unpack(data)]
+
+def encodeResponse(status, size=0):
+    return RESPONSE.pack(MAGIC, VERSION, status, size)
+
+# reads a response header from a BufferedReader, returns (status, size) or
+#   None if the connection closed or it isn't a v2 response
+def readResponse(reader):
+    header = reader.getFullMsg(RESPONSE.size)
+    if len(header) < RESPONSE.size:
+        return None
+    magic, version, status, size = RESPONSE.unpack(header)
+    if magic != MAGIC:
+        return None
+    return status, size
+
+# reads the codec byte that follows the response to a request offering
+#   compression, returns the codec flag or None if the connection closed
+def readCodec(reader):
+    codec = reader.getFullMsg(CODEC.size)
+    if len(codec) < CODEC.size:
+        return None
+    return CODEC.unpack(codec)[0]
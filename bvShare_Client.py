@@ -3,69 +3,494 @@
 from sys import argv
 from os import path
 from pathlib import Path
+from collections import deque
+from fnmatch import fnmatchcase
+import threading
+import time
+import hashlib
+import shutil
+import os
 
 from socket import *
+from bvBufferedReader import BufferedReader
+import bvShareProtocol as protocol
+import bvShareCompress as compress
+from bvShareIndex import HashCache, hashFile
 
+# bytes received and written to disk at a time
+WRITE_SIZE = 1024 * 1024
 
+# bytes received on a range between saves of the download's progress
+PROGRESS_INTERVAL = 16 * 1024 * 1024
+
+# smallest range worth its own connection
+MIN_RANGE = 8 * 1024 * 1024
+
+# requests a connection sends before it waits for the first answer
+PIPELINE = 16
+
+# times in a row a connection may fail to fetch anything before its worker gives up,
+#   and seconds it waits before trying again
+MAX_FAILURES = 3
+RETRY_DELAY = 0.5
+
+# hashes of the files in repository/, so a file that didn't change isn't read again next time
+HASH_CACHE = "repository.hashes"
+
+
+if len(argv) < 3:
+    print("usage: bvShare_Client.py IP PORT [FILE_ID | NAME_OR_PATTERN ...] [--connections=N] [--compress[=zlib|zstd|lz4]]")
+    exit()
 
 serverIP = argv[1]
 serverPort = int(argv[2])
+fileArg = None
+patterns = [] # names or glob patterns of files to fetch without asking
+CONNECTIONS = 1 # connections one file is split over, or that many files are fetched over at once
+CODECS = 0 # flags of the codecs offered to the server, none to get files as they are
+for arg in argv[3:]:
+    if arg.startswith("--connections="):
+        CONNECTIONS = int(arg.split('=')[1])
+    elif arg == "--compress":
+        CODECS = compress.available()
+    elif arg.startswith("--compress="):
+        CODECS = compress.byName(arg.split('=')[1])
+        if CODECS is None:
+            print(f"{arg.split('=')[1]} isn't available, this Python has {', '.join(name for name, c, d in compress.CODECS.values())}")
+            exit()
+    else:
+        patterns.append(arg)
+if len(patterns) == 1 and patterns[0].isdigit():
+    fileArg = int(patterns.pop())
+
+
+#Connects to the server and receives the listing. returns the socket, its
+#   reader and the file names, or None for the names if the server hung up
+def connect():
+    clientSocket = socket(AF_INET, SOCK_STREAM)
+    clientSocket.connect( (serverIP, serverPort) )
+    reader = BufferedReader(clientSocket)
+    return clientSocket, reader, protocol.readListing(reader)
+
+
+#A download in progress is kept in repository/NAME.part, and the ranges of it
+#   still being fetched in repository/NAME.part.ranges: the server's file size,
+#   mtime and sha256 on the first line, "-" for the ones it didn't send, then
+#   a "start end done" line per range. A partial file is only resumed if
+#   nothing known on both lines differs, so one that changed on the server
+#   without changing size is fetched again. Progress is saved
+#   every PROGRESS_INTERVAL bytes, so an interrupted download picks up close
+#   to where it stopped and a range never has to start over. With the
+#   sha256 from the server's manifest the file is checked before it gets its
+#   real name, as it arrives when it comes in one piece from the start
+class Download:
+    def __init__(self, fileName, fileSize, sha256=None, mtime=None, rangeCount=1):
+        self.fileName = fileName
+        self.fileSize = fileSize
+        self.sha256 = sha256
+        self.version = " ".join("-" if field is None else str(field) for field in (fileSize, mtime, sha256))
+        self.partPath = "repository/" + fileName + ".part"
+        self.progressPath = self.partPath + ".ranges"
+        self.lock = threading.Lock() #guards ranges, pending and finished
+        self.saveLock = threading.Lock() #one save at a time, they share the temporary file
+        self.writeLock = threading.Lock() #guards fd, so it isn't closed under a write
+        self.ranges = self.loadProgress()
+        if self.ranges is None: #nothing to resume, split the file into ranges
+            count = max(1, min(rangeCount, fileSize // MIN_RANGE))
+            bounds = [fileSize * n // count for n in range(count + 1)]
+            self.ranges = [[bounds[n], bounds[n + 1], 0] for n in range(count)]
+            with open(self.partPath, "wb") as f:
+                f.truncate(fileSize)
+        self.fd = os.open(self.partPath, os.O_WRONLY)
+        self.digest = None #hash of the bytes so far, while they arrive in order
+        if sha256 is not None and self.ranges == [[0, fileSize, 0]]:
+            self.digest = hashlib.sha256()
+        self.pending = len(self.unfinished()) #ranges not fetched or given up on yet
+        self.started = None #when the first response for it came in
+        self.elapsed = 0 #seconds from then until the last byte
+        self.finished = False
+        self.complete = False #True once the whole file is here, under its real name
+        self.corrupt = False #True if the finished file didn't match sha256
+
+    #returns the saved ranges, or None if there is no download of this file to resume
+    def loadProgress(self):
+        try:
+            with open(self.progressPath) as f:
+                lines = f.read().split("\n")
+            saved = lines[0].split()
+            if len(saved) != 3 or any(old != new and "-" not in (old, new) for old, new in zip(saved, self.version.split())) \
+                    or path.getsize(self.partPath) != self.fileSize:
+                return None #the file changed on the server since
+            return [[int(field) for field in line.split()] for line in lines[1:] if line]
+        except (OSError, ValueError):
+            return None
 
+    def saveProgress(self):
+        with self.saveLock:
+            with self.lock:
+                lines = [self.version] + [f"{start} {end} {done}" for start, end, done in self.ranges]
+            with open(self.progressPath + ".tmp", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(self.progressPath + ".tmp", self.progressPath)
 
-#Connect to server
-clientSocket = socket(AF_INET, SOCK_STREAM)
-clientSocket.connect( (serverIP, serverPort) )
+    def received(self):
+        with self.lock:
+            return sum(done for start, end, done in self.ranges)
 
-#receive the number of files that are in the repository
-msgRec = clientSocket.recv(4)
-numFiles = int.from_bytes(msgRec,'little')
+    #the ranges with bytes left to fetch
+    def unfinished(self):
+        return [fileRange for fileRange in self.ranges if fileRange[0] + fileRange[2] < fileRange[1]]
 
-fileNames = []
+    #receives the rest of one range, whose response header has been read,
+    #   writing every buffer at its place in the file as it arrives. Frames
+    #   are unpacked if the server picked a codec. returns True if the whole
+    #   range arrived, False if the connection closed first
+    def receive(self, fileRange, reader, codec, stats):
+        if self.started is None:
+            self.started = time.perf_counter()
+        start, end, done = fileRange
+        if not codec:
+            buffer = bytearray(min(end - start - done, WRITE_SIZE))
+            view = memoryview(buffer)
+        unsaved = 0
+        while start + done < end:
+            if codec:
+                data = compress.readFrame(reader, codec, stats)
+                if data is None:
+                    return False #connection closed
+                data = data[:end - start - done]
+                want = len(data)
+            else:
+                want = min(len(buffer), end - start - done)
+                data = view[:reader.readInto(view[:want])]
+            with self.writeLock:
+                if self.fd is None:
+                    return False #finished while this range was arriving
+                os.pwrite(self.fd, data, start + done)
+            if self.digest is not None:
+                self.digest.update(data)
+            done += len(data)
+            unsaved += len(data)
+            with self.lock:
+                fileRange[2] = done
+            if unsaved >= PROGRESS_INTERVAL:
+                self.saveProgress()
+                unsaved = 0
+            if len(data) < want:
+                return False #connection closed
+        return True
 
-#receive each file name and display them with a ID
-count = 1
-for i in range(numFiles):
-    msgR = clientSocket.recv(2)
-    nameLen = int.from_bytes(msgR, 'little')
+    #called once per unfinished range when it is fetched or given up on,
+    #   finishes the download after the last one
+    def rangeSettled(self):
+        with self.lock:
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.finish()
 
-    fileName = clientSocket.recv(nameLen).decode()
+    #closes the file and saves what was received. Once the whole file is
+    #   here it is checked against sha256 and moved to its real name, or
+    #   thrown away and corrupt set if it doesn't match
+    def finish(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if self.started is not None:
+            self.elapsed = time.perf_counter() - self.started
+        with self.writeLock: #no worker writes to the fd number once it can be reused
+            os.close(self.fd)
+            self.fd = None
+        self.saveProgress()
+        if self.received() < self.fileSize:
+            return
+        if self.sha256 is not None:
+            sha256 = self.digest.hexdigest() if self.digest is not None else hashFile(self.partPath)
+            if sha256 != self.sha256:
+                self.corrupt = True
+                os.remove(self.partPath)
+                os.remove(self.progressPath)
+                return
+        os.replace(self.partPath, "repository/" + self.fileName)
+        os.remove(self.progressPath)
+        self.complete = True
 
-    fileNames.append(fileName)
 
-    print(f"[{count}] {fileName}")
-    count += 1
+#Fetches the unfinished ranges of every download over `connections'
+#   connections at once. Each connection stays open for as many ranges as
+#   it can take and keeps up to PIPELINE requests in flight, so the next
+#   file is already on its way while one is still arriving. Ranges in flight
+#   on a connection that closes go back in the queue for the next one.
+#   Servers from before persistent connections hang up after one file,
+#   and drop anything sent before they do, so nothing is pipelined until a
+#   connection has answered a second request
+class Fetcher:
+    def __init__(self, downloads, connections):
+        self.downloads = downloads
+        self.lock = threading.Lock() #guards queue
+        self.queue = deque((download, fileRange) for download in downloads for fileRange in download.unfinished())
+        self.connections = max(1, min(connections, len(self.queue)))
+        self.stats = compress.Stats() #of the ranges that came compressed
+        self.codec = 0 #the codec the server picked, 0 if none
+        self.persistent = None #whether the server takes more than one request per connection, None until known
+        for download in downloads:
+            if not download.pending: #resumed with every byte already here
+                download.finish()
 
+    #returns once every range was fetched or the server couldn't be reached
+    #   MAX_FAILURES times in a row
+    def run(self):
+        threads = [threading.Thread(target=self.worker, daemon=True) for n in range(self.connections)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for download in self.downloads:
+                download.finish()
 
-msgID = int(input("What file do you want: "))
+    def worker(self):
+        failures = 0
+        while failures < MAX_FAILURES:
+            with self.lock:
+                if not self.queue:
+                    return
+            try:
+                clientSocket, reader, fileNames = connect()
+            except OSError:
+                failures += 1
+                time.sleep(RETRY_DELAY)
+                continue
+            if fileNames is not None and self.pipeline(clientSocket, reader, fileNames):
+                failures = 0
+            else:
+                failures += 1
+                time.sleep(RETRY_DELAY)
 
-#Store the file name
-finalFileName = fileNames[msgID -1]
+    #fetches ranges from the queue over one connection until the queue is
+    #   empty or the connection closes. returns True if it fetched any
+    def pipeline(self, clientSocket, reader, fileNames):
+        ids = {name: n + 1 for n, name in enumerate(fileNames)} #IDs move when files are added before one
+        inflight = deque()
+        served = 0
+        try:
+            while True:
+                if self.persistent is False and served:
+                    return True
+                window = PIPELINE if self.persistent else 1
+                requests = []
+                gone = []
+                with self.lock:
+                    while len(inflight) < window and self.queue:
+                        download, fileRange = self.queue.popleft()
+                        if download.fileName not in ids:
+                            gone.append(download)
+                            continue
+                        start, end, done = fileRange
+                        requests.append(protocol.encodeRequest(ids[download.fileName], CODECS, offset=start + done, length=end - start - done))
+                        inflight.append((download, fileRange))
+                for download in gone: #removed from the server
+                    download.rangeSettled()
+                if requests:
+                    clientSocket.sendall(b''.join(requests))
+                if not inflight:
+                    return served > 0
 
-#Check to see if the user put 0
-if msgID == 0:
-    print("invalid ID")
+                download, fileRange = inflight[0]
+                response = protocol.readResponse(reader)
+                if response is None:
+                    break
+                if response[0] == protocol.NO_FILE:
+                    inflight.popleft()
+                    download.rangeSettled()
+                    continue
+                if response != (protocol.OK, download.fileSize):
+                    #the file changed since its size was asked for, what comes next is the new one
+                    inflight.popleft()
+                    download.rangeSettled()
+                    return served > 0
+                codec = protocol.readCodec(reader) if CODECS else 0
+                if codec:
+                    self.codec = codec
+                if not download.receive(fileRange, reader, codec, self.stats):
+                    return served > 0
+                inflight.popleft()
+                download.rangeSettled()
+                served += 1
+                if served == 2:
+                    self.persistent = True
+        except OSError:
+            pass #the server went away, what was received is saved for next time
+        finally:
+            clientSocket.close()
+            with self.lock:
+                self.queue.extendleft(reversed(inflight))
+        if served == 1 and self.persistent is None:
+            self.persistent = False #closed instead of answering the next request
+        return served > 0
+
+
+#the files in repository/ by size and sha256, from a single scan. Only the
+#   sizes that are looked up get their files hashed
+class LocalFiles:
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.unhashed = {} #size -> names of the files of that size, until one is looked up
+        self.names = {} #(size, sha256) -> names of the files with that contents
+        with os.scandir("repository") as scan:
+            for entry in scan:
+                if entry.is_file() and not entry.name.endswith((".part", ".copy")):
+                    self.unhashed.setdefault(entry.stat().st_size, []).append(entry.name)
+
+    #the name of a file with the given size and sha256, `fileName' itself if
+    #   it is one of them, or None
+    def find(self, fileName, fileSize, sha256):
+        for name in self.unhashed.pop(fileSize, ()):
+            self.names.setdefault((fileSize, self.hashes.hash(name)), []).append(name)
+        same = self.names.get((fileSize, sha256))
+        if not same:
+            return None
+        return fileName if fileName in same else same[0]
+
+
+#Connect to server and receive the number of files that are in the repository and their names
+clientSocket, reader, fileNames = connect()
+if fileNames is None:
+    print("Server closed the connection")
     exit()
 
+if patterns:
+    #Fetch every file matching one of the names or patterns without asking
+    wanted = [name for name in fileNames if any(fnmatchcase(name, pattern) for pattern in patterns)]
+    for pattern in patterns:
+        if not any(fnmatchcase(name, pattern) for name in fileNames):
+            print(f"Nothing matches {pattern}")
+    if not wanted:
+        exit()
+
+    #Ask for the size and hash of every file
+    clientSocket.sendall( protocol.encodeManifestRequest() )
+    response = protocol.readResponse(reader)
+    manifest = None
+    if response is not None and response[0] == protocol.MANIFEST_OK:
+        manifest = protocol.readManifest(reader, response[1], len(fileNames))
+    clientSocket.close()
+    if manifest is None or len(manifest) != len(fileNames):
+        print("Server doesn't send manifests, ask for its files one at a time")
+        exit()
+    sizes = dict(zip(fileNames, manifest))
+    entries = {name: sizes[name] for name in wanted}
+
+else:
+    #display each file name with a ID
+    count = 1
+    for fileName in fileNames:
+        print(f"[{count}] {fileName}")
+        count += 1
+
+
+    if fileArg is not None:
+        msgID = fileArg
+    else:
+        msgID = int(input("What file do you want: "))
+
+    #Check to see if the user put a valid ID
+    if not 1 <= msgID <= len(fileNames):
+        print("invalid ID")
+        exit()
+
+    #Store the file name
+    finalFileName = fileNames[msgID -1]
 
-#Convert the id to bytes
-idBytes = msgID.to_bytes(2, 'little')
 
+    #Ask for the file's size and hash. A server from before the manifest sends
+    #   no bytes of the file instead, which gets the file size back
+    clientSocket.sendall( protocol.encodeManifestRequest(msgID) )
+    response = protocol.readResponse(reader)
+    manifest = None
+    if response is not None and response[0] == protocol.MANIFEST_OK:
+        manifest = protocol.readManifest(reader, response[1], 1)
+    clientSocket.close()
+    if manifest:
+        entries = {finalFileName: manifest[0]}
+    elif response is not None and response[0] == protocol.OK:
+        entries = {finalFileName: (response[1], None, None)}
+    else:
+        print("Server couldn't send the file")
+        exit()
 
-clientSocket.send( idBytes )
+#Skip the files that are here already, and copy the ones that are here under another name
+Path("repository").mkdir(exist_ok=True)
+hashes = HashCache("repository", HASH_CACHE)
+local = LocalFiles(hashes)
+fetching = [] #(name, size, sha256, mtime) of every file to download
+skipped = [] #(name, size, why) of every file that wasn't downloaded
+copies = [] #(name, source) of every file copied from another name
+for fileName, (fileSize, sha256, mtime) in entries.items():
+    same = local.find(fileName, fileSize, sha256) if sha256 is not None else None
+    if same == fileName:
+        skipped.append((fileName, fileSize, "up to date"))
+        if not patterns:
+            print(f"{fileName} is up to date")
+    elif same is not None:
+        shutil.copyfile("repository/" + same, "repository/" + fileName + ".copy")
+        copies.append((fileName, same))
+        skipped.append((fileName, fileSize, f"copied from {same}"))
+    else:
+        fetching.append((fileName, fileSize, sha256, mtime))
 
+#the copies replace their files once every one is made, so a file that is
+#   copied over is never the source of another copy
+for fileName, same in copies:
+    os.replace("repository/" + fileName + ".copy", "repository/" + fileName)
+    if not patterns:
+        print(f"Copied {fileName} from {same}, it has the same contents")
 
-#Receive file size
-fileSizebytes = clientSocket.recv(4)
-fileSize = int.from_bytes(fileSizebytes, 'little')
+#one file is split into a range per connection, many files get a connection each
+rangeCount = CONNECTIONS if len(fetching) == 1 else 1
+downloads = [Download(fileName, fileSize, sha256, mtime, rangeCount) for fileName, fileSize, sha256, mtime in fetching]
 
-#Receive bytes until we get the entire file size
-bytesRecv = 0
-msg = b'' 
-while bytesRecv != fileSize:
-    msg += clientSocket.recv(fileSize - bytesRecv)
-    bytesRecv = len(msg)
+#Receive the files and write them as they arrive, picking up partial downloads where there are some
+for download in downloads:
+    if download.received():
+        print(f"Resuming {download.fileName}, {download.received()} of {download.fileSize} bytes already here")
+alreadyHere = sum(download.received() for download in downloads)
+fetcher = Fetcher(downloads, CONNECTIONS)
+start = time.perf_counter()
+try:
+    fetcher.run()
+except KeyboardInterrupt:
+    pass
+elapsed = time.perf_counter() - start
 
-#Write the file
-with open("repository/" + finalFileName, "wb") as f:
-    f.write(msg)
+if fetcher.codec:
+    stats = fetcher.stats
+    print(f"Received {stats.raw} bytes as {stats.sent} with {compress.CODECS[fetcher.codec][0]}"
+        f" ({stats.ratio():.1%}), {stats.cpu * 1000:.1f} ms CPU to decompress")
+for download in downloads:
+    if download.corrupt:
+        print(f"{download.fileName} didn't match the server's hash and was thrown away")
+    elif not download.complete:
+        print(f"Stopped after {download.received()} of {download.fileSize} bytes of {download.fileName}, run again to resume")
+    elif download.sha256 is not None:
+        stat = os.stat("repository/" + download.fileName)
+        hashes.put(download.fileName, stat.st_size, stat.st_mtime_ns, download.sha256)
+hashes.save()
 
+#Report how fast every file came and the whole batch
+if patterns:
+    MB = 1024 * 1024
+    print(f"{'MB':>10}{'seconds':>10}{'MB/s':>10}  file")
+    for download in downloads:
+        rate = f"{download.fileSize / MB / download.elapsed:>10.1f}" if download.elapsed else f"{'-':>10}"
+        status = "" if download.complete else " (hash mismatch)" if download.corrupt else " (incomplete)"
+        print(f"{download.fileSize / MB:>10.2f}{download.elapsed:>10.2f}{rate}  {download.fileName}{status}")
+    for fileName, fileSize, why in skipped:
+        print(f"{fileSize / MB:>10.2f}{'-':>10}{'-':>10}  {fileName} ({why})")
+    received = (sum(download.received() for download in downloads) - alreadyHere) / MB
+    done = sum(1 for download in downloads if download.complete)
+    print(f"{done} of {len(downloads)} files downloaded, {len(skipped)} already here."
+        f" {received:.2f} MB in {elapsed:.2f} s, {received / elapsed if elapsed else 0:.1f} MB/s"
+        f" over {fetcher.connections} connections")
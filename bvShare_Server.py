@@ -1,47 +1,229 @@
+from sys import argv
 from socket import *
-from pathlib import Path
-from os import path
+from os import fstat, stat as stat_file
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from bvBufferedReader import BufferedReader
+from bvShareIndex import RepositoryIndex
+import bvShareProtocol as protocol
+import bvShareCompress as compress
 
+# usage: bvShare_Server.py [PORT] [--workers=N] [--backlog=N] [--poll=SECONDS] [--no-hash] [--cache=MB]
 port = 11111
+WORKERS = 256 # clients served at once, the rest wait in the backlog for a free worker
+BACKLOG = 1024 # connections the OS queues before they are accepted
+POLL_INTERVAL = 1 # seconds between checks of repository/ for changes
+HASH_CONTENTS = True # keep a sha256 of every file in the index, for the manifest
+CACHE_MB = 256 # memory for compressed copies of the files asked for most
+for arg in argv[1:]:
+    if arg.startswith("--workers="):
+        WORKERS = int(arg.split('=')[1])
+    elif arg.startswith("--backlog="):
+        BACKLOG = int(arg.split('=')[1])
+    elif arg.startswith("--poll="):
+        POLL_INTERVAL = float(arg.split('=')[1])
+    elif arg == "--hash":
+        HASH_CONTENTS = True
+    elif arg == "--no-hash":
+        HASH_CONTENTS = False
+    elif arg.startswith("--cache="):
+        CACHE_MB = float(arg.split('=')[1])
+    else:
+        port = int(arg)
+
+# Seconds a client has to pick a file before its worker is given to someone else,
+#   that a client can stop reading in the middle of a file, and that a
+#   connection can sit idle between requests once its first file was sent
+REQUEST_TIMEOUT = 300
+SEND_TIMEOUT = 60
+KEEPALIVE_TIMEOUT = 30
+
 serverSock = socket(AF_INET, SOCK_STREAM)
+serverSock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
 
 serverSock.bind(('',port))
-serverSock.listen()
+serverSock.listen(BACKLOG)
 print(f'Running on {port}')
 
 
-while True:
-    clientConn, clientAddr = serverSock.accept()
-    p = Path('./repository/')
-    repo = p.iterdir()
-    files = []
+# The files in repository/ and their encoded listing, rebuilt only when they
+#   change. Their hashes are kept next to repository/, so a restart doesn't
+#   read every file again
+index = RepositoryIndex('./repository/', POLL_INTERVAL, HASH_CONTENTS, './repository.hashes')
+index.start()
 
-    for abso in repo:
-        if '/' in str(abso):
-            file = str(abso).split('/')[-1]
-        else:
-            file = str(abso).split('\\')[-1]
-        files.append(file)
-    
+# Compressed copies of whole files, so a popular file is compressed once and not for every client
+frameCache = compress.FrameCache(int(CACHE_MB * 1024 * 1024))
+
+
+# Sends `count' bytes of the open file `f' starting at `offset'. socket.sendfile
+#   has the kernel copy the file straight to the socket, and falls back to
+#   sending it in chunks through a memoryview where that isn't possible, so
+#   the file is never read into memory as a whole
+def sendFile(clientConn, f, offset, count):
+    if count:
+        clientConn.sendfile(f, offset, count)
+
+
+# Sends `count' bytes of the open file `f' starting at `offset' as frames
+#   compressed with `codec'. A whole file is served from frameCache once it
+#   is there, and put there once it has been asked for often enough.
+#   returns what it cost as a compress.Stats
+def sendFrames(clientConn, f, offset, count, codec, name, stat):
+    stats = compress.Stats()
+    whole = offset == 0 and count == stat.st_size
+    if whole:
+        frames = frameCache.get(name, codec, stat.st_size, stat.st_mtime_ns)
+        if frames is not None:
+            clientConn.sendall(frames)
+            stats.add(count, len(frames), 0.0)
+            return stats
+    # frames are only kept for a file that can fit in the cache, and given
+    #   up on once they don't, so memory stays bounded for big files
+    keep = None
+    if whole and stat.st_size <= frameCache.budget and frameCache.wanted(name, codec, stat.st_size, stat.st_mtime_ns):
+        keep = []
+    kept = 0
+
+    f.seek(offset)
+    for frame in compress.encodeFrames(codec, f, count, stats):
+        clientConn.sendall(frame)
+        if keep is not None:
+            keep.append(frame)
+            kept += len(frame)
+            if kept > frameCache.budget:
+                keep = None
+    if keep is not None and stats.raw == count: # not if the file shrank
+        frameCache.put(name, codec, stat.st_size, stat.st_mtime_ns, b''.join(keep))
+    return stats
+
+
+# Sends the manifest of file `fId' in the client's listing, or of all of them
+#   for 0. The manifest of every file is as of the index's last poll, a single
+#   file is checked against the disk so it is right even if it just changed.
+#   The entries carry mtimes if `mtime' is set
+def sendManifest(clientConn, files, listing, fId, mtime=False):
+    if fId == 0:
+        manifest = index.manifest(files, listing, mtime)
+    elif 1 <= fId <= len(files):
+        entry = files[fId - 1]
+        try:
+            stat = stat_file('repository/' + entry.name)
+        except OSError: # removed since the listing was sent
+            clientConn.sendall(protocol.encodeResponse(protocol.NO_FILE))
+            return
+        if (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime):
+            entry = entry._replace(size=stat.st_size, mtime=stat.st_mtime_ns,
+                sha256=index.hashes.get(entry.name, stat.st_size, stat.st_mtime_ns))
+        manifest = protocol.encodeManifest([entry], mtime)
+    else:
+        clientConn.sendall(protocol.encodeResponse(protocol.NO_FILE))
+        return
+    clientConn.sendall(protocol.encodeResponse(protocol.MANIFEST_OK, len(manifest)) + manifest)
+
+
+# Serves one client: sends the listing, then serves its requests until it
+#   hangs up. v1 clients get one file, v2 clients can ask for as many as they
+#   like on the same connection, and send the next requests before the
+#   file they are receiving has arrived
+def handleClient(clientConn):
+    clientConn.settimeout(REQUEST_TIMEOUT)
+    reader = BufferedReader(clientConn)
+    files, listing = index.snapshot()
 
     # Sends Client number of files in repository/
-    clientConn.send(len(files).to_bytes(4,'little'))
-    for f in files:
-        clientConn.send(len(f).to_bytes(2,'little'))
-        clientConn.send(f.encode())
-    
-    fId = int.from_bytes(clientConn.recv(4), 'little')
-   
+    clientConn.sendall(listing)
+
+    while serveRequest(clientConn, reader, files, listing):
+        clientConn.settimeout(KEEPALIVE_TIMEOUT)
+
+
+# Reads one request and answers it. returns True if the connection can take another
+def serveRequest(clientConn, reader, files, listing):
+    # v2 clients start their request with the magic bytes, v1 clients just send a 2 byte ID
+    start = bytes(reader.getFullMsg(len(protocol.MAGIC)))
+    if start == protocol.MAGIC:
+        rest = reader.getFullMsg(protocol.REQUEST.size - len(protocol.MAGIC))
+        if len(rest) < protocol.REQUEST.size - len(protocol.MAGIC):
+            return False
+        magic, version, flags, fId = protocol.REQUEST.unpack(start + rest)
+        offset, length = 0, None # the whole file
+        if flags & protocol.RANGE:
+            fields = reader.getFullMsg(protocol.RANGE_FIELDS.size)
+            if len(fields) < protocol.RANGE_FIELDS.size:
+                return False
+            offset, length = protocol.RANGE_FIELDS.unpack(fields)
+        if flags & protocol.MANIFEST:
+            sendManifest(clientConn, files, listing, fId, bool(flags & protocol.MTIME))
+            return True
+    elif len(start) == protocol.LEGACY_ID.size:
+        version, flags, fId = 1, 0, protocol.LEGACY_ID.unpack(start)[0]
+        offset, length = 0, None
+    else:
+        return False
+
+    if not 1 <= fId <= len(files):
+        if version > 1:
+            clientConn.sendall(protocol.encodeResponse(protocol.NO_FILE))
+        return version > 1
+
     # Finds the file client requested and sends the size of said file
-    fileToSend = 'repository/'+files[fId - 1]
-    file_size = path.getsize(fileToSend)
-    clientConn.send(file_size.to_bytes(4, 'little'))
-    
-    # Sending file_size bytes
-    with open(fileToSend, 'rb') as f:
-        clientConn.send(f.read(file_size))
-
-    clientConn.close()
+    name = files[fId - 1].name
+    fileToSend = 'repository/'+name
+    try:
+        f = open(fileToSend, 'rb')
+    except OSError: # removed since the listing was sent
+        if version > 1:
+            clientConn.sendall(protocol.encodeResponse(protocol.NO_FILE))
+        return version > 1
+    with f:
+        stat = fstat(f.fileno())
+        file_size = stat.st_size
+        codec = 0
+        if version > 1:
+            response = protocol.encodeResponse(protocol.OK, file_size)
+            if flags & protocol.COMPRESSION: # the client offered codecs, say which one is used
+                codec = compress.choose(flags, name)
+                response += protocol.CODEC.pack(codec)
+            clientConn.sendall(response)
+        elif file_size > protocol.LEGACY_MAX_SIZE:
+            return False # too big for a 4 byte size, v1 clients see the connection close
+        else:
+            clientConn.sendall(protocol.LEGACY_SIZE.pack(file_size))
+
+        # Sending the requested bytes, all file_size of them unless a range was asked for
+        offset = min(offset, file_size)
+        count = file_size - offset if length is None else min(length, file_size - offset)
+        clientConn.settimeout(SEND_TIMEOUT)
+        if not codec:
+            sendFile(clientConn, f, offset, count)
+            return version > 1
+        stats = sendFrames(clientConn, f, offset, count, codec, name, stat)
+        if stats.raw:
+            print(f"{name}: {stats.raw} bytes sent as {stats.sent} with {compress.CODECS[codec][0]}"
+                f" ({stats.ratio():.1%}), {stats.cpu * 1000:.1f} ms CPU")
+        return True
+
+
+# Runs on a worker thread, so a slow client only holds up its own worker
+def serveClient(clientConn):
+    try:
+        handleClient(clientConn)
+    except OSError:
+        pass # the client went away
+    finally:
+        clientConn.close()
+        freeWorkers.release()
+
+
+# A connection is only accepted once a worker is free for it, so the ones
+#   waiting stay in the OS backlog instead of piling up in the executor
+workers = ThreadPoolExecutor(max_workers=WORKERS)
+freeWorkers = BoundedSemaphore(WORKERS)
+while True:
+    freeWorkers.acquire()
+    clientConn, clientAddr = serverSock.accept()
+    workers.submit(serveClient, clientConn)
 
 
 print('Closing')
@@ -0,0 +1,361 @@
+from sys import argv, executable
+from socket import *
+from pathlib import Path
+import importlib
+import subprocess
+import tempfile
+import threading
+import random
+import queue
+import hashlib
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+from bvBufferedReader import BufferedReader
+from bvPiecePicker import PiecePicker
+from bvPieceStorage import PieceStorage
+from bvBitfield import Bitfield
+
+# local test harness and benchmarks for bvTorrent-client.py
+# usage: bvTorrent-bench.py swarm [SIZE_MB] [CHUNK_KB] [LATENCY_MS] [CLIENT_ARGS...]
+#   downloads a random file with bvTorrent-client.py from 1, 2, 4 and 8
+#   in-process seeders and reports the time and throughput for each
+# usage: bvTorrent-bench.py rarest [CHUNKS] [LEECHERS] [SEEDER_ROUNDS] [TRIALS]
+#   simulates a swarm in rounds with random and rarest-first chunk picking,
+#   with the only seeder leaving after SEEDER_ROUNDS rounds, and reports how
+#   many swarms finished and how many rounds they took
+# usage: bvTorrent-bench.py resume [SIZE_MB] [CHUNK_KB] [WORKERS]
+#   times how fast a restarted client hashes a finished file again, with
+#   1 worker process and with WORKERS (all cores by default)
+# usage: bvTorrent-bench.py verify [SIZE_MB] [CHUNK_KB] [WORKERS]
+#   times how fast downloaded chunks are checked and written to the file by
+#   the client's verification threads, with 1 thread and with WORKERS
+# usage: bvTorrent-bench.py tracker [CHUNKS] [PEERS] [REFRESHES]
+#   compares the bytes a client gets from the tracker per refresh with a full
+#   CLIENT_LIST and with CLIENT_LIST_SINCE, while every peer gets a chunk
+#   between refreshes
+# usage: bvTorrent-bench.py upload [SIZE_MB] [CHUNK_KB] [PEERS] [CLIENT_ARGS...]
+#   seeds a file with bvTorrent-client.py and has PEERS downloaders fetch all
+#   of it at once, while one more peer asks for everything and never reads
+
+# the tracker's file name isn't a valid module name, so import it by path name
+trackerModule = importlib.import_module("bvTorrent-tracker")
+
+clientPath = Path(__file__).parent / "bvTorrent-client.py"
+
+# A seeder that has the whole file and serves chunks to bvTorrent clients.
+#   Every request is answered `latency' seconds after it arrived, like a peer
+#   on the other side of a real network would. Requests pipelined on one
+#   connection wait out their latency together, not one after another.
+class Seeder:
+    def __init__(self, data, chunkSize, latency):
+        self.data = data
+        self.chunkSize = chunkSize
+        self.latency = latency
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.acceptPeers, daemon=True).start()
+
+    def acceptPeers(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.servePeer, args=(conn,), daemon=True).start()
+
+    # reads every chunk index the peer sends until it hangs up, and has
+    #   sendChunks answer them when they are due
+    def servePeer(self, conn):
+        reader = BufferedReader(conn)
+        requests = queue.Queue()
+        threading.Thread(target=self.sendChunks, args=(conn, requests), daemon=True).start()
+        try:
+            while True:
+                line = reader.getLine()
+                if line == "":
+                    break
+                requests.put((time.perf_counter() + self.latency, int(line)))
+        except (OSError, ValueError):
+            pass
+        finally:
+            requests.put(None)
+
+    def sendChunks(self, conn, requests):
+        try:
+            while True:
+                request = requests.get()
+                if request is None:
+                    break
+                due, index = request
+                time.sleep(max(0, due - time.perf_counter()))
+                start = index * self.chunkSize
+                conn.sendall(memoryview(self.data)[start:start + self.chunkSize])
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.listener.close()
+
+# starts bvTorrent-client.py and waits until it reports the download
+#   finished. returns the running client and the number of seconds it took,
+#   or None if the client quit first
+def startClient(trackerPort, workDir, clientArgs):
+    start = time.perf_counter()
+    client = subprocess.Popen([executable, "-u", str(clientPath), "127.0.0.1", str(trackerPort)] + clientArgs,
+        cwd=workDir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        env=dict(os.environ, PYTHONPATH=str(clientPath.parent)))
+    for line in client.stdout:
+        if line.startswith("Download complete"):
+            return client, time.perf_counter() - start
+    return client, None
+
+# runs bvTorrent-client.py until it reports the download finished, returns
+#   the number of seconds it took
+def runClient(trackerPort, workDir, clientArgs):
+    client, elapsed = startClient(trackerPort, workDir, clientArgs)
+    client.kill()
+    client.wait()
+    return elapsed
+
+# downloads the same file from a growing number of seeders
+def benchSwarm(sizeMB, chunkKB, latency, clientArgs):
+    data = os.urandom(int(sizeMB * 1024 * 1024))
+    chunkSize = chunkKB * 1024
+    with tempfile.TemporaryDirectory() as workDir:
+        filePath = Path(workDir) / "swarm.bin"
+        filePath.write_bytes(data)
+        downloadDir = Path(workDir) / "download"
+        downloadDir.mkdir()
+
+        print(f"{sizeMB} MB file, {chunkKB} KB chunks, {latency * 1000:.0f} ms per request")
+        print(f"{'seeders':>8}{'seconds':>10}{'MB/s':>10}")
+        for seederCount in (1, 2, 4, 8):
+            tracker = trackerModule.Tracker(str(filePath), chunkSize)
+            trackerPort = tracker.start()
+            seeders = [Seeder(data, chunkSize, latency) for i in range(seederCount)]
+            for seeder in seeders:
+                tracker.addClient("127.0.0.1", seeder.port, "1" * tracker.chunkNum)
+
+            elapsed = runClient(trackerPort, str(downloadDir), clientArgs)
+            if elapsed is None:
+                print(f"{seederCount:>8}{'failed':>10}")
+            else:
+                print(f"{seederCount:>8}{elapsed:>10.2f}{sizeMB / elapsed:>10.2f}")
+
+            tracker.stop()
+            for seeder in seeders:
+                seeder.stop()
+
+# chunks every peer can upload per round in the simulation
+SIM_UPLOAD_SLOTS = 2
+
+# Simulates one swarm of `leecherCount' downloaders and one seeder. Every
+#   round each downloader picks a chunk it is missing and gets it from a peer
+#   that has it and still has an upload slot free, and the chunks arrive at
+#   the end of the round. The seeder leaves after `seederRounds' rounds.
+#   returns the number of rounds until every downloader had the whole file,
+#   or None if the swarm stalled because a chunk left with the seeder
+def simulateSwarm(chunkNum, leecherCount, seederRounds, rarest):
+    masks = {"seeder": Bitfield.fromMask("1" * chunkNum)}
+    pickers = {}
+    for n in range(leecherCount):
+        masks[n] = Bitfield(chunkNum)
+        pickers[n] = PiecePicker(chunkNum)
+
+    rounds = 0
+    while any(picker.missing for picker in pickers.values()):
+        rounds += 1
+        if rounds > seederRounds:
+            masks.pop("seeder", None)
+        uploads = dict.fromkeys(masks, 0)
+        received = []
+        leechers = [n for n in pickers if pickers[n].missing]
+        random.shuffle(leechers)
+        for n in leechers:
+            picker = pickers[n]
+            picker.updatePeers({peer: mask for peer, mask in masks.items() if peer != n})
+            order = picker.pickOrder()
+            if not rarest:
+                random.shuffle(order)
+            for i in order:
+                peers = [peer for peer in masks if peer != n and masks[peer][i] and uploads[peer] < SIM_UPLOAD_SLOTS]
+                if peers:
+                    uploads[random.choice(peers)] += 1
+                    received.append((n, i))
+                    break
+        if not received:
+            return None
+        for n, i in received:
+            masks[n].set(i)
+            pickers[n].markHave(i)
+    return rounds
+
+# compares random and rarest-first picking over the same number of simulated swarms
+def benchRarest(chunkNum, leecherCount, seederRounds, trials):
+    print(f"{chunkNum} chunks, {leecherCount} downloaders, seeder leaves after {seederRounds} rounds, {trials} swarms")
+    print(f"{'picking':>14}{'finished':>10}{'avg rounds':>12}")
+    for name, rarest in (("random", False), ("rarest-first", True)):
+        random.seed(1) #both strategies see the same sequence of swarms
+        results = [simulateSwarm(chunkNum, leecherCount, seederRounds, rarest) for t in range(trials)]
+        finished = [rounds for rounds in results if rounds is not None]
+        average = f"{sum(finished) / len(finished):.1f}" if finished else "-"
+        print(f"{name:>14}{len(finished):>10}{average:>12}")
+
+# re-verifies a whole file the way resumeChunks does at startup
+def benchResume(sizeMB, chunkKB, workers):
+    chunkSize = chunkKB * 1024
+    with tempfile.TemporaryDirectory() as workDir:
+        filePath = Path(workDir) / "resume.bin"
+        filePath.write_bytes(os.urandom(int(sizeMB * 1024 * 1024)))
+        tracker = trackerModule.Tracker(str(filePath), chunkSize)
+        chunkSizes = [size for size, checkSum in tracker.checkSums]
+        digests = [bytes.fromhex(checkSum) for size, checkSum in tracker.checkSums]
+        storage = PieceStorage(str(filePath), chunkSize, chunkSizes)
+
+        print(f"{sizeMB} MB file, {chunkKB} KB chunks")
+        print(f"{'workers':>8}{'seconds':>10}{'MB/s':>10}")
+        for workerCount in sorted({1, workers}):
+            start = time.perf_counter()
+            good = storage.verify(list(range(len(chunkSizes))), digests, workerCount)
+            elapsed = time.perf_counter() - start
+            if len(good) != len(chunkSizes):
+                print(f"{workerCount:>8}{'failed':>10}")
+            else:
+                print(f"{workerCount:>8}{elapsed:>10.2f}{sizeMB / elapsed:>10.1f}")
+        storage.close()
+
+# checks and stores every chunk of a file the way getChunk hands them to verifyPool
+def benchVerify(sizeMB, chunkKB, workers):
+    chunkSize = chunkKB * 1024
+    data = os.urandom(int(sizeMB * 1024 * 1024))
+    chunks = [data[start:start + chunkSize] for start in range(0, len(data), chunkSize)]
+    digests = [hashlib.sha224(chunk).digest() for chunk in chunks]
+    with tempfile.TemporaryDirectory() as workDir:
+        storage = PieceStorage(str(Path(workDir) / "verify.bin"), chunkSize, [len(chunk) for chunk in chunks])
+
+        print(f"{sizeMB} MB of {chunkKB} KB chunks")
+        print(f"{'workers':>8}{'seconds':>10}{'MB/s':>10}")
+        for workerCount in sorted({1, workers}):
+            with ThreadPoolExecutor(max_workers=workerCount) as pool:
+                start = time.perf_counter()
+                results = list(pool.map(storage.verifyAndWrite, range(len(chunks)), chunks, digests))
+                elapsed = time.perf_counter() - start
+            if not all(results):
+                print(f"{workerCount:>8}{'failed':>10}")
+            else:
+                print(f"{workerCount:>8}{elapsed:>10.2f}{sizeMB / elapsed:>10.1f}")
+        storage.close()
+
+# sizes a swarm's tracker replies without any sockets
+def benchTracker(chunkNum, peerCount, refreshes):
+    with tempfile.TemporaryDirectory() as workDir:
+        filePath = Path(workDir) / "tracker.bin"
+        filePath.write_bytes(bytes(chunkNum))
+        tracker = trackerModule.Tracker(str(filePath), 1)
+    for n in range(peerCount):
+        tracker.addClient("10.0.0.1", 6000 + n, "0" * chunkNum)
+
+    fullBytes = deltaBytes = 0
+    version = tracker.version
+    for refresh in range(refreshes):
+        for n in range(peerCount): #every peer got one more chunk
+            tracker.addHave(f"10.0.0.1:{6000 + n}", (n + refresh) % chunkNum)
+        fullBytes += len(tracker.clientList("{count}"))
+        deltaBytes += len(tracker.clientListSince(version))
+        version = tracker.version
+
+    print(f"{chunkNum} chunks, {peerCount} peers, {refreshes} refreshes")
+    print(f"{'reply':>18}{'bytes/refresh':>15}")
+    print(f"{'CLIENT_LIST':>18}{fullBytes // refreshes:>15}")
+    print(f"{'CLIENT_LIST_SINCE':>18}{deltaBytes // refreshes:>15}")
+
+# one downloader for benchUpload. Pipelines a request for every chunk on one
+#   connection and reads the answers, or never reads them if `stall' is set
+def fetchAll(port, chunkCount, totalSize, stall, received):
+    conn = create_connection(('127.0.0.1', port))
+    conn.sendall("".join(f"{i}\n" for i in range(chunkCount)).encode())
+    if stall:
+        time.sleep(60)
+    else:
+        received.append(len(BufferedReader(conn).getFullMsg(totalSize)))
+    conn.close()
+
+# downloads from a seeding bvTorrent-client.py with many peers at once
+def benchUpload(sizeMB, chunkKB, peerCount, clientArgs):
+    data = os.urandom(int(sizeMB * 1024 * 1024))
+    chunkSize = chunkKB * 1024
+    with tempfile.TemporaryDirectory() as workDir:
+        filePath = Path(workDir) / "upload.bin"
+        filePath.write_bytes(data)
+        tracker = trackerModule.Tracker(str(filePath), chunkSize)
+        trackerPort = tracker.start()
+        client, elapsed = startClient(trackerPort, workDir, clientArgs) #finds the whole file already there
+        with tracker.lock:
+            seedPort = int(next(iter(tracker.clients)).split(':')[1])
+
+        threading.Thread(target=fetchAll, args=(seedPort, tracker.chunkNum, len(data), True, []), daemon=True).start()
+        received = []
+        fetchers = [threading.Thread(target=fetchAll, args=(seedPort, tracker.chunkNum, len(data), False, received))
+            for n in range(peerCount)]
+        start = time.perf_counter()
+        for fetcher in fetchers:
+            fetcher.start()
+        for fetcher in fetchers:
+            fetcher.join()
+        elapsed = time.perf_counter() - start
+        client.kill()
+        client.wait()
+        tracker.stop()
+
+        print(f"{sizeMB} MB file, {chunkKB} KB chunks, {peerCount} peers and 1 stalled peer")
+        complete = sum(1 for count in received if count == len(data))
+        print(f"{complete} of {peerCount} peers got the whole file in {elapsed:.2f} s, {complete * sizeMB / elapsed:.1f} MB/s uploaded")
+
+if len(argv) < 2:
+    print("usage: bvTorrent-bench.py swarm [SIZE_MB] [CHUNK_KB] [LATENCY_MS] [CLIENT_ARGS...]")
+    print("       bvTorrent-bench.py rarest [CHUNKS] [LEECHERS] [SEEDER_ROUNDS] [TRIALS]")
+    print("       bvTorrent-bench.py resume [SIZE_MB] [CHUNK_KB] [WORKERS]")
+    print("       bvTorrent-bench.py verify [SIZE_MB] [CHUNK_KB] [WORKERS]")
+    print("       bvTorrent-bench.py tracker [CHUNKS] [PEERS] [REFRESHES]")
+    print("       bvTorrent-bench.py upload [SIZE_MB] [CHUNK_KB] [PEERS] [CLIENT_ARGS...]")
+    exit()
+
+mode = argv[1]
+if mode == "swarm":
+    sizeMB = float(argv[2]) if len(argv) > 2 else 4
+    chunkKB = int(argv[3]) if len(argv) > 3 else 64
+    latency = (float(argv[4]) if len(argv) > 4 else 20) / 1000
+    benchSwarm(sizeMB, chunkKB, latency, argv[5:])
+elif mode == "rarest":
+    chunkNum = int(argv[2]) if len(argv) > 2 else 64
+    leecherCount = int(argv[3]) if len(argv) > 3 else 16
+    seederRounds = int(argv[4]) if len(argv) > 4 else 40
+    trials = int(argv[5]) if len(argv) > 5 else 20
+    benchRarest(chunkNum, leecherCount, seederRounds, trials)
+elif mode == "resume":
+    sizeMB = float(argv[2]) if len(argv) > 2 else 256
+    chunkKB = int(argv[3]) if len(argv) > 3 else 256
+    workers = int(argv[4]) if len(argv) > 4 else os.cpu_count()
+    benchResume(sizeMB, chunkKB, workers)
+elif mode == "verify":
+    sizeMB = float(argv[2]) if len(argv) > 2 else 256
+    chunkKB = int(argv[3]) if len(argv) > 3 else 256
+    workers = int(argv[4]) if len(argv) > 4 else os.cpu_count()
+    benchVerify(sizeMB, chunkKB, workers)
+elif mode == "tracker":
+    chunkNum = int(argv[2]) if len(argv) > 2 else 4096
+    peerCount = int(argv[3]) if len(argv) > 3 else 50
+    refreshes = int(argv[4]) if len(argv) > 4 else 20
+    benchTracker(chunkNum, peerCount, refreshes)
+elif mode == "upload":
+    sizeMB = float(argv[2]) if len(argv) > 2 else 16
+    chunkKB = int(argv[3]) if len(argv) > 3 else 64
+    peerCount = int(argv[4]) if len(argv) > 4 else 8
+    benchUpload(sizeMB, chunkKB, peerCount, argv[5:])
+else:
+    print(f"unknown benchmark {mode}")
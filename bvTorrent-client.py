@@ -2,50 +2,88 @@ from sys import getsizeof
 from sys import argv
 from socket import *
 import threading
-import hashlib
-import random
 import time
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bvBufferedReader import BufferedReader
+from bvPiecePicker import PiecePicker, ENDGAME_DUPLICATES
+from bvPieceStorage import PieceStorage
+from bvBitfield import Bitfield
+from bvUploader import Uploader
 
 #Listener connection for client to client
 listener = socket(AF_INET, SOCK_STREAM)
 listener.bind(('', 0)) #Bind to an open address
 listenSocket = listener.getsockname()[1] #gets listener socket
 
+#Most chunk requests in flight at once across all peers, and pipelined on one peer's connection
+MAX_REQUESTS = 16
+MAX_PEER_REQUESTS = 8
+
+#Seconds to wait for a peer to accept a connection before trying another peer
+CONNECT_TIMEOUT = 2
+
+#Seconds a peer can go quiet with requests outstanding before its connection is dropped
+REQUEST_TIMEOUT = 1
+
+#Seconds to wait before asking the tracker again when no peer had anything new
+REFRESH_DELAY = 1
+
+#Seconds between saves of the chunk mask while chunks arrive, so a killed client doesn't fetch them again
+MASK_SAVE_INTERVAL = 5
+
+#Threads that check downloaded chunks against their checksums
+VERIFY_WORKERS = os.cpu_count()
+
+#Bad chunks a peer can send before it isn't asked for anything anymore
+MAX_BAD_CHUNKS = 3
+
+#Seconds to wait for the tracker to answer FEATURES before assuming it doesn't know it
+FEATURES_TIMEOUT = 1
+
+#Most chunks sent to other peers at once, and the most KB/s sent over one peer's connection (0 for no limit)
+UPLOAD_SLOTS = 8
+PEER_UPLOAD_RATE = 0
+
+#Seconds to keep seeding after the download is done (0 to seed until Ctrl-C), and between upload reports
+SEED_TIME = 0
+STATS_INTERVAL = 10
+
 #Check for correct args (Ip and port)
 if len(argv) < 3:
-    print("Usage: bvTorrent-client.py [IPADDR] [PORT]")
+    print("Usage: bvTorrent-client.py [IPADDR] [PORT] [--requests=N] [--peer-requests=N] [--verify-workers=N]")
+    print("       [--upload-slots=N] [--peer-upload-rate=KB/s] [--seed-time=SECONDS]")
     exit()
 ip = argv[1]
 port = int(argv[2])
+for arg in argv[3:]: #Optional limits on requests in flight
+    if arg.startswith("--requests="):
+        MAX_REQUESTS = int(arg.split('=')[1])
+    elif arg.startswith("--peer-requests="):
+        MAX_PEER_REQUESTS = int(arg.split('=')[1])
+    elif arg.startswith("--verify-workers="):
+        VERIFY_WORKERS = int(arg.split('=')[1])
+    elif arg.startswith("--upload-slots="):
+        UPLOAD_SLOTS = int(arg.split('=')[1])
+    elif arg.startswith("--peer-upload-rate="):
+        PEER_UPLOAD_RATE = int(arg.split('=')[1])
+    elif arg.startswith("--seed-time="):
+        SEED_TIME = float(arg.split('=')[1])
 
-#Function from tracker code. Small modification with timeout
-def getFullMsg(conn, msgLength):
-    msg = b''    
-    while len(msg) < msgLength:
-        conn.settimeout(.25) #timeout after .25 seconds
-        try:
-            retVal = conn.recv(msgLength - len(msg))
-        except:
-            break
-        msg += retVal
-        if len(retVal) == 0:
-            break
-    return msg
+#Chunks are hashed here so the scheduler keeps requesting while they are checked
+verifyPool = ThreadPoolExecutor(max_workers=VERIFY_WORKERS)
 
 #Function from the tracker code
-def getLine(conn):
-    msg = b''
-    while True:
-        ch = conn.recv(1)
-        msg += ch
-        if ch == b'\n' or len(ch) == 0:
-            break
-    return msg.decode()
+#Lines are cut out of the reader's buffer instead of reading one byte per recv
+def getLine(reader):
+    return reader.getLine(keepNewline=True)
 
 ########## Create connection ############
 # takes in ip and port then makes a new connection based off those and returns it
-def createConnection(ip, port):
+def createConnection(ip, port, timeout=None):
     tmpsocket = socket(AF_INET, SOCK_STREAM)
+    tmpsocket.settimeout(timeout)
     tmpsocket.connect((ip, port))
     return tmpsocket
 
@@ -54,101 +92,352 @@ def createConnection(ip, port):
 def getInitial():
     print("Getting initial data from server")
     serverSocket = createConnection(ip, port)
-    fileName = getLine(serverSocket)
-    chunkSize = getLine(serverSocket)
-    chunkNum = getLine(serverSocket)
-    chunkMask = "0"*int(chunkNum)+"\n"
-    checkSum = []
-    for i in range(0, int(chunkNum)): #Gets all checksum values
-        check = getLine(serverSocket).split(',')[1]
-        checkSum.append(check)
-    
-    sendInfo = f'{listenSocket},{chunkMask}' #sends client info to server for other clients to use
+    serverReader = BufferedReader(serverSocket)
+    fileName = getLine(serverReader)
+    chunkSize = getLine(serverReader)
+    chunkNum = getLine(serverReader)
+    checkSum = [] #binary sha224 digests, decoded once here instead of for every chunk
+    chunkSizes = [] #the last chunk is usually shorter than chunkSize
+    for i in range(0, int(chunkNum)): #Gets all size and checksum values
+        size, check = getLine(serverReader).split(',')
+        chunkSizes.append(int(size))
+        checkSum.append(bytes.fromhex(check.strip()))
+    return chunkNum, chunkSize, serverReader, fileName, checkSum, chunkSizes
+
+####### Sends client info to server for other clients to use ########
+def sendInitial(chunkMask, serverSocket):
+    sendInfo = f'{listenSocket},{chunkMask.toMask()}\n'
     serverSocket.send(sendInfo.encode())
-    return chunkNum, chunkSize, chunkMask, serverSocket, fileName, checkSum
+
+####### Asks the tracker which protocol extensions it knows ########
+# returns a set like {"HAVE", "DELTA"}, empty if the tracker doesn't answer,
+#   or None if it hung up on the unknown command
+def getFeatures(serverReader):
+    serverReader.conn.send(("FEATURES\n").encode())
+    serverReader.conn.settimeout(FEATURES_TIMEOUT)
+    try:
+        reply = serverReader.getLine()
+    except TimeoutError:
+        return set()
+    finally:
+        serverReader.conn.settimeout(None)
+    if reply == "":
+        return None
+    words = reply.split()
+    return set(words[1:]) if words and words[0] == "FEATURES" else set()
+
+####### Picks up a download an earlier run left unfinished ########
+# returns the chunk mask of the chunks already in the file. The chunks the
+#   saved mask claims are hashed again across all cores before they count
+def resumeChunks(storage, checkSum, picker):
+    savedMask = Bitfield.fromMask(storage.loadMask())
+    chunkMask = Bitfield(savedMask.size)
+    claimed = savedMask.difference(chunkMask)
+    if not claimed:
+        return chunkMask
+    print(f"Checking {len(claimed)} chunks left from an earlier run")
+    for i in storage.verify(claimed, checkSum):
+        chunkMask.set(i)
+        storage.have[i] = True
+        picker.markHave(i)
+    print(f"Recovered {chunkMask.count()} of {chunkMask.size} chunks")
+    return chunkMask
 
 ###### Get Client List ########3
-#Takes in a server socket and returns the list of clients from server
-def getClients(serverSocket):
-    clientList = []
-    serverSocket.send(("CLIENT_LIST\n").encode())
-    numClients = getLine(serverSocket)
-    for i in range(0, int(numClients)): #appends all clients to clientList
-        clientList.append(getLine(serverSocket))
-    return clientList
+#The client list as of trackerVersion, kept up to date with CLIENT_LIST_SINCE
+trackerPeers = {} #(ip, port) -> Bitfield
+trackerVersion = 0
+
+#Takes in the server's reader and returns the clients from server as a dict
+#   of (ip, port) -> Bitfield. If the tracker knows DELTA only what changed
+#   since the last call is sent, otherwise the whole list every time
+def getClients(serverReader, features):
+    global trackerVersion
+    if "DELTA" not in features:
+        clients = {}
+        serverReader.conn.send(("CLIENT_LIST\n").encode())
+        numClients = getLine(serverReader)
+        for i in range(0, int(numClients)): #adds all clients to clients
+            ipInfo, clientMask = getLine(serverReader).split(',')
+            clients[tuple(ipInfo.split(':'))] = Bitfield.fromMask(clientMask)
+        return clients
+
+    serverReader.conn.send((f"CLIENT_LIST_SINCE {trackerVersion}\n").encode())
+    kind, version, count = getLine(serverReader).split()
+    if kind == "FULL":
+        trackerPeers.clear()
+    for i in range(0, int(count)):
+        line = getLine(serverReader).strip()
+        if kind == "FULL":
+            line = "PEER " + line
+        change, ipInfo = line.split(' ', 1)
+        ipInfo, _, value = ipInfo.partition(',')
+        peer = tuple(ipInfo.split(':'))
+        if change == "PEER":
+            trackerPeers[peer] = Bitfield.fromMask(value)
+        elif change == "HAVE" and peer in trackerPeers:
+            trackerPeers[peer].set(int(value))
+        elif change == "GONE":
+            trackerPeers.pop(peer, None)
+    trackerVersion = int(version)
+    return trackerPeers
 
 ####### Updates client mask in server ########
+#Trackers that know HAVE hear about every chunk as it arrives instead
 def updateMask(chunkMask, serverSocket):
-    serverSocket.send(("UPDATE_MASK\n").encode())
-    serverSocket.send(chunkMask.encode())
-
-######## Makes chunks for size of chunkNum ############
-def makeChunks(chunkNum):
-    chunks = [None]*int(chunkNum)
-    return chunks
-
-######### Sends chunk to other clients ###############
-def sendChunk(listenerConn, chunks):
-    index = getLine(listenerConn) #gets index of chunk list
-    chunk = chunks[int(index)] #get chunk from index
-    listenerConn.send(chunk) # sends chuhnk
-
-############### Downloads chunk from other client ##############
-def getChunk(chunkNum, chunkSize, chunkMask, chunks, clientList, serverSocket, checkSum):
-    for clients in clientList: #For each client, get ip info and the chunk mask
-        ipInfo, clientMask = clients.split(',')
-        newList = list(range(0, int(chunkNum))) #Make a random list of numbers so then chunks are not downloaded one after another
-        random.shuffle(newList)
-
-        for i in newList: #For each number in randList
-            if chunkMask[i] == "0" and clientMask[i] == "1": #If current doesnt have chunk but connected client does
-                clientIp,clientPort = ipInfo.split(':') #Get connection infor
-                clientSocket = createConnection(clientIp, int(clientPort)) #Connect to client
-                clientSocket.send((str(i)+"\n").encode()) #Send chunk index to cleint
-                chunk = getFullMsg(clientSocket, int(chunkSize)) #Get chunk from other client
-                newCheck = hashlib.sha224(chunk).hexdigest() #Make new checksum
-                check = (checkSum[i])[:-1]
-                if check == newCheck: #check if checksums match
-                    chunks[i] = chunk #if they match then update checksum and close the connection
-                    tmp = list(chunkMask)
-                    tmp[i] = "1"
-                    chunkMask = "".join(tmp)
-                    clientSocket.close()
-
-        #Update mask after each client and get updated client list after each client. This is done this way so then it can get a new list of clients in after each client with a new chunk mask so then when it checks for a new client the lists are fully updated
-        updateMask(chunkMask, serverSocket)
-        clientList = getClients(serverSocket) 
-    return chunkMask, chunks
-
-#Makes file after all chunks are recieved
-def makeFile(chunks, fileName):
-    file = b''.join(chunks) #joins bytes
-    with open(fileName[:-1], 'wb') as f:
-        f.write(file)
-    
-#Thread function for listening
-def incomingConn(chunks):
-    listener.listen(8) #Chose 8 because server supports 32 connects. Needed less than 32, assumed more than 8 clients would not be connected at once and 8 is a good hex number
-    while True: #Keep excepting unless interrupt
-        connection, ip = listener.accept()
-        sendChunk(connection, chunks)
+    serverSocket.send((f"UPDATE_MASK\n{chunkMask.toMask()}\n").encode())
+
+#Tells the tracker about new chunks, one HAVE line each, in a single send
+def announceHave(indexes, serverSocket):
+    if indexes:
+        serverSocket.send("".join(f"HAVE {i}\n" for i in indexes).encode())
+
+############### Downloads chunks from other client ##############
+# One long-lived connection to a peer. Chunk requests are pipelined: request()
+#   sends the index right away and returns a Future, and a thread reads the
+#   answers in the order they were asked for. If the peer hangs up or stalls
+#   for REQUEST_TIMEOUT, every request still waiting fails with an OSError and
+#   the connection is closed
+class PeerConnection:
+    def __init__(self, peer):
+        self.peer = peer
+        self.sock = None
+        self.closed = False
+        self.waiting = deque() #(size, future) of every request not answered yet, in order
+        self.unsent = [] #indexes asked for before the connection was made
+        self.lock = threading.Condition()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    # asks the peer for one chunk of `size' bytes
+    def request(self, index, size):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionError("peer connection closed"))
+                return future
+            self.waiting.append((size, future))
+            if self.sock is None:
+                self.unsent.append(index)
+            else:
+                try:
+                    self.sock.sendall((str(index)+"\n").encode())
+                except OSError:
+                    pass #the receive thread notices too and fails the request
+            self.lock.notify()
+        return future
+
+    # connects, then hands every answer to the request waiting for it
+    def receive(self):
+        try:
+            clientIp, clientPort = self.peer
+            sock = createConnection(clientIp, int(clientPort), CONNECT_TIMEOUT) #Connect to client
+            sock.settimeout(REQUEST_TIMEOUT)
+            with self.lock:
+                self.sock = sock
+                sock.sendall("".join(str(index)+"\n" for index in self.unsent).encode())
+                self.unsent = []
+            reader = BufferedReader(sock)
+            while True:
+                with self.lock:
+                    while not self.waiting and not self.closed:
+                        self.lock.wait()
+                    if self.closed:
+                        return
+                    size, future = self.waiting[0]
+                chunk = reader.getFullMsg(size) #Get chunk from other client
+                if len(chunk) < size:
+                    raise ConnectionError("peer hung up or stalled")
+                with self.lock:
+                    self.waiting.popleft()
+                future.set_result(chunk)
+        except OSError as e:
+            self.close(e)
+
+    def close(self, error=None):
+        with self.lock:
+            self.closed = True
+            failed = list(self.waiting)
+            self.waiting.clear()
+            if self.sock is not None:
+                self.sock.close()
+            self.lock.notify()
+        for size, future in failed:
+            future.set_exception(error or ConnectionError("peer connection closed"))
+
+#Open connections to peers, reused every time the client list is refreshed
+peerConnections = {} #peer -> PeerConnection
+
+# returns the open connection to `peer', connecting again if the old one closed
+def getConnection(peer):
+    conn = peerConnections.get(peer)
+    if conn is None or conn.closed:
+        conn = peerConnections[peer] = PeerConnection(peer)
+    return conn
+
+# closes the connections to peers that aren't in `peers', or all of them
+def closeConnections(peers=()):
+    for peer in [peer for peer in peerConnections if peer not in peers]:
+        peerConnections.pop(peer).close()
+
+#Number of chunks each peer sent that failed their checksum, kept across refreshes
+badChunks = {} #peer -> count
+
+# picks the peer that has chunk `index', isn't in `skip' and is below
+#   MAX_PEER_REQUESTS, preferring peers that sent fewer bad chunks and then
+#   the least busy one. returns None if there isn't one
+def pickPeer(index, peerMasks, peerLoad, skip):
+    best = None
+    for peer, clientMask in peerMasks.items():
+        if not clientMask[index] or peer in skip or peerLoad[peer] >= MAX_PEER_REQUESTS:
+            continue
+        if best is None or (badChunks.get(peer, 0), peerLoad[peer]) < (badChunks.get(best, 0), peerLoad[best]):
+            best = peer
+    return best
+
+# downloads every missing chunk the peers in clientList have, rarest first,
+#   keeping up to MAX_REQUESTS requests in flight across all of them. A chunk
+#   that fails or stalls is handed to another peer that has it. Received chunks
+#   are checked on verifyPool while the downloads go on, and a peer that sends
+#   MAX_BAD_CHUNKS bad ones is dropped. In endgame mode the last chunks are
+#   requested from several peers at once and the first good copy is kept.
+#   Good chunks are set in chunkMask, and announced with HAVE as they arrive
+#   if the tracker knows it, or with one UPDATE_MASK at the end if it doesn't
+def getChunk(chunkNum, chunkSizes, chunkMask, storage, clients, serverReader, checkSum, picker, features):
+    peerMasks = {peer: clientMask for peer, clientMask in clients.items() if badChunks.get(peer, 0) < MAX_BAD_CHUNKS}
+    peerLoad = dict.fromkeys(peerMasks, 0)
+    closeConnections(peerMasks) #Drop connections to peers that left
+    picker.updatePeers(peerMasks) #Only peers whose masks changed are counted again
+
+    pending = picker.pickOrder() #Rarest chunks first
+    failed = {i: set() for i in pending} #Peers that already failed to send each chunk
+    fetching = {i: set() for i in pending} #Peers each chunk is being downloaded from
+    inFlight = {} #future -> (chunk index, peer)
+    checking = {} #verification future -> (chunk index, peer)
+    checkingCount = dict.fromkeys(pending, 0) #copies of each chunk being verified
+    lastSave = time.monotonic() #when the chunk mask was last written to disk
+
+    # puts a chunk back in line if no copy of it is on the way anymore
+    def retry(i):
+        if not fetching[i] and not checkingCount[i] and not chunkMask[i]:
+            pending.append(i)
+
+    def request(i, peer):
+        peerLoad[peer] += 1
+        fetching[i].add(peer)
+        inFlight[getConnection(peer).request(i, chunkSizes[i])] = (i, peer)
+
+    while True:
+        #Hand out as many waiting chunks as the limits allow
+        waiting = []
+        for i in pending:
+            peer = None
+            if len(inFlight) < MAX_REQUESTS:
+                peer = pickPeer(i, peerMasks, peerLoad, failed[i])
+            if peer is None:
+                waiting.append(i)
+            else:
+                request(i, peer)
+        pending = waiting
+
+        #In endgame, ask more peers for the chunks that are still downloading
+        if picker.inEndgame():
+            for i in [i for i in picker.missing if fetching.get(i)]:
+                while len(fetching[i]) < ENDGAME_DUPLICATES and len(inFlight) < MAX_REQUESTS:
+                    peer = pickPeer(i, peerMasks, peerLoad, failed[i] | fetching[i])
+                    if peer is None:
+                        break
+                    request(i, peer)
+
+        if not inFlight and not checking:
+            break #Nothing left that these peers can send
+
+        done, notDone = wait(list(inFlight) + list(checking), return_when=FIRST_COMPLETED)
+        newChunks = [] #chunks that passed their check this time around
+        for future in done:
+            if future in checking: #a chunk was verified, and written to the file if it was good
+                i, peer = checking.pop(future)
+                checkingCount[i] -= 1
+                if chunkMask[i]:
+                    continue #Another copy already passed
+                if future.result():
+                    chunkMask.set(i)
+                    picker.markHave(i)
+                    newChunks.append(i)
+                else:
+                    badChunks[peer] = badChunks.get(peer, 0) + 1
+                    if badChunks[peer] >= MAX_BAD_CHUNKS:
+                        peerMasks.pop(peer, None) #stop asking this peer for anything
+                    failed[i].add(peer) #try the chunk again with another peer
+                    retry(i)
+                continue
+
+            i, peer = inFlight.pop(future)
+            peerLoad[peer] -= 1
+            fetching[i].discard(peer)
+            if chunkMask[i]:
+                continue #Another peer already sent this chunk
+            try:
+                chunk = future.result()
+            except OSError:
+                failed[i].add(peer) #the peer hung up or stalled, try another
+                retry(i)
+                continue
+            checkingCount[i] += 1
+            checking[verifyPool.submit(storage.verifyAndWrite, i, chunk, checkSum[i])] = (i, peer)
+
+        if "HAVE" in features:
+            announceHave(newChunks, serverReader.conn) #other peers can ask us for them right away
+        if newChunks and time.monotonic() - lastSave >= MASK_SAVE_INTERVAL:
+            storage.saveMask(chunkMask.toMask())
+            lastSave = time.monotonic()
+
+    #Update mask once every peer had its turn, the main loop then gets an updated client list
+    if "HAVE" not in features:
+        updateMask(chunkMask, serverReader.conn)
+
+#Keeps serving other peers once the download is done, printing the upload
+#   rate every STATS_INTERVAL seconds. Runs for SEED_TIME seconds, or until Ctrl-C
+def seed(uploader):
+    start = time.monotonic()
+    while not SEED_TIME or time.monotonic() - start < SEED_TIME:
+        left = SEED_TIME - (time.monotonic() - start) if SEED_TIME else STATS_INTERVAL
+        time.sleep(min(STATS_INTERVAL, left))
+        uploaded, rate, peers = uploader.stats()
+        print(f"Seeding to {peers} peers at {rate / 1024:.1f} KB/s, {uploaded / 1048576:.1f} MB uploaded")
 
 running = True
 while running: #Endless loop till keyboard interrupt
     try:
-        chunkNum, chunkSize, chunkMask, serverSocket, fileName, checkSum = getInitial() #runs function for initial info
-        chunks = makeChunks(chunkNum) #gets list of chunks
-        threading.Thread(target = incomingConn, args = (chunks,), daemon = True).start() #Starts thread in thread function
+        chunkNum, chunkSize, serverReader, fileName, checkSum, chunkSizes = getInitial() #runs function for initial info
+        serverSocket = serverReader.conn
+        storage = PieceStorage(fileName[:-1], int(chunkSize), chunkSizes) #chunks are written straight into the file
+        picker = PiecePicker(int(chunkNum)) #decides which chunks to download first
+        chunkMask = resumeChunks(storage, checkSum, picker) #keep what an earlier run already downloaded
+        sendInitial(chunkMask, serverSocket) #the tracker hears about recovered chunks right away
+        features = getFeatures(serverReader) #HAVE and delta client lists, if the tracker knows them
+        if features is None: #the tracker hung up on FEATURES, connect again without it
+            serverReader = getInitial()[2]
+            serverSocket = serverReader.conn
+            sendInitial(chunkMask, serverSocket)
+            features = set()
+        uploader = Uploader(storage, UPLOAD_SLOTS, PEER_UPLOAD_RATE * 1024) #serves other peers while we download
+        listener.listen(32)
+        threading.Thread(target = uploader.serve, args = (listener,), daemon = True).start() #Starts thread in thread function
 
         #while the chunkmask is not full. Get new list of clients and run getChunk
-        while str(chunkMask) != ("1"*int(chunkNum) + "\n"):
-            clients = getClients(serverSocket) #if reciever somehow runs out of clients before downloading all chunks
-            chunkMask, chunks = getChunk(chunkNum, chunkSize, chunkMask, chunks, clients, serverSocket, checkSum)
-        print("Waiting for 2 minutes to keep sending data")
-        time.sleep(120) #sleep for 2 minutes to keep sending to others
-        serverSocket.send(("DISCONNECT\n").encode()) #disconnect from server and make the file
+        while not chunkMask.isFull():
+            clients = getClients(serverReader, features) #if reciever somehow runs out of clients before downloading all chunks
+            oldCount = chunkMask.count()
+            getChunk(chunkNum, chunkSizes, chunkMask, storage, clients, serverReader, checkSum, picker, features) #fills in chunkMask
+            storage.saveMask(chunkMask.toMask()) #a restarted client only has to fetch what's missing
+            if chunkMask.count() == oldCount:
+                time.sleep(REFRESH_DELAY) #no peer had anything new, give the swarm a moment
+        closeConnections() #Done downloading, hang up on the peers
+        print("Download complete, seeding" + (f" for {SEED_TIME:g} seconds" if SEED_TIME else " until Ctrl-C"))
+        seed(uploader) #keep sending to others
+        serverSocket.send(("DISCONNECT\n").encode()) #disconnect from server and close the file
         serverSocket.close()
-        makeFile(chunks, fileName)
+        storage.close()
         running = False
 
     except KeyboardInterrupt: #disconnect if keyboard interrupt
@@ -0,0 +1,159 @@
+from sys import argv
+from socket import *
+from pathlib import Path
+from collections import deque
+import threading
+import hashlib
+from bvBufferedReader import BufferedReader
+
+# Stand-in for the class's bvTorrent tracker, for testing bvTorrent-client.py
+#   locally. It speaks the same protocol: on connect it sends the file name,
+#   chunk size, number of chunks and a "size,checksum" line per chunk, reads
+#   back the client's "port,mask", and then answers CLIENT_LIST, UPDATE_MASK
+#   and DISCONNECT.
+#
+# It also speaks an incremental extension. A client that sends FEATURES gets
+#   back "FEATURES HAVE DELTA" and may then use:
+#
+#   HAVE <index>              the client got one more chunk, no reply
+#   CLIENT_LIST_SINCE <ver>   what changed since the client list version the
+#                             client last saw. The reply starts with
+#                             "DELTA <ver> <count>" followed by count lines of
+#                             "PEER ip:port,mask" (joined or sent a whole new
+#                             mask), "HAVE ip:port,index" or "GONE ip:port".
+#                             If those changes are too old to replay, or
+#                             <ver> is 0, it starts with "FULL <ver> <count>"
+#                             followed by a CLIENT_LIST style "ip:port,mask"
+#                             line per client.
+#
+# Every change bumps the version and goes into a bounded log the deltas are
+#   built from, so a refresh costs what changed, not every peer's whole mask.
+# usage: bvTorrent-tracker.py FILE [CHUNK_SIZE] [PORT]
+
+DEFAULT_CHUNK_SIZE = 65536
+
+# number of changes kept for CLIENT_LIST_SINCE, older versions get a full list
+CHANGE_LOG_SIZE = 65536
+
+# Tracker state for one shared file
+class Tracker:
+    def __init__(self, fileName, chunkSize=DEFAULT_CHUNK_SIZE):
+        self.fileName = Path(fileName).name
+        self.chunkSize = chunkSize
+        self.checkSums = [] # (size, sha224 hex digest) of every chunk
+        with open(fileName, 'rb') as f:
+            while True:
+                chunk = f.read(chunkSize)
+                if not chunk:
+                    break
+                self.checkSums.append((len(chunk), hashlib.sha224(chunk).hexdigest()))
+        self.chunkNum = len(self.checkSums)
+        self.clients = {} # "ip:port" -> chunk mask as a bytearray of '0'/'1' characters
+        self.version = 0 # bumped on every change to clients
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE) # the line for each of the last versions
+        self.lock = threading.Lock()
+        self.listener = None
+
+    # records a change to clients, the lock must be held
+    def logChange(self, line):
+        self.version += 1
+        self.changes.append(line)
+
+    # adds a client that is already running somewhere, like an in-process
+    #   seeder, or gives a known client a whole new mask
+    def addClient(self, ip, port, mask):
+        key = f"{ip}:{port}"
+        with self.lock:
+            self.clients[key] = bytearray(mask.strip().encode())
+            self.logChange(f"PEER {key},{mask.strip()}")
+
+    # marks one more chunk as downloaded by a client
+    def addHave(self, key, index):
+        with self.lock:
+            self.clients[key][index] = ord("1")
+            self.logChange(f"HAVE {key},{index}")
+
+    def removeClient(self, key):
+        with self.lock:
+            if self.clients.pop(key, None) is not None:
+                self.logChange(f"GONE {key}")
+
+    # the reply to CLIENT_LIST, or to CLIENT_LIST_SINCE when `since' can't be replayed
+    def clientList(self, header):
+        with self.lock:
+            lines = [header.format(count=len(self.clients), version=self.version)]
+            lines += [f"{c},{m.decode()}" for c, m in self.clients.items()]
+        return ("\n".join(lines) + "\n").encode()
+
+    # the reply to CLIENT_LIST_SINCE
+    def clientListSince(self, since):
+        with self.lock:
+            missed = self.version - since
+            if since > 0 and 0 <= missed <= len(self.changes):
+                lines = [f"DELTA {self.version} {missed}"]
+                lines += list(self.changes)[len(self.changes) - missed:]
+                return ("\n".join(lines) + "\n").encode()
+        return self.clientList("FULL {version} {count}")
+
+    # starts accepting clients on `port' (0 lets the OS pick), returns the port
+    def start(self, port=0):
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(32)
+        threading.Thread(target=self.acceptClients, daemon=True).start()
+        return self.listener.getsockname()[1]
+
+    def acceptClients(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return # the tracker was stopped
+            threading.Thread(target=self.handleClient, args=(conn, addr), daemon=True).start()
+
+    def stop(self):
+        self.listener.close()
+
+    # runs one client's session
+    def handleClient(self, conn, addr):
+        reader = BufferedReader(conn)
+        header = [self.fileName, str(self.chunkSize), str(self.chunkNum)]
+        header += [f"{size},{checkSum}" for size, checkSum in self.checkSums]
+        conn.sendall(("\n".join(header) + "\n").encode())
+
+        clientPort, mask = reader.getLine().split(',')
+        key = f"{addr[0]}:{clientPort}"
+        self.addClient(addr[0], clientPort, mask)
+        try:
+            while True:
+                command, _, argument = reader.getLine().partition(' ')
+                if command == "CLIENT_LIST":
+                    conn.sendall(self.clientList("{count}"))
+                elif command == "UPDATE_MASK":
+                    self.addClient(addr[0], clientPort, reader.getLine())
+                elif command == "FEATURES":
+                    conn.sendall(b"FEATURES HAVE DELTA\n")
+                elif command == "HAVE":
+                    self.addHave(key, int(argument))
+                elif command == "CLIENT_LIST_SINCE":
+                    conn.sendall(self.clientListSince(int(argument)))
+                else: # DISCONNECT, or the client went away
+                    break
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            self.removeClient(key)
+            conn.close()
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print("usage: bvTorrent-tracker.py FILE [CHUNK_SIZE] [PORT]")
+        exit()
+    tracker = Tracker(argv[1], int(argv[2]) if len(argv) > 2 else DEFAULT_CHUNK_SIZE)
+    trackerPort = tracker.start(int(argv[3]) if len(argv) > 3 else 0)
+    print(f"Tracking {tracker.fileName} ({tracker.chunkNum} chunks) on port {trackerPort}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        tracker.stop()
@@ -0,0 +1,146 @@
+from collections import deque
+import threading
+import time
+from bvBufferedReader import BufferedReader
+
+# Seconds of uploads the rate in Uploader.stats() is averaged over
+RATE_WINDOW = 10
+
+# Seconds a peer can take to accept a chunk before it is dropped, so a peer
+#   that stopped reading doesn't keep an upload slot forever
+SEND_TIMEOUT = 10
+
+# Seconds of a shaped peer's rate sent at a time. A chunk goes out in slices
+#   this long, so the peer never goes without data for longer than the
+#   downloader's stall timeout waiting for tokens
+SHAPE_INTERVAL = .25
+
+# Limits how fast one connection is sent data. Sending a chunk takes its size
+#   in tokens, tokens come back at `rate' bytes per second, and up to `burst'
+#   bytes can be sent at once after the connection was idle. A rate of 0 means
+#   no limit
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # blocks until `size' bytes may be sent
+    def take(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            self.refill()
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    # True once the bucket has refilled to `burst' tokens
+    def isFull(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            self.refill()
+            return self.tokens >= self.burst
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+# The seeding side of bvTorrent-client.py. Every peer that connects gets a
+#   thread that reads its pipelined chunk requests and answers them in order
+#   straight from the file, so a slow downloader only holds up itself. At most
+#   `slots' chunks are sent at once across all peers, and every connection is
+#   sent at most `peerRate' bytes per second (0 for no limit).
+class Uploader:
+    def __init__(self, storage, slots, peerRate=0):
+        self.storage = storage
+        self.slots = threading.BoundedSemaphore(slots)
+        self.peerRate = peerRate
+        self.slice = max(1, int(peerRate * SHAPE_INTERVAL)) if peerRate else None # bytes sent per token wait
+        self.buckets = {} # peer IP: TokenBucket its last connection left behind, until it refills
+        self.lock = threading.Lock()
+        self.peers = 0 # connected peers
+        self.uploaded = 0 # bytes sent since the start
+        self.recent = deque() # (time, bytes) of the chunks sent in the last RATE_WINDOW seconds
+
+    # accepts peers on `listener' until it is closed
+    def serve(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.servePeer, args=(conn, addr[0]), daemon=True).start()
+
+    # a TokenBucket for a new connection from `ip'. It takes over the bucket
+    #   the peer's last connection left behind, so reconnecting doesn't refill it
+    def bucket(self, ip):
+        with self.lock:
+            bucket = self.buckets.pop(ip, None)
+        return bucket or TokenBucket(self.peerRate, max(self.slice or 0, self.peerRate))
+
+    # keeps the bucket of a closed connection from `ip' until it has refilled,
+    #   which is when a new bucket would be no different
+    def release(self, ip, bucket):
+        with self.lock:
+            for other in [other for other, left in self.buckets.items() if left.isFull()]:
+                del self.buckets[other]
+            if not bucket.isFull() and (ip not in self.buckets or bucket.tokens < self.buckets[ip].tokens):
+                self.buckets[ip] = bucket # the emptier one, if several connections from `ip' closed
+
+    # A peer can keep its connection open and send any number of chunk
+    #   indexes, one per line, without waiting for the answers. They are
+    #   answered in order with the chunk's bytes. A peer that asks for one
+    #   chunk and hangs up works too. A shaped chunk is sent a slice at a time
+    def servePeer(self, conn, ip):
+        reader = BufferedReader(conn)
+        bucket = self.bucket(ip)
+        with self.lock:
+            self.peers += 1
+        try:
+            while True:
+                index = reader.getLine()
+                if index == "":
+                    break # peer hung up
+                index = int(index)
+                if not self.storage.have[index]:
+                    break # we don't have it, hanging up fails the peer's request
+                size = self.storage.chunkSizes[index]
+                sent = 0
+                while sent < size:
+                    part = min(size - sent, self.slice or size)
+                    bucket.take(part)
+                    with self.slots:
+                        conn.settimeout(SEND_TIMEOUT)
+                        self.storage.sendChunk(conn, index, sent, part)
+                        conn.settimeout(None) # waiting for the next request can take as long as it likes
+                    self.count(part)
+                    sent += part
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            with self.lock:
+                self.peers -= 1
+            self.release(ip, bucket)
+            conn.close()
+
+    def count(self, size):
+        now = time.monotonic()
+        with self.lock:
+            self.uploaded += size
+            self.recent.append((now, size))
+            while self.recent[0][0] < now - RATE_WINDOW:
+                self.recent.popleft()
+
+    # returns (bytes uploaded in total, bytes per second lately, connected peers)
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and self.recent[0][0] < now - RATE_WINDOW:
+                self.recent.popleft()
+            return self.uploaded, sum(size for sent, size in self.recent) / RATE_WINDOW, self.peers